@@ -4,3 +4,23 @@ chats_port = 2907
 files_port = 3103
 voice_port = 2706
 video_port = 2903
+# The framing to offer the server ('text' or 'binary'), servers without binary framing stay on 'text'
+framing = 'text'
+# The cipher of the calls and the binary framing ('cbc' or the authenticated 'gcm')
+cipher = 'cbc'
+# The amount of RSA keys generated ahead in the background, and whether to use one key pair per session
+rsa_pool_size = 3
+reuse_rsa_key = False
+# Whether to carry the chats and files channels on the general connection (falls back to three connections)
+multiplexed = False
+# Whether to run the connections and the dispatch of their messages as coroutines on the event loop of the GUI
+asyncio_com = False
+# Whether to request the whole initial state at once when logging in, instead of a request per chat
+batched_bootstrap = False
+# Whether to keep the chats' messages on disk (encrypted), so only new messages are downloaded when logging in
+store_messages = False
+# The amount of worker threads handling the CPU heavy messages (decryption, files), 0 handles them in order on the
+# thread of their channel
+dispatch_workers = 4
+# The preferred codec of the voice calls ('adpcm', 'ulaw' or 'pcm'), the calls fall back to a codec every member has
+audio_codec = 'adpcm'
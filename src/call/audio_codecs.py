@@ -0,0 +1,185 @@
+import struct
+import time
+import numpy as np
+
+try:
+    # IMA ADPCM, part of the standard library until Python 3.13
+    import audioop
+except ImportError:
+    audioop = None
+
+
+class PCMCodec:
+    """
+    Raw 16-bit PCM, the fallback every client can decode
+    """
+    ID = 0
+    NAME = 'pcm'
+
+    def encode(self, pcm: bytes):
+        """
+        Encodes a chunk of audio
+        :param pcm: The 16-bit mono PCM samples
+        :type pcm: bytes
+        :return: The encoded chunk
+        :rtype: bytes
+        """
+        return pcm
+
+    @staticmethod
+    def decode(data: bytes):
+        """
+        Decodes a chunk of audio
+        :param data: The encoded chunk
+        :type data: bytes
+        :return: The 16-bit mono PCM samples
+        :rtype: bytes
+        """
+        return data
+
+
+class ULawCodec:
+    """
+    Mu-law companding of every sample to 8 bits (2:1), computed with NumPy
+    """
+    ID = 1
+    NAME = 'ulaw'
+    MU = 255
+
+    def encode(self, pcm: bytes):
+        """
+        Encodes a chunk of audio
+        :param pcm: The 16-bit mono PCM samples
+        :type pcm: bytes
+        :return: The encoded chunk
+        :rtype: bytes
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16) / 32768
+        companded = np.sign(samples) * np.log1p(ULawCodec.MU * np.abs(samples)) / np.log1p(ULawCodec.MU)
+        return np.round(companded * 127).astype(np.int8).tobytes()
+
+    @staticmethod
+    def decode(data: bytes):
+        """
+        Decodes a chunk of audio
+        :param data: The encoded chunk
+        :type data: bytes
+        :return: The 16-bit mono PCM samples
+        :rtype: bytes
+        """
+        companded = np.frombuffer(data, dtype=np.int8) / 127
+        samples = np.sign(companded) * np.expm1(np.abs(companded) * np.log1p(ULawCodec.MU)) / ULawCodec.MU
+        return np.clip(samples * 32768, -32768, 32767).astype(np.int16).tobytes()
+
+
+class ADPCMCodec:
+    """
+    IMA ADPCM, 4 bits per sample (4:1).
+    Every chunk starts with the state of the encoder, so chunks are decoded on their own even if others are lost.
+    """
+    ID = 2
+    NAME = 'adpcm'
+    # The predicted sample and the step index the chunk starts from
+    STATE = struct.Struct('!hB')
+
+    def __init__(self):
+        self.state = None
+
+    def encode(self, pcm: bytes):
+        """
+        Encodes a chunk of audio
+        :param pcm: The 16-bit mono PCM samples
+        :type pcm: bytes
+        :return: The encoded chunk
+        :rtype: bytes
+        """
+        state = self.state or (0, 0)
+        data, self.state = audioop.lin2adpcm(pcm, 2, self.state)
+        return ADPCMCodec.STATE.pack(*state) + data
+
+    @staticmethod
+    def decode(data: bytes):
+        """
+        Decodes a chunk of audio
+        :param data: The encoded chunk
+        :type data: bytes
+        :return: The 16-bit mono PCM samples
+        :rtype: bytes
+        """
+        state = ADPCMCodec.STATE.unpack_from(data)
+        return audioop.adpcm2lin(data[ADPCMCodec.STATE.size:], 2, state)[0]
+
+
+# The codecs this client can encode and decode by their names, from the most to the least compressed
+CODECS = {codec.NAME: codec for codec in (ADPCMCodec, ULawCodec, PCMCodec)
+          if codec is not ADPCMCodec or audioop is not None}
+# The codecs by their ids in the audio packets
+CODECS_BY_ID = {codec.ID: codec for codec in CODECS.values()}
+
+
+def codecs_mask(codecs=CODECS.values()):
+    """
+    Returns the bit mask of codecs which is advertised in every audio packet
+    :param codecs: The codecs
+    :return: The mask, with the bit of the id of every codec set
+    :rtype: int
+    """
+    mask = 0
+    for codec in codecs:
+        mask |= 1 << codec.ID
+    return mask
+
+
+def negotiate_codec(masks, preferred=None):
+    """
+    Chooses the codec of a call, the preferred codec (or the most compressed one) which every member can decode
+    :param masks: The codecs masks of the members of the call
+    :param preferred: The name of the preferred codec
+    :type preferred: str
+    :return: The codec
+    :rtype: type
+    """
+    common = codecs_mask()
+    for mask in masks:
+        common &= mask
+
+    candidates = list(CODECS.values())
+    if preferred in CODECS:
+        candidates.insert(0, CODECS[preferred])
+    return next((codec for codec in candidates if common & (1 << codec.ID)), PCMCodec)
+
+
+def _benchmark(rate=44100, chunk=4096, repeat=200):
+    """
+    Measures the bitrate, the quality and the encode and decode CPU time per chunk of every codec
+    :param rate: The sample rate
+    :param chunk: The amount of samples in a chunk
+    :param repeat: The amount of chunks encoded and decoded
+    :return: -
+    """
+    # A voice-like signal: a few harmonics with a syllable envelope, and some noise
+    t = np.arange(chunk * repeat) / rate
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)
+    signal = envelope * sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate((180, 360, 720, 1440)))
+    signal = signal * 6000 + np.random.normal(0, 200, signal.size)
+    chunks = [signal[i * chunk:(i + 1) * chunk].astype(np.int16).tobytes() for i in range(repeat)]
+
+    for codec_class in CODECS.values():
+        codec = codec_class()
+        start = time.perf_counter()
+        encoded = [codec.encode(pcm) for pcm in chunks]
+        encode_time = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        decoded = [codec_class.decode(data) for data in encoded]
+        decode_time = (time.perf_counter() - start) / repeat
+
+        original = np.frombuffer(b''.join(chunks), dtype=np.int16).astype(np.float64)
+        error = original - np.frombuffer(b''.join(decoded), dtype=np.int16)
+        snr = 10 * np.log10(np.sum(original ** 2) / max(np.sum(error ** 2), 1))
+        bitrate = len(encoded[0]) * 8 * rate / chunk / 1000
+        print(f'{codec_class.NAME}: {bitrate:.0f} kbps, encode {encode_time * 10 ** 6:.0f}us, '
+              f'decode {decode_time * 10 ** 6:.0f}us per chunk, SNR {snr:.1f} dB')
+
+
+if __name__ == '__main__':
+    _benchmark()
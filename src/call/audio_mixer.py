@@ -0,0 +1,121 @@
+import threading
+import time
+import numpy as np
+import pyaudio
+from src.call.ring_buffer import RingBuffer
+
+
+class AudioMixer:
+    """
+    Plays the audio of all the members of a call through one output stream, summing the members' chunks with their
+    volumes.
+    A mixing thread keeps a ring buffer up to a chunk ahead of the output stream, whose callback only copies from it.
+    """
+
+    def __init__(self, audio, audio_format, channels, rate, chunk, block, probe):
+        """
+        Opens the output stream of the mixer and starts mixing
+        :param audio: The PyAudio object of the call
+        :type audio: pyaudio.PyAudio
+        :param audio_format: The format of the samples
+        :param channels: The amount of channels
+        :type channels: int
+        :param rate: The sample rate
+        :type rate: int
+        :param chunk: The amount of samples in a chunk
+        :type chunk: int
+        :param block: The amount of samples in every callback of the output stream
+        :type block: int
+        :param probe: The probe counting the glitches of the output
+        :type probe: LatencyProbe
+        """
+        self.chunk = chunk
+        self.probe = probe
+        self.lock = threading.Lock()
+        # The members mixed, by their usernames. The dict is replaced rather than changed, so the mixing thread
+        # reads it without the lock
+        self.users = {}
+        # The mixed audio waiting to be played, between the mixing thread and the output callback. A chunk is mixed
+        # when less than two blocks are left, so the mixing thread has a block's time to catch up
+        self.playout = RingBuffer(chunk + 2 * block)
+        self.active = True
+        threading.Thread(target=self._mix_loop, args=(block / rate / 2,), daemon=True).start()
+        self.output = audio.open(format=audio_format, channels=channels, rate=rate, output=True,
+                                 frames_per_buffer=block, stream_callback=self._play)
+
+    def add_user(self, user):
+        """
+        Starts mixing the audio of a call member
+        :param user: The call member, with an open jitter buffer
+        :type user: User
+        :return: -
+        """
+        with self.lock:
+            self.users = {**self.users, user.username: user}
+
+    def remove_user(self, user):
+        """
+        Stops mixing the audio of a call member
+        :param user: The call member
+        :type user: User
+        :return: -
+        """
+        with self.lock:
+            self.users = {username: member for username, member in self.users.items() if username != user.username}
+
+    def mix(self):
+        """
+        Mixes the next chunk of every member
+        :return: The 16-bit PCM samples of the mixed chunk
+        :rtype: bytes
+        """
+        mixed = np.zeros(self.chunk, dtype=np.float32)
+        for user in self.users.values():
+            jitter_buffer = user.jitter_buffer
+            if jitter_buffer is None:
+                continue
+            samples = np.frombuffer(jitter_buffer.get(), dtype=np.int16)
+            if user.volume == 1:
+                mixed += samples
+            elif user.volume:
+                mixed += samples * np.float32(user.volume)
+        # Loud members together (or a high volume) may pass the range of the samples, which is clipped
+        return np.clip(mixed, -32768, 32767).astype(np.int16).tobytes()
+
+    def _mix_loop(self, interval):
+        """
+        Mixes a chunk whenever the playout buffer has room for it
+        :param interval: The amount of seconds to wait while the playout buffer is full
+        :type interval: float
+        :return: -
+        """
+        while self.active:
+            if self.playout.free() >= self.chunk:
+                self.playout.write(self.mix())
+            else:
+                time.sleep(interval)
+
+    def _play(self, in_data, frame_count, time_info, status):
+        """
+        The callback of the output stream, plays the next block of the mixed audio
+        :return: The block and whether to continue playing
+        :rtype: tuple
+        """
+        if status & pyaudio.paOutputUnderflow:
+            self.probe.glitch('output_underflow')
+        data = self.playout.read(frame_count)
+        if data is None:
+            # The mixing fell behind, play silence rather than wait
+            self.probe.glitch('playout_underrun')
+            data = bytes(frame_count * 2)
+        return data, pyaudio.paContinue
+
+    def close(self):
+        """
+        Stops mixing and closes the output stream
+        :return: -
+        """
+        self.active = False
+        if not self.output.is_stopped():
+            self.output.stop_stream()
+        self.output.close()
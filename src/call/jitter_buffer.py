@@ -0,0 +1,179 @@
+import math
+import threading
+import time
+import numpy as np
+from src.call.voice_activity import comfort_noise
+
+
+class JitterBuffer:
+    """
+    Holds the audio chunks of a call member by their sequence numbers until the member's chunk is played,
+    so late and reordered packets are played in order, and lost packets are concealed.
+    The depth of the buffer adapts to the jitter of the member's packets.
+    """
+    MIN_DEPTH = 1  # The least amount of chunks buffered before the playout starts
+    MAX_DEPTH = 6  # The most amount of chunks buffered, older chunks are dropped to catch up
+    JITTER_GAIN = 1 / 16  # How fast the estimate of the jitter follows the arrival times (as in RTP)
+    CONCEALMENT_FADE = 0.5  # The gain of every chunk repeated in place of a lost chunk, relative to the last one
+    MAX_CONCEALED = 3  # The amount of chunks concealed in a row before playing silence
+
+    def __init__(self, chunk, rate):
+        """
+        Creates an empty jitter buffer
+        :param chunk: The amount of samples in a chunk
+        :type chunk: int
+        :param rate: The sample rate
+        :type rate: int
+        """
+        self.chunk = chunk
+        self.chunk_time = chunk / rate
+        self.lock = threading.Lock()
+        # The buffered chunks by their (unwrapped) sequence numbers, a chunk is its PCM or the level of comfort noise
+        self.chunks = {}
+        # The highest sequence number received (unwrapped), None until the first packet
+        self.highest_seq = None
+        # The sequence number of the next chunk to play, None while waiting for the buffer to fill
+        self.next_seq = None
+        # The sequence number of the last chunk played, packets at or before it are late
+        self.played_seq = None
+        # The level of the comfort noise while the member is silent, None while the member speaks
+        self.comfort_noise_level = None
+        # The last chunk played, repeated (faded) in place of lost chunks, and the amount of lost chunks in a row
+        self.last_chunk = None
+        self.concealed = 0
+        # The estimate of the jitter in seconds, and the transit time of the last packet
+        self.jitter = 0
+        self.last_transit = None
+        self.target_depth = self.MIN_DEPTH
+        # Statistics
+        self.received = 0
+        self.late = 0
+        self.lost = 0
+        self.dropped = 0
+
+    def _unwrap(self, seq):
+        """
+        Returns the sequence number of a packet without the 16-bit wraparound
+        :param seq: The 16-bit sequence number
+        :type seq: int
+        :return: The unwrapped sequence number
+        :rtype: int
+        """
+        if self.highest_seq is None:
+            return seq
+        # The closest number to the highest sequence number with the same low 16 bits
+        delta = (seq - self.highest_seq + 0x8000) % 0x10000 - 0x8000
+        return self.highest_seq + delta
+
+    def put(self, seq, pcm=None, comfort_noise_level=None):
+        """
+        Adds a packet to the buffer, called by the receiving thread
+        :param seq: The 16-bit sequence number of the packet, None for packets without one (of older clients)
+        :type seq: int
+        :param pcm: The 16-bit PCM samples of the chunk, None for comfort noise markers
+        :type pcm: bytes
+        :param comfort_noise_level: The level of the comfort noise of a marker
+        :type comfort_noise_level: int
+        :return: -
+        """
+        now = time.time()
+        with self.lock:
+            if seq is None:
+                seq = 0 if self.highest_seq is None else self.highest_seq + 1
+            else:
+                seq = self._unwrap(seq)
+            self.received += 1
+
+            if (self.played_seq is not None and seq <= self.played_seq) or seq in self.chunks:
+                self.late += 1
+                return
+            self.chunks[seq] = pcm if pcm is not None else comfort_noise_level
+
+            # The jitter is the variation of the transit time, the arrival time relative to the sequence number
+            transit = now - seq * self.chunk_time
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) * self.JITTER_GAIN
+            self.last_transit = transit
+            self.target_depth = min(self.MAX_DEPTH, max(self.MIN_DEPTH,
+                                                        1 + math.ceil(2 * self.jitter / self.chunk_time)))
+
+            if self.highest_seq is None or seq > self.highest_seq:
+                self.highest_seq = seq
+            # Too much audio is buffered (e.g. after a burst), drop the oldest chunks to cut the delay
+            while len(self.chunks) > self.MAX_DEPTH:
+                oldest = min(self.chunks)
+                del self.chunks[oldest]
+                self.played_seq = oldest
+                if self.next_seq is not None:
+                    self.next_seq = oldest + 1
+                self.dropped += 1
+
+    def get(self):
+        """
+        Returns the next chunk to play, called by the audio output
+        :return: The 16-bit PCM samples of the chunk
+        :rtype: bytes
+        """
+        with self.lock:
+            # Waiting for the buffer to fill, at the start of the call and of every talkspurt
+            if self.next_seq is None:
+                if len(self.chunks) < self.target_depth:
+                    return self._silence()
+                self.next_seq = min(self.chunks)
+
+            seq = self.next_seq
+            self.next_seq += 1
+            chunk = self.chunks.pop(seq, None)
+            self.played_seq = seq
+            if chunk is None:
+                # The buffer ran out, wait for it to fill again
+                if not self.chunks:
+                    self.next_seq = None
+                self.lost += 1
+                return self._conceal()
+
+            if isinstance(chunk, int):
+                # A comfort noise marker, the member is silent and the chunks until the next talkspurt aren't sent
+                self.comfort_noise_level = chunk
+                self.next_seq = None
+                return self._silence()
+
+            self.comfort_noise_level = None
+            self.last_chunk = chunk
+            self.concealed = 0
+            return chunk
+
+    def _silence(self):
+        """
+        Returns a chunk of the member's comfort noise, or of silence
+        :return: The 16-bit PCM samples of the chunk
+        :rtype: bytes
+        """
+        if self.comfort_noise_level:
+            return comfort_noise(self.comfort_noise_level, self.chunk)
+        return bytes(self.chunk * 2)
+
+    def _conceal(self):
+        """
+        Returns a chunk played in place of a lost chunk, the last chunk fading out
+        :return: The 16-bit PCM samples of the chunk
+        :rtype: bytes
+        """
+        self.concealed += 1
+        if self.last_chunk is None or self.concealed > self.MAX_CONCEALED:
+            return self._silence()
+        samples = np.frombuffer(self.last_chunk, dtype=np.int16) * self.CONCEALMENT_FADE ** self.concealed
+        return samples.astype(np.int16).tobytes()
+
+    def stats(self):
+        """
+        Returns the statistics of the buffer
+        :return: The depth of the buffer (in chunks and in milliseconds), its target depth, the jitter and the
+        amounts of packets received, late (arrived after their chunk was played), lost (missing when their chunk
+        was played, concealed) and dropped (to cut the delay)
+        :rtype: dict
+        """
+        with self.lock:
+            return {'depth': len(self.chunks), 'depth_ms': round(len(self.chunks) * self.chunk_time * 1000),
+                    'target_depth': self.target_depth, 'jitter_ms': round(self.jitter * 1000),
+                    'received': self.received, 'late': self.late, 'lost': self.lost, 'dropped': self.dropped}
@@ -0,0 +1,51 @@
+from collections import deque
+import numpy as np
+
+
+class LatencyProbe:
+    """
+    Measures the latency from capturing the mic's audio to sending it, and counts the glitches of the audio streams.
+    Only the chunks which are sent are measured (speech, and the comfort noise markers of silence), the silent chunks
+    which are suppressed aren't, so the statistics describe the latency while speaking rather than of the whole call
+    """
+    SAMPLES = 500  # The amount of latest latencies the statistics are computed of
+    # The kinds of glitches: the device dropping captured audio, the capture buffer being full because the audio
+    # isn't sent fast enough, the device running out of audio to play, and the playout buffer running out of audio
+    GLITCHES = ('input_overflow', 'capture_overrun', 'output_underflow', 'playout_underrun')
+
+    def __init__(self):
+        self.latencies = deque(maxlen=self.SAMPLES)
+        # The amount of glitches of every kind, every kind is counted by one thread
+        self.glitches = dict.fromkeys(self.GLITCHES, 0)
+
+    def record_latency(self, seconds):
+        """
+        Records the latency of a chunk, from capturing its last sample to sending it
+        :param seconds: The latency in seconds
+        :type seconds: float
+        :return: -
+        """
+        self.latencies.append(seconds)
+
+    def glitch(self, kind):
+        """
+        Counts a glitch
+        :param kind: The kind of the glitch, one of GLITCHES
+        :type kind: str
+        :return: -
+        """
+        self.glitches[kind] += 1
+
+    def stats(self):
+        """
+        Returns the statistics of the latest latencies (in milliseconds) and the amounts of glitches
+        :rtype: dict
+        """
+        stats = dict(self.glitches)
+        # Copied at once, the sending thread appends meanwhile
+        latencies = np.array(list(self.latencies)) * 1000
+        if latencies.size:
+            stats.update(latency_avg_ms=round(float(latencies.mean()), 1),
+                         latency_p95_ms=round(float(np.percentile(latencies, 95)), 1),
+                         latency_max_ms=round(float(latencies.max()), 1))
+        return stats
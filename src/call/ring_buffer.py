@@ -0,0 +1,76 @@
+import numpy as np
+
+
+class RingBuffer:
+    """
+    A ring buffer of 16-bit samples between one writing thread and one reading thread (e.g. an audio callback and a
+    network thread), without locks: the writer only moves write_pos and the reader only moves read_pos, after copying
+    the samples
+    """
+
+    def __init__(self, capacity):
+        """
+        Creates an empty ring buffer
+        :param capacity: The most amount of samples in the buffer
+        :type capacity: int
+        """
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        # The amounts of samples written and read since the buffer was created
+        self.write_pos = 0
+        self.read_pos = 0
+
+    def available(self):
+        """
+        Returns the amount of samples waiting to be read
+        :rtype: int
+        """
+        return self.write_pos - self.read_pos
+
+    def free(self):
+        """
+        Returns the amount of samples which can be written
+        :rtype: int
+        """
+        return self.capacity - self.available()
+
+    def write(self, data):
+        """
+        Writes samples to the buffer, called by the writing thread
+        :param data: The 16-bit PCM samples
+        :type data: bytes
+        :return: The amount of samples written, less than the amount of samples if the buffer is full
+        :rtype: int
+        """
+        samples = np.frombuffer(data, dtype=np.int16)
+        count = min(samples.size, self.free())
+        start = self.write_pos % self.capacity
+        first = min(count, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:count - first] = samples[first:count]
+        # The samples are visible to the reader only after they're copied
+        self.write_pos += count
+        return count
+
+    def read(self, count):
+        """
+        Reads samples from the buffer, called by the reading thread
+        :param count: The amount of samples to read
+        :type count: int
+        :return: The 16-bit PCM samples, None if fewer samples are waiting
+        :rtype: bytes
+        """
+        if self.available() < count:
+            return None
+        start = self.read_pos % self.capacity
+        first = min(count, self.capacity - start)
+        data = self.buffer[start:start + first].tobytes() + self.buffer[:count - first].tobytes()
+        self.read_pos += count
+        return data
+
+    def skip(self):
+        """
+        Drops the samples waiting to be read, called by the reading thread
+        :return: -
+        """
+        self.read_pos = self.write_pos
@@ -4,7 +4,7 @@ import time
 import cv2
 import numpy
 import config
-from src.core.cryptions import AESCipher
+from src.core.cryptions import CipherContext, negotiate_cipher
 from src.handlers.camera_handler import CameraHandler
 import src.gui.gui_util as gui_util
 
@@ -41,8 +41,10 @@ class VideoCall:
         self.transmit_video = True
         self.parent = parent
 
-        self.aes = AESCipher()
         self.key = key
+        # The cipher context of the call's key, every member of the call has to use the same cipher so it's
+        # renegotiated by the call window as the members join
+        self.cipher = CipherContext.get(key, negotiate_cipher([config.cipher]))
 
         # Creates a UDP socket
         self.socket = None
@@ -91,7 +93,7 @@ class VideoCall:
                 # Compress the frame to jpg format
                 ret, buffer = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.QUALITY])
                 # Encrypt the data using the call's symmetrical key
-                data = self.aes.encrypt_bytes(self.key, buffer.tobytes())
+                data = self.cipher.encrypt_bytes(buffer.tobytes())
                 # The ips to send to
                 ips = list(self.ips_users.keys())
                 # Send the image to all the users in the call
@@ -114,12 +116,18 @@ class VideoCall:
             except Exception:
                 continue
 
-            # Decrypt the data using the call's symmetrical key
-            data = self.aes.decrypt_bytes(self.key, data)
+            try:
+                # Decrypt the data using the call's symmetrical key
+                data = self.cipher.decrypt_bytes(data)
+            except ValueError:
+                # A corrupt or forged frame (or one of another call)
+                continue
 
             # Convert the buffer received to an image
             buffer = numpy.frombuffer(data, numpy.uint8)
             frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+            if frame is None:
+                continue
 
             # Convert the frame from BGR to RGB
             frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
@@ -139,6 +147,14 @@ class VideoCall:
             # Put the image/frame in the ips-videos dict
             self.ips_users[ip].update_video(frame)
 
+    def set_cipher(self, cipher):
+        """
+        Switches the call to the cipher negotiated with the call members
+        :param cipher: The cipher of the call (AESCipher or AEADCipher)
+        :type cipher: type
+        """
+        self.cipher = CipherContext.get(self.key, cipher)
+
     def add_user(self, ip, user):
         """
         Adds a user to the call
@@ -184,4 +200,5 @@ class VideoCall:
         self.active = False
         if self.camera:
             self.camera.close()
+        CipherContext.evict(self.key)
         self.socket.close()
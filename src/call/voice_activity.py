@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class VoiceActivityDetector:
+    """
+    Decides which chunks of the mic's audio carry speech, by comparing their energy to the background noise
+    """
+    MARGIN_DB = 9  # How much louder than the background noise a chunk has to be to count as speech
+    MIN_SPEECH_DB = -50  # Chunks quieter than this (in dBFS) are never speech, however quiet the room is
+    NOISE_RISE_DB = 0.1  # How fast the estimate of the background noise follows a louder room, per chunk
+    HANGOVER_CHUNKS = 3  # The amount of chunks still sent after the speech, so the ends of words aren't cut
+
+    def __init__(self):
+        # The estimated energy of the background noise in dBFS, None until the first chunk
+        self.noise_db = None
+        # The amount of chunks left to send after the last chunk of speech
+        self.hangover = 0
+
+    @staticmethod
+    def energy(pcm: bytes):
+        """
+        Returns the energy of a chunk of audio
+        :param pcm: The 16-bit PCM samples of the chunk
+        :type pcm: bytes
+        :return: The energy in dBFS (0 is a full scale square wave)
+        :rtype: float
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        rms = np.sqrt(np.mean(samples * samples)) if samples.size else 0
+        return 20 * np.log10(max(rms, 1) / 32768)
+
+    def is_speech(self, pcm: bytes):
+        """
+        Checks whether a chunk of the mic's audio should be sent, and updates the estimate of the background noise
+        :param pcm: The 16-bit PCM samples of the chunk
+        :type pcm: bytes
+        :return: Whether the chunk is speech (or right after speech)
+        :rtype: bool
+        """
+        energy = self.energy(pcm)
+        # The noise estimate drops at once to quieter chunks, and rises slowly so speech doesn't become "noise"
+        if self.noise_db is None or energy < self.noise_db:
+            self.noise_db = energy
+        else:
+            self.noise_db += self.NOISE_RISE_DB
+
+        if energy > max(self.noise_db + self.MARGIN_DB, self.MIN_SPEECH_DB):
+            self.hangover = self.HANGOVER_CHUNKS
+            return True
+        if self.hangover:
+            self.hangover -= 1
+            return True
+        return False
+
+    def noise_level(self):
+        """
+        Returns the level of the background noise, which the other members play as comfort noise
+        :return: The RMS of the noise in 16-bit samples
+        :rtype: int
+        """
+        if self.noise_db is None:
+            return 0
+        return min(int(32768 * 10 ** (self.noise_db / 20)), 0xFFFF)
+
+
+def comfort_noise(level, samples):
+    """
+    Generates comfort noise, played instead of the audio of silent call members
+    :param level: The RMS of the noise in 16-bit samples
+    :type level: int
+    :param samples: The amount of samples
+    :type samples: int
+    :return: The 16-bit PCM samples of the noise
+    :rtype: bytes
+    """
+    noise = np.random.normal(0, level, samples)
+    return np.clip(noise, -32768, 32767).astype(np.int16).tobytes()
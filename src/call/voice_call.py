@@ -1,11 +1,18 @@
 import queue
 import socket
+import struct
 import threading
 import time
 import wx
 import wx.adv
 import pyaudio
-from src.core.cryptions import AESCipher
+from pubsub import pub
+from src.core.cryptions import CipherContext, negotiate_cipher
+from src.call.audio_codecs import CODECS_BY_ID, PCMCodec, codecs_mask, negotiate_codec
+from src.call.voice_activity import VoiceActivityDetector
+from src.call.audio_mixer import AudioMixer
+from src.call.ring_buffer import RingBuffer
+from src.call.latency_probe import LatencyProbe
 import config
 
 
@@ -18,7 +25,19 @@ class VoiceCall:
     CHANNELS = 1
     RATE = 44100
     CHUNK = 4096
+    BLOCK = 1024  # The amount of samples in every callback of the audio streams, less than a chunk to cut latency
+    CAPTURE_CHUNKS = 4  # The amount of chunks of the mic's audio buffered while the sending falls behind
     CALL_TIMEOUT = 3  # The amount of seconds to wait for a response from a call member
+    # The header of the audio packets: the codec of the packet, the mask of the codecs its sender can decode and the
+    # sequence number of the chunk (counting the chunks of silence which aren't sent).
+    # Packets of older clients are raw PCM without a header, exactly CHUNK * 2 bytes long.
+    AUDIO_HEADER = struct.Struct('!BBH')
+    # The codec id of the comfort noise markers, sent instead of the chunks of silence, with the level of the noise
+    COMFORT_NOISE_ID = 0xFF
+    COMFORT_NOISE = struct.Struct('!H')
+    # The amount of seconds between the comfort noise markers of a silent member, below CALL_TIMEOUT so the silent
+    # members stay in the call
+    COMFORT_NOISE_INTERVAL = 1
 
     def __init__(self, parent, chat_id, key):
         """
@@ -41,15 +60,45 @@ class VoiceCall:
 
         # A dict of the current call members ips as the keys and their users as the values
         self.call_members = {}
+        # The masks of the codecs the call members can decode by their ips, learned from their packets
+        self.members_codecs = {}
+        # The ips of the call members whose clients send (and only play) raw PCM without a header
+        self.legacy_members = set()
+        # The encoders of the codecs used in the call by their ids (the encoders keep state between chunks)
+        self.encoders = {}
+        self.codecs_mask = codecs_mask()
+        # The sequence number of the next chunk of the mic
+        self.seq = 0
+        # Detects the chunks of silence in the mic's audio, which aren't sent
+        self.vad = VoiceActivityDetector()
+        # The time the last comfort noise marker was sent, 0 while speaking
+        self.last_comfort_noise = 0
+        # The amount of bytes sent, and the amount of bytes raw PCM chunks would have taken
+        self.bytes_sent = 0
+        self.bytes_raw = 0
+        # The amount of chunks of the mic, and how many of them weren't sent as silence
+        self.chunks = 0
+        self.chunks_suppressed = 0
+
+        # Measures the latency of the mic's audio and counts the glitches of the audio streams
+        self.probe = LatencyProbe()
+        # The mic's audio waiting to be sent, between the mic's callback and the sending thread
+        self.capture = RingBuffer(self.CHUNK * self.CAPTURE_CHUNKS)
+        # The position in the capture buffer after the last captured sample, and when it was captured
+        self.last_capture = (0, time.perf_counter())
 
         # Audio object
         self.audio = pyaudio.PyAudio()
+        # Plays the audio of all the call members through one output stream
+        self.mixer = AudioMixer(self.audio, self.FORMAT, self.CHANNELS, self.RATE, self.CHUNK, self.BLOCK, self.probe)
 
         self.audio_input = None
         self._init_mic()
         
-        self.aes = AESCipher()
         self.key = key
+        # The cipher context of the call's key, every member of the call has to use the same cipher so it's
+        # renegotiated by the call window as the members join
+        self.cipher = CipherContext.get(key, negotiate_cipher([config.cipher]))
 
         self._start()
 
@@ -66,13 +115,28 @@ class VoiceCall:
         self.audio_input = None
         try:
             self.audio_input = self.audio.open(format=self.FORMAT, channels=self.CHANNELS, rate=self.RATE,
-                                               input=True, frames_per_buffer=self.CHUNK)
+                                               input=True, frames_per_buffer=self.BLOCK,
+                                               stream_callback=self._capture)
         except Exception:
             self.muted = True
             self.parent.onMuteToggle(None)
         else:
             self.muted = False
 
+    def _capture(self, in_data, frame_count, time_info, status):
+        """
+        The callback of the mic, buffers the captured audio for the sending thread
+        :return: Nothing to play, and whether to continue capturing
+        :rtype: tuple
+        """
+        if status & pyaudio.paInputOverflow:
+            self.probe.glitch('input_overflow')
+        if self.capture.write(in_data) < frame_count:
+            # The sending fell behind, the newest audio is dropped
+            self.probe.glitch('capture_overrun')
+        self.last_capture = (self.capture.write_pos, time.perf_counter())
+        return None, pyaudio.paContinue
+
     def _start(self):
         """
         Starts the call
@@ -87,11 +151,17 @@ class VoiceCall:
 
     def check_users(self):
         """
-        Checks if the users are still in the call, and removes the ones that aren't
+        Checks if the users are still in the call, and removes the ones that aren't.
+        Silent users send comfort noise markers every COMFORT_NOISE_INTERVAL seconds, which keep them in the call.
+        Publishes the statistics of the users' jitter buffers every check.
         """
         while self.active:
             # A copy of the call members dict
             call_members_copy = self.call_members.copy()
+            stats = {user.username: user.jitter_buffer.stats() for user in call_members_copy.values()
+                     if user.jitter_buffer}
+            wx.CallAfter(pub.sendMessage, 'voice_stats', chat_id=self.chat_id, stats=stats,
+                         probe={**self.probe.stats(), **self.bandwidth_stats()})
             # Check if the users are still in the call
             for ip, user in call_members_copy.items():
                 # If the user hasn't updated his last_audio_update in the last CALL_TIMEOUT seconds
@@ -108,25 +178,73 @@ class VoiceCall:
         """
         while self.active:
             if not self.muted:
-                try:
-                    data = self.audio_input.read(self.CHUNK)
-                except Exception:
-                    self._init_mic()
+                data = self.capture.read(self.CHUNK)
+                if data is None:
+                    # The mic stopped (e.g. it was disconnected), open it again
+                    if self.audio_input is None or not self.audio_input.is_active():
+                        self._init_mic()
+                    time.sleep(self.BLOCK / self.RATE / 2)
                     continue
+                is_speech = self.vad.is_speech(data)
             else:
-                # If the mic is muted, send silence
+                # If the mic is muted, send silence, paced like the mic
+                time.sleep(self.CHUNK / self.RATE)
+                # The audio captured while muted isn't sent after unmuting
+                self.capture.skip()
                 data = b'\x00' * self.CHUNK * 2
+                is_speech = False
 
-            # Encrypt the data using the call's symmetrical key
-            data = self.aes.encrypt_bytes(self.key, data)
+            seq = self.seq
+            self.seq = (self.seq + 1) & 0xFFFF
             # The ips to send to
             ips = list(self.call_members.keys())
+            self.chunks += 1
+            # An encrypted raw PCM chunk for every member, as older clients send
+            self.bytes_raw += (self.CHUNK * 2 + 32) * len(ips)
+            # Older clients play only raw PCM, and drop members who stop sending it
+            if not is_speech and not any(ip in self.legacy_members for ip in ips):
+                data = self.encode_silence(ips, seq)
+                if data is None:
+                    continue
+            else:
+                self.last_comfort_noise = 0
+                # Encode the chunk once with the codec of the call
+                data = self.encode_audio(data, ips, seq)
+
+            # Encrypt the data using the call's symmetrical key
+            data = self.cipher.encrypt_bytes(data)
             # send the data to the ips
             for ip in ips:
                 try:
                     self.socket.sendto(data, (ip, self.port))
                 except Exception:
                     break
+                self.bytes_sent += len(data)
+
+            if not self.muted:
+                # The time since the chunk's last sample was captured, the samples captured after it took
+                # (position - read_pos) / RATE seconds
+                position, captured = self.last_capture
+                self.probe.record_latency(time.perf_counter() - captured
+                                          + (position - self.capture.read_pos) / self.RATE)
+
+    def encode_silence(self, ips, seq):
+        """
+        Returns the comfort noise marker to send instead of a chunk of silence, if it's time to send one
+        :param ips: The ips of the call members the marker is sent to
+        :type ips: list
+        :param seq: The sequence number of the chunk
+        :type seq: int
+        :return: The marker packet, None if the chunk is skipped
+        :rtype: bytes
+        """
+        self.chunks_suppressed += 1
+        if time.time() - self.last_comfort_noise < self.COMFORT_NOISE_INTERVAL:
+            return None
+
+        self.last_comfort_noise = time.time()
+        level = 0 if self.muted else self.vad.noise_level()
+        return self.AUDIO_HEADER.pack(self.COMFORT_NOISE_ID, self.codecs_mask, seq) + self.COMFORT_NOISE.pack(level)
 
     def receive_audio(self):
         """
@@ -134,12 +252,16 @@ class VoiceCall:
         """
         while self.active:
             try:
-                data, addr = self.socket.recvfrom(self.CHUNK*2 + 32)
+                data, addr = self.socket.recvfrom(self.CHUNK*2 + self.AUDIO_HEADER.size + 32)
             except Exception as e:
                 continue
 
-            # Decrypt the data using the call's symmetrical key
-            data = self.aes.decrypt_bytes(self.key, data)
+            try:
+                # Decrypt the data using the call's symmetrical key
+                data = self.cipher.decrypt_bytes(data)
+            except ValueError:
+                # A corrupt or forged packet (or one of another call)
+                continue
 
             ip = addr[0]
 
@@ -150,8 +272,77 @@ class VoiceCall:
                 else:
                     continue
 
-            # Update the user's audio
-            self.call_members[ip].update_audio(data)
+            try:
+                packet = self.decode_audio(ip, data)
+            except (ValueError, struct.error):
+                # A truncated header or comfort noise marker, or an audio frame its codec can't decode
+                continue
+            if packet is not None:
+                # Update the user's audio, which is buffered until the user's output plays it
+                self.call_members[ip].update_audio(*packet)
+
+    def encode_audio(self, pcm, ips, seq):
+        """
+        Encodes a chunk of the mic's audio with the best codec every call member can decode
+        :param pcm: The 16-bit PCM samples of the chunk
+        :type pcm: bytes
+        :param ips: The ips of the call members the chunk is sent to
+        :type ips: list
+        :param seq: The sequence number of the chunk
+        :type seq: int
+        :return: The audio packet
+        :rtype: bytes
+        """
+        # Older clients play whatever they receive as raw PCM
+        if any(ip in self.legacy_members for ip in ips):
+            return pcm
+
+        # Members which haven't sent audio yet get PCM until their codecs are known
+        masks = [self.members_codecs.get(ip, 1 << PCMCodec.ID) for ip in ips]
+        codec = negotiate_codec(masks, config.audio_codec)
+        encoder = self.encoders.get(codec.ID)
+        if encoder is None:
+            encoder = self.encoders[codec.ID] = codec()
+        return self.AUDIO_HEADER.pack(codec.ID, self.codecs_mask, seq) + encoder.encode(pcm)
+
+    def decode_audio(self, ip, data):
+        """
+        Decodes an audio packet of a call member, and records the codecs the member can decode
+        :param ip: The ip of the call member
+        :type ip: str
+        :param data: The decrypted audio packet
+        :type data: bytes
+        :return: The sequence number of the packet (None for older clients), its 16-bit PCM samples (None for comfort
+        noise markers) and the level of its comfort noise, None for unknown codecs
+        :rtype: tuple
+        :raises ValueError: If the packet is truncated or its audio can't be decoded into a whole chunk
+        """
+        if len(data) == self.CHUNK * 2:
+            self.legacy_members.add(ip)
+            return None, data, None
+
+        codec_id, self.members_codecs[ip], seq = self.AUDIO_HEADER.unpack_from(data)
+        self.legacy_members.discard(ip)
+        if codec_id == self.COMFORT_NOISE_ID:
+            level, = self.COMFORT_NOISE.unpack_from(data, self.AUDIO_HEADER.size)
+            return seq, None, level
+
+        codec = CODECS_BY_ID.get(codec_id)
+        if codec is None:
+            return None
+        pcm = codec.decode(data[self.AUDIO_HEADER.size:])
+        # The mixer adds up whole chunks
+        if len(pcm) != self.CHUNK * 2:
+            raise ValueError(f'Audio frame of {len(pcm)} bytes')
+        return seq, pcm, None
+
+    def set_cipher(self, cipher):
+        """
+        Switches the call to the cipher negotiated with the call members
+        :param cipher: The cipher of the call (AESCipher or AEADCipher)
+        :type cipher: type
+        """
+        self.cipher = CipherContext.get(self.key, cipher)
 
     def add_user(self, ip, user):
         """
@@ -163,8 +354,9 @@ class VoiceCall:
         # Initiate the user's last_audio_update
         user.last_audio_update = time.time()
 
-        # Open the user audio
+        # Open the user audio, and mix it into the call's output
         user.open_audio()
+        self.mixer.add_user(user)
 
         join_sound = wx.GetApp().GetTopWindow().main_panel.call_join_sound
         # Play the sound
@@ -176,9 +368,12 @@ class VoiceCall:
         """
         if ip in self.call_members.keys():
             # Close the user's audio
+            self.mixer.remove_user(self.call_members[ip])
             self.call_members[ip].close_audio()
             # Remove the user from the call
             del self.call_members[ip]
+            self.members_codecs.pop(ip, None)
+            self.legacy_members.discard(ip)
             # Create a sound object
             leave_sound = wx.GetApp().GetTopWindow().main_panel.call_leave_sound
             # Play the sound
@@ -194,14 +389,32 @@ class VoiceCall:
         else:
             self.muted = not self.muted
 
+    def bandwidth_stats(self):
+        """
+        Returns the bandwidth of this user's audio
+        :return: The kilobytes sent, the kilobytes raw PCM chunks would have taken, the percents saved by the codec
+        and the silence suppression, and the amounts of chunks of the mic and of chunks suppressed as silence
+        :rtype: dict
+        """
+        return {'sent_kb': round(self.bytes_sent / 1024), 'raw_kb': round(self.bytes_raw / 1024),
+                'saved_percent': round((1 - self.bytes_sent / self.bytes_raw) * 100) if self.bytes_raw else 0,
+                'chunks': self.chunks, 'chunks_suppressed': self.chunks_suppressed}
+
     def terminate(self):
         """
         Terminates the call
+        :return: The latency, the glitches and the bandwidth of this user's audio in the call, as published in
+        voice_stats
+        :rtype: dict
         """
         self.active = False
         if self.audio_input:
             self.audio_input.close()
+        self.mixer.close()
+        # The call's key isn't used after the call (a video call of the same call keeps its own context)
+        CipherContext.evict(self.key)
         for user in self.call_members.values():
             user.close_audio()
 
         self.socket.close()
+        return {**self.probe.stats(), **self.bandwidth_stats()}
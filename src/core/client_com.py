@@ -1,8 +1,14 @@
+import asyncio
 import base64
+import os
+import select
 import socket
+import struct
 import threading
+import time
 import queue
-from src.core.cryptions import RSACipher, AESCipher
+from collections import deque
+from src.core.cryptions import RSACipher, AESCipher, CIPHERS
 from pubsub import pub
 import wx
 
@@ -11,8 +17,42 @@ class ClientCom:
     """
     Represents a TCP based communication class
     """
+    # The framing modes of the messages on the wire
+    TEXT_FRAMING = 'text'
+    BINARY_FRAMING = 'binary'
 
-    def __init__(self, server_port: int, server_ip: str, message_queue: queue.Queue, com_type='general'):
+    # Binary framing header: the length of the payload and the channel id
+    BINARY_HEADER = struct.Struct('!IB')
+    CHANNEL_IDS = {'general': 0, 'chats': 1, 'files': 2}
+    # The streams whose messages are delivered as bytes, so file contents are never decoded into a str
+    BYTES_CHANNELS = (CHANNEL_IDS['files'],)
+
+    # The offer sent (in the text framing) to ask the server to switch to the binary framing,
+    # followed by the name of the cipher when it isn't the default CBC cipher
+    FRAMING_OFFER = 'binary_framing'
+    # The amount of seconds to wait for the first byte of the server's answer to an offer
+    FRAMING_TIMEOUT = 2
+    # The (ip, port, offer) of the offers which servers didn't answer in time, which aren't offered to them again
+    unanswered_offers = set()
+
+    # The offer sent (in the binary framing) to ask the server to carry the other channels on this connection
+    MULTIPLEX_OFFER = 'multiplexed'
+    # The maximum amount of frames waiting to be sent on every stream before senders have to wait
+    MAX_OUTBOUND_FRAMES = 16
+    # The maximum amount of bytes the writer sends to the socket at once
+    MAX_BATCH_SIZE = 256 * 1024
+    # The largest frame accepted from the server, a larger length in a header means the stream is corrupt
+    MAX_FRAME_SIZE = 32 * 1024 * 1024
+    # The largest receive buffer kept between frames, the buffer of a larger frame is dropped after it
+    MAX_RECV_BUFFER = 256 * 1024
+    # The maximum amount of frames the writer sends to the socket at once, sendmsg fails with more buffers
+    # than the system allows
+    MAX_BATCH_FRAMES = 1024
+    if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names and os.sysconf('SC_IOV_MAX') > 0:
+        MAX_BATCH_FRAMES = os.sysconf('SC_IOV_MAX')
+
+    def __init__(self, server_port: int, server_ip: str, message_queue: queue.Queue, com_type='general',
+                 framing=TEXT_FRAMING, cipher='cbc', key_pool=None, streams=None):
         """
         Initializes the client communication object.
 
@@ -24,32 +64,80 @@ class ClientCom:
         :type message_queue: queue.Queue
         :param com_type: The type of communication (e.g. 'general' or 'files').
         :type com_type: str
+        :param framing: The preferred framing mode, the binary framing is used only if the server accepts it
+        :type framing: str
+        :param cipher: The preferred cipher of the binary framing (a key of CIPHERS)
+        :type cipher: str
+        :param key_pool: A pool of pre-generated RSA keys, a key is generated on connection if not given
+        :type key_pool: RSAKeyPool
+        :param streams: The queues of the other channels to carry on this connection if the server supports it,
+                        by their com type (requires the binary framing)
+        :type streams: dict
         """
         self.CHUNK_SIZE = 1024
+        # The length of the size header of every frame on this channel
+        self.SIZE_LENGTH = 10 if com_type == 'files' else 4
         self.server_port = server_port
         self.server_ip = server_ip
         self.message_queue = message_queue
-        self.socket = socket.socket()
+        self.socket = None
         self.com_type = com_type
+        self.channel_id = ClientCom.CHANNEL_IDS.get(com_type, 0)
+
+        # The framing the client asks for, and the framing actually used with the server
+        self.preferred_framing = framing
+        self.framing = ClientCom.TEXT_FRAMING
+        # The cipher the client asks for, and the cipher actually used in the binary framing
+        self.preferred_cipher = cipher
+        self.cipher = AESCipher
 
         self.server_key = None
-        self.rsa = RSACipher()
+        self.key_pool = key_pool
+        self.rsa = None
         self.aes_key = None
+        # The amount of seconds every step of the last connection took, see handshake_metrics
+        self.handshake_times = {}
 
         self.INVALID_TYPE_EXCEPTION = Exception('Invalid data type')
 
         self.running = False
 
-        # Start the main thread
-        self.main_thread = threading.Thread(target=self._main_loop, name=f'client_com_{com_type}_thread')
+        # The queues of the streams carried on this connection by their channel id
+        self.streams = {ClientCom.CHANNEL_IDS[stream_type]: stream_queue
+                        for stream_type, stream_queue in (streams or {}).items()}
+        self.multiplexed = False
+        # The frames waiting to be sent by the writer on every stream, by channel id
+        self._outbound = {}
+        self._outbound_condition = threading.Condition()
+        # Counters of the writer, see send_metrics
+        self._send_stats = {'frames': 0, 'bytes': 0, 'batches': 0, 'max_depth': 0, 'blocked_seconds': 0.0}
+        # Set once the handshake with the server is over, whether it succeeded or not
+        self.handshake_done = threading.Event()
+        # The thread sending the frames of the current connection
+        self.writer_thread = None
+
+        # A reusable buffer for receiving frames from the socket
+        self._recv_buffer = bytearray(self.CHUNK_SIZE)
+
+        self._start()
+
+    def _start(self):
+        """
+        Starts connecting to the server in the main thread
+        :return: -
+        """
+        self.socket = socket.socket()
+        self.main_thread = threading.Thread(target=self._main_loop, name=f'client_com_{self.com_type}_thread')
         self.main_thread.start()
 
-    def send_data(self, data):
+    def send_data(self, data, channel_id=None):
         """
         Sends data to the server.
 
         :param data: The data to send.
         :type data: str or bytes
+        :param channel_id: The stream to send the data on, the channel of this connection if not given
+        :type channel_id: int
         """
         # Check if the client com is running
         if not self.running:
@@ -58,36 +146,249 @@ class ClientCom:
             return
 
         # Encode the data if needed
-        if type(data) == bytes:
-            try:
-                data = data.encode()
-            except Exception:
-                raise self.INVALID_TYPE_EXCEPTION
+        if type(data) == str:
+            data = data.encode()
+        elif type(data) != bytes:
+            raise self.INVALID_TYPE_EXCEPTION
 
-        try:
-            enc_data = AESCipher.encrypt(self.aes_key, data).encode()
-
-            # send data length
-            str_len = str(len(enc_data)).zfill(10) if self.com_type == 'files' else\
-                str(len(enc_data)).zfill(4)
+        if channel_id is None:
+            channel_id = self.channel_id
 
-            self.socket.send(str_len.encode())
+        try:
+            if self.framing == ClientCom.BINARY_FRAMING:
+                frame = ClientCom._binary_frame(self.aes_key, data, channel_id, self.cipher)
+            else:
+                frame = ClientCom._text_frame(self.aes_key, data, self.SIZE_LENGTH)
 
-            # Send the data
-            self.socket.send(enc_data)
+            self._send_frame(channel_id, frame)
         except Exception:
             wx.CallAfter(pub.sendMessage, 'server_connection_lost')
             self.close()
 
+    def _send_frame(self, channel_id, frame):
+        """
+        Queues a frame for the writer thread. Background threads (e.g. a file upload) wait while their stream is full,
+        the GUI thread never waits so a slow link can't freeze the UI. The GUI thread only sends what the user does
+        (messages, requests), so the frames it adds past MAX_OUTBOUND_FRAMES stay few, and the bulk senders behind
+        them wait until the stream is drained below the limit again.
+        :param channel_id: The stream of the frame
+        :type channel_id: int
+        :param frame: The frame to send
+        :type frame: bytes
+        """
+        self._enqueue_frame(channel_id, frame, wait=not wx.IsMainThread())
+
+    def _deliver(self, channel_id, message):
+        """
+        Puts a received message in the message queue of its stream
+        :param channel_id: The stream the message arrived on
+        :type channel_id: int
+        :param message: The decrypted message
+        :type message: str
+        """
+        self.streams.get(channel_id, self.message_queue).put(message)
+
+    def stream(self, com_type, server_port):
+        """
+        Returns a channel carried on this multiplexed connection
+        :param com_type: The type of the channel (e.g. 'chats' or 'files')
+        :type com_type: str
+        :param server_port: The port of the channel's own connection, used if the server stops multiplexing it
+        :type server_port: int
+        :return: The channel, which can be used like a ClientCom of its own
+        :rtype: StreamCom
+        """
+        channel_id = ClientCom.CHANNEL_IDS[com_type]
+        return StreamCom(self, com_type, channel_id, self.streams[channel_id], server_port)
+
+    def channel_com(self, com_type, server_port):
+        """
+        Connects a channel of this connection on a connection of its own, with the same settings
+        :param com_type: The type of the channel (e.g. 'chats' or 'files')
+        :type com_type: str
+        :param server_port: The port of the channel on the server
+        :type server_port: int
+        :return: The connection of the channel, which puts the received messages in the queue of its stream
+        :rtype: ClientCom
+        """
+        return type(self)(server_port, self.server_ip, self.streams[ClientCom.CHANNEL_IDS[com_type]],
+                          com_type=com_type, framing=self.preferred_framing, cipher=self.preferred_cipher,
+                          key_pool=self.key_pool, **self._com_options())
+
+    def _com_options(self):
+        """
+        :return: The options of this class's constructor, besides the ones of every ClientCom
+        :rtype: dict
+        """
+        return {}
+
+    def _enqueue_frame(self, channel_id, frame, wait=True):
+        """
+        Queues a frame to be sent by the writer
+        :param channel_id: The stream of the frame
+        :type channel_id: int
+        :param frame: The frame to send
+        :type frame: bytes
+        :param wait: Whether to wait while the stream already has too many frames waiting
+        :type wait: bool
+        """
+        with self._outbound_condition:
+            outbound = self._outbound.setdefault(channel_id, deque())
+            if wait and self.running and len(outbound) >= ClientCom.MAX_OUTBOUND_FRAMES:
+                wait_time = time.perf_counter()
+                while self.running and len(outbound) >= ClientCom.MAX_OUTBOUND_FRAMES:
+                    self._outbound_condition.wait()
+                self._send_stats['blocked_seconds'] += time.perf_counter() - wait_time
+
+            outbound.append(frame)
+            self._send_stats['max_depth'] = max(self._send_stats['max_depth'], len(outbound))
+            self._outbound_condition.notify_all()
+
+    def _take_frames(self):
+        """
+        Takes the next batch of queued frames, one frame of every stream in turn
+        so a large file transfer can't hold back the chat messages
+        :return: The frames to send
+        :rtype: list
+        """
+        frames = []
+        batch_size = 0
+        with self._outbound_condition:
+            while (batch_size < ClientCom.MAX_BATCH_SIZE and len(frames) < ClientCom.MAX_BATCH_FRAMES and
+                   any(self._outbound.values())):
+                for outbound in self._outbound.values():
+                    if outbound and len(frames) < ClientCom.MAX_BATCH_FRAMES:
+                        frames.append(outbound.popleft())
+                        batch_size += len(frames[-1])
+
+            if frames:
+                self._send_stats['frames'] += len(frames)
+                self._send_stats['bytes'] += batch_size
+                self._send_stats['batches'] += 1
+            # Wake the senders waiting for room in their stream
+            self._outbound_condition.notify_all()
+
+        return frames
+
+    def _writer_loop(self):
+        """
+        Sends the queued frames to the server, coalescing the frames waiting together into a single call
+        :return: -
+        """
+        while self.running:
+            with self._outbound_condition:
+                while self.running and not any(self._outbound.values()):
+                    self._outbound_condition.wait()
+
+            try:
+                self._send_frames(self._take_frames())
+            except Exception:
+                if self.running:
+                    wx.CallAfter(pub.sendMessage, 'server_connection_lost')
+                    self.close()
+
+    def _send_frames(self, frames):
+        """
+        Sends frames to the server with as few calls as possible, handling partial sends
+        :param frames: The frames to send
+        :type frames: list
+        """
+        # Windows sockets have no sendmsg, so the frames are joined instead
+        if not hasattr(self.socket, 'sendmsg'):
+            self.socket.sendall(b''.join(frames))
+            return
+
+        views = [memoryview(frame) for frame in frames]
+        # The first frame which wasn't sent completely
+        first = 0
+        while first < len(views):
+            sent = self.socket.sendmsg(views[first:] if first else views)
+            # Skip the frames which were sent completely, and the sent part of a partially sent frame
+            while first < len(views) and sent >= len(views[first]):
+                sent -= len(views[first])
+                first += 1
+            if sent:
+                views[first] = views[first][sent:]
+
+    def outbound_depth(self):
+        """
+        :return: The amount of frames waiting to be sent on every stream, by channel id
+        :rtype: dict
+        """
+        with self._outbound_condition:
+            return {channel_id: len(outbound) for channel_id, outbound in self._outbound.items()}
+
+    def send_metrics(self):
+        """
+        Returns the metrics of the writer: the amount of frames, bytes and socket calls (batches) sent,
+        the deepest a stream's queue got, the seconds senders waited for room and the current queue depths
+        :return: The metrics
+        :rtype: dict
+        """
+        with self._outbound_condition:
+            metrics = dict(self._send_stats)
+        metrics['depth'] = self.outbound_depth()
+        return metrics
+
+    def handshake_metrics(self):
+        """
+        Returns the amount of milliseconds every step of the last connection's handshake took (getting the RSA key,
+        connecting, switching keys, negotiating the framing and the multiplexing) and the whole handshake
+        :return: The metrics
+        :rtype: dict
+        """
+        return {step: round(seconds * 1000) for step, seconds in self.handshake_times.items()}
+
+    @staticmethod
+    def _text_frame(aes_key, data: bytes, size_length: int):
+        """
+        Constructs a frame in the text framing: a zero padded ascii length and the base64 encrypted data
+        :param aes_key: The key to encrypt the data with
+        :type aes_key: str
+        :param data: The data of the frame
+        :type data: bytes
+        :param size_length: The amount of digits in the length header
+        :type size_length: int
+        :return: The frame
+        :rtype: bytes
+        """
+        enc_data = base64.b64encode(AESCipher.encrypt_bytes(aes_key, data))
+        return str(len(enc_data)).zfill(size_length).encode() + enc_data
+
+    @staticmethod
+    def _binary_frame(aes_key, data: bytes, channel_id: int, cipher=AESCipher):
+        """
+        Constructs a frame in the binary framing: a packed length and channel id, and the raw iv and ciphertext
+        :param aes_key: The key to encrypt the data with
+        :type aes_key: str
+        :param data: The data of the frame
+        :type data: bytes
+        :param channel_id: The id of the channel the frame belongs to
+        :type channel_id: int
+        :param cipher: The cipher to encrypt the data with
+        :type cipher: type
+        :return: The frame
+        :rtype: bytes
+        """
+        enc_data = cipher.encrypt_bytes(aes_key, data)
+        return ClientCom.BINARY_HEADER.pack(len(enc_data), channel_id) + enc_data
+
     def _main_loop(self):
         """
         The main loop which receives data from the server and puts it in a queue
         :return: -
         """
 
+        start_time = time.perf_counter()
+        # Get the RSA key of the key exchange
+        self.rsa = self.key_pool.get() if self.key_pool else RSACipher()
+        self.handshake_times = {'rsa_key': time.perf_counter() - start_time}
+
         # Try to connect to the server
         try:
+            step_time = time.perf_counter()
             self.socket.connect((self.server_ip, self.server_port))
+            self.handshake_times['connect'] = time.perf_counter() - step_time
 
         except Exception:
             # Check if there is a wx app running
@@ -99,7 +400,9 @@ class ClientCom:
 
         # Change keys with server
         try:
+            step_time = time.perf_counter()
             self.switch_keys()  # Switch encryption keys with server
+            self.handshake_times['switch_keys'] = time.perf_counter() - step_time
 
         except Exception as e:
             # Check if there is a wx app running
@@ -109,7 +412,37 @@ class ClientCom:
                 self.close()
                 return
 
+        # Ask the server for the binary framing if it is preferred
+        if self.preferred_framing == ClientCom.BINARY_FRAMING:
+            try:
+                step_time = time.perf_counter()
+                self._negotiate_framing()
+                self.handshake_times['framing'] = time.perf_counter() - step_time
+            except Exception:
+                if wx.GetApp():
+                    wx.CallAfter(pub.sendMessage, 'server_connection_lost')
+                    self.close()
+                    return
+
+        # Ask the server to carry the other channels on this connection
+        if self.streams and self.framing == ClientCom.BINARY_FRAMING:
+            try:
+                step_time = time.perf_counter()
+                self._negotiate_multiplexing()
+                self.handshake_times['multiplexing'] = time.perf_counter() - step_time
+            except Exception:
+                if wx.GetApp():
+                    wx.CallAfter(pub.sendMessage, 'server_connection_lost')
+                    self.close()
+                    return
+
+        self.handshake_times['total'] = time.perf_counter() - start_time
+
         self.running = True
+        self.handshake_done.set()
+        self.writer_thread = threading.Thread(target=self._writer_loop, name=f'client_com_{self.com_type}_writer_thread')
+        self.writer_thread.start()
+
         # Check if there is a wx app running
         if wx.GetApp():
             # Send a message to the main frame that the connection was established
@@ -118,18 +451,7 @@ class ClientCom:
         # Run while the client_com object is running
         while self.running:
             try:
-                if self.com_type == 'files':
-                    size_length = 10
-                else:
-                    size_length = 4
-
-                # Receive the size of the data and convert it to an int
-                size = int(self.socket.recv(size_length).decode())
-                # Receive the data
-                if self.com_type == 'files':
-                    data = self.receive_file(size)  # Receive file data
-                else:
-                    data = self.socket.recv(size)
+                channel_id, data = self._receive_frame()
 
             # Invalid size exception
             except ValueError:
@@ -139,36 +461,191 @@ class ClientCom:
                 self.running = False
             else:
                 try:
-                    dec_data = AESCipher.decrypt(self.aes_key, data.decode())
+                    dec_data = self._decrypt_frame(data, channel_id)
                 except Exception:
                     pass
                 else:
-                    # Put the received data inside the message queue
-                    self.message_queue.put(dec_data)
+                    # Put the received data inside the message queue of its stream
+                    self._deliver(channel_id, dec_data)
+
+        # Wake the writer thread so it stops with the connection
+        with self._outbound_condition:
+            self._outbound_condition.notify_all()
+
+    def _negotiate_framing(self):
+        """
+        Offers the binary framing to the server, and switches to it if the server accepts.
+        Servers which don't answer in time keep the text framing, and aren't offered it again.
+        :return: -
+        """
+        offer = self._framing_offer()
+        if (self.server_ip, self.server_port, offer) in ClientCom.unanswered_offers:
+            return
+        self.socket.sendall(ClientCom._text_frame(self.aes_key, offer.encode(), self.SIZE_LENGTH))
+
+        answer = None
+        if self._wait_for_answer(offer):
+            answer = self._decrypt_frame(self._receive_frame()[1])
+
+        self._accept_framing(offer, answer)
+
+    def _wait_for_answer(self, offer):
+        """
+        Waits for the first byte of the server's answer to an offer. Only the first byte is waited for with a timeout,
+        the rest of the frame is received as usual so the stream never loses its place in a frame.
+        :param offer: The offer, remembered if the server doesn't answer it
+        :type offer: str
+        :return: Whether the server answered in time
+        :rtype: bool
+        """
+        readable, _, _ = select.select([self.socket], [], [], ClientCom.FRAMING_TIMEOUT)
+        if not readable:
+            ClientCom.unanswered_offers.add((self.server_ip, self.server_port, offer))
+        return bool(readable)
+
+    def _framing_offer(self):
+        """
+        :return: The offer of the binary framing with the preferred cipher
+        :rtype: str
+        """
+        if self.preferred_cipher != 'cbc':
+            return f'{ClientCom.FRAMING_OFFER}_{self.preferred_cipher}'
+        return ClientCom.FRAMING_OFFER
+
+    def _accept_framing(self, offer, answer):
+        """
+        Switches to the framing and the cipher the server answered with
+        :param offer: The offer sent to the server
+        :type offer: str
+        :param answer: The answer of the server, None if it didn't answer in time
+        :type answer: str
+        :return: -
+        """
+        if answer == offer:
+            self.framing = ClientCom.BINARY_FRAMING
+            self.cipher = CIPHERS[self.preferred_cipher]
+        elif answer == ClientCom.FRAMING_OFFER:
+            # The server accepted the binary framing but not the cipher
+            self.framing = ClientCom.BINARY_FRAMING
+        elif answer is not None:
+            # A regular message which arrived before the server answered
+            self._deliver(self.channel_id, answer)
+
+    def _negotiate_multiplexing(self):
+        """
+        Offers the server to carry the other channels on this connection, as streams identified by the channel id
+        of every frame. Servers which don't answer in time keep the channels on their own connections, and aren't
+        offered it again.
+        :return: -
+        """
+        if (self.server_ip, self.server_port, ClientCom.MULTIPLEX_OFFER) in ClientCom.unanswered_offers:
+            return
+        self.socket.sendall(ClientCom._binary_frame(self.aes_key, ClientCom.MULTIPLEX_OFFER.encode(),
+                                                    self.channel_id, self.cipher))
+
+        channel_id, answer = self.channel_id, None
+        if self._wait_for_answer(ClientCom.MULTIPLEX_OFFER):
+            channel_id, data = self._receive_frame()
+            answer = self._decrypt_frame(data)
+
+        self._accept_multiplexing(channel_id, answer)
+
+    def _accept_multiplexing(self, channel_id, answer):
+        """
+        Carries the streams on this connection if the server accepted the offer
+        :param channel_id: The stream the answer arrived on
+        :type channel_id: int
+        :param answer: The answer of the server, None if it didn't answer in time
+        :type answer: str
+        :return: -
+        """
+        if answer == ClientCom.MULTIPLEX_OFFER:
+            self.multiplexed = True
+            self._outbound = {}
+        elif answer is not None:
+            # A regular message which arrived before the server answered
+            self._deliver(channel_id, answer)
+
+    def _receive_frame(self):
+        """
+        Receives a single frame from the server according to the current framing
+        :return: The channel id and the encrypted payload of the frame
+        :rtype: tuple
+        """
+        if self.framing == ClientCom.BINARY_FRAMING:
+            size, channel_id = ClientCom.BINARY_HEADER.unpack(self._recv_exact(ClientCom.BINARY_HEADER.size))
+            # The payload is decrypted straight out of the receive buffer, before the next frame is received
+            return channel_id, self._recv_exact(size, copy=False)
+
+        # Receive the size of the data and convert it to an int
+        size = int(self._recv_exact(self.SIZE_LENGTH).decode())
+
+        # Receive the data
+        return self.channel_id, self._recv_exact(size)
+
+    def _decrypt_frame(self, data, channel_id=None):
+        """
+        Decrypts the payload of a frame according to the current framing
+        :param data: The encrypted payload
+        :type data: bytes or memoryview
+        :param channel_id: The stream of the frame, the messages of the bytes channels aren't decoded
+        :type channel_id: int
+        :return: The decrypted message
+        :rtype: str or bytes
+        """
+        if self.framing == ClientCom.BINARY_FRAMING:
+            message = self.cipher.decrypt_bytes(self.aes_key, data)
+        else:
+            message = AESCipher.decrypt_bytes(self.aes_key, base64.b64decode(data))
+
+        if channel_id in ClientCom.BYTES_CHANNELS:
+            return message
+        return message.decode()
+
+    def _recv_exact(self, size, copy=True):
+        """
+        Receives exactly the given amount of bytes from the server, looping over short reads
+        :param size: The amount of bytes to receive
+        :type size: int
+        :param copy: Whether to copy the data out of the receive buffer,
+                     otherwise it's only valid until the next receive
+        :type copy: bool
+        :return: The received data
+        :rtype: bytes or memoryview
+        """
+        if size > ClientCom.MAX_FRAME_SIZE:
+            raise ValueError(f'Frame of {size} bytes is too large')
+        # Grow the reusable buffer if the frame doesn't fit in it, and shrink it back after a large frame
+        if len(self._recv_buffer) < size:
+            self._recv_buffer = bytearray(size)
+        elif len(self._recv_buffer) > ClientCom.MAX_RECV_BUFFER >= size:
+            self._recv_buffer = bytearray(ClientCom.MAX_RECV_BUFFER)
+
+        bytes_received = 0
+        with memoryview(self._recv_buffer) as view:
+            while bytes_received < size:
+                received = self.socket.recv_into(view[bytes_received:size], size - bytes_received)
+
+                if not received:
+                    raise socket.error('Socket connection broken')
+
+                bytes_received += received
+
+            if copy:
+                return bytes(view[:size])
+        return memoryview(self._recv_buffer)[:size]
 
     def receive_file(self, file_size, chunk_size=1024):
         """
         Receives file data from the server
         :param file_size: The size of the file to receive
         :type file_size: int
-        :param chunk_size: The size of each chunk of data to receive
+        :param chunk_size: The size of each chunk of data to receive (kept for compatibility)
         :type chunk_size: int
         :return: The received file data
         :rtype: bytes
         """
-        data = b''
-        bytes_received = 0
-
-        while bytes_received < file_size:
-            chunk = self.socket.recv(min(chunk_size, file_size - bytes_received))
-
-            if not chunk:
-                raise Exception('Socket connection broken')
-
-            data += chunk
-            bytes_received += len(chunk)
-
-        return data
+        return self._recv_exact(file_size)
 
     def switch_keys(self):
         """
@@ -179,7 +656,7 @@ class ClientCom:
         key = self.socket.recv(1024).decode()  # Receive server's public key
         self.server_key = key
         self.socket.send(self.rsa.get_string_public_key().encode())  # Send client's public key
-        aes_key_enc = self.socket.recv(256)  # Receive encrypted AES key
+        aes_key_enc = self._recv_exact(256)  # Receive encrypted AES key
         self.aes_key = self.rsa.decrypt(aes_key_enc).decode()  # Decrypt AES key
 
     def close(self):
@@ -190,6 +667,11 @@ class ClientCom:
         """
         self.running = False
         self.socket = None  # Close socket connection
+        self.handshake_done.set()
+
+        # Wake the writer thread and the senders waiting for it
+        with self._outbound_condition:
+            self._outbound_condition.notify_all()
 
     def reconnect(self):
         """
@@ -199,12 +681,430 @@ class ClientCom:
         """
         # Close the socket connection and reset the variables
         self.running = False
-        self.socket.close()
+        self._disconnect()
         self.server_key = None
-        self.rsa = RSACipher()
+        self.rsa = None
         self.aes_key = None
-        self.socket = socket.socket()
+        self.framing = ClientCom.TEXT_FRAMING
+        self.cipher = AESCipher
+        self.multiplexed = False
+        self.handshake_done.clear()
+        with self._outbound_condition:
+            # Frames encrypted with the key of the old connection can't be sent on the new one
+            self._outbound = {}
+            self._outbound_condition.notify_all()
 
-        # Start the main thread
-        self.main_thread = threading.Thread(target=self._main_loop)
-        self.main_thread.start()
+        # The writer of the old connection would take the frames of the new one
+        if self.writer_thread and self.writer_thread is not threading.current_thread():
+            self.writer_thread.join()
+        self.writer_thread = None
+
+        self._start()
+
+    def _disconnect(self):
+        """
+        Closes the connection to the server
+        :return: -
+        """
+        if self.socket is None:
+            return
+        try:
+            # Wakes the threads blocked on the socket (e.g. the writer in the middle of a send)
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class StreamCom:
+    """
+    Represents a channel carried on a multiplexed ClientCom, which is used like a ClientCom of its own
+    """
+
+    def __init__(self, client_com: ClientCom, com_type: str, channel_id: int, message_queue: queue.Queue,
+                 server_port: int):
+        """
+        Initializes the stream
+        :param client_com: The multiplexed connection carrying the stream
+        :type client_com: ClientCom
+        :param com_type: The type of the channel (e.g. 'chats' or 'files')
+        :type com_type: str
+        :param channel_id: The id of the stream on the connection
+        :type channel_id: int
+        :param message_queue: The queue the received messages of the stream are put in
+        :type message_queue: queue.Queue
+        :param server_port: The port of the channel's own connection, used if the server stops multiplexing it
+        :type server_port: int
+        """
+        self.client_com = client_com
+        self.com_type = com_type
+        self.channel_id = channel_id
+        self.message_queue = message_queue
+        self.server_port = server_port
+        # The channel's own connection, while the server doesn't multiplex the connection carrying the stream
+        self.own_com = None
+
+    @property
+    def running(self):
+        if self.own_com:
+            return self.own_com.running
+        return self.client_com.running
+
+    def send_data(self, data):
+        """
+        Sends data to the server on the stream
+        :param data: The data to send
+        :type data: str or bytes
+        """
+        if self.own_com:
+            self.own_com.send_data(data)
+        else:
+            self.client_com.send_data(data, self.channel_id)
+
+    def close(self):
+        """
+        Closes the connection carrying the stream
+        :return: -
+        """
+        if self.own_com:
+            self.own_com.close()
+        self.client_com.close()
+
+    def reconnect(self):
+        """
+        Waits for the connection carrying the stream to reconnect, which must have started reconnecting already,
+        and moves the channel to a connection of its own if the server doesn't multiplex the new connection
+        :return: -
+        """
+        self.client_com.handshake_done.wait()
+        if self.client_com.multiplexed:
+            if self.own_com:
+                self.own_com.close()
+                self.own_com = None
+        elif self.own_com:
+            self.own_com.reconnect()
+        else:
+            self.own_com = self.client_com.channel_com(self.com_type, self.server_port)
+
+
+class AsyncClientCom(ClientCom):
+    """
+    Represents a TCP based communication class which runs as coroutines on an asyncio event loop
+    instead of its own threads
+    """
+
+    def __init__(self, server_port: int, server_ip: str, message_queue: asyncio.Queue, com_type='general',
+                 framing=ClientCom.TEXT_FRAMING, cipher='cbc', key_pool=None, streams=None, loop=None):
+        """
+        Initializes the client communication object.
+
+        :param server_port: The port number of the server.
+        :type server_port: int
+        :param server_ip: The IP address of the server.
+        :type server_ip: str
+        :param message_queue: The queue to put received messages.
+        :type message_queue: asyncio.Queue
+        :param com_type: The type of communication (e.g. 'general' or 'files').
+        :type com_type: str
+        :param framing: The preferred framing mode, the binary framing is used only if the server accepts it
+        :type framing: str
+        :param cipher: The preferred cipher of the binary framing (a key of CIPHERS)
+        :type cipher: str
+        :param key_pool: A pool of pre-generated RSA keys, a key is generated on connection if not given
+        :type key_pool: RSAKeyPool
+        :param streams: The queues of the other channels to carry on this connection if the server supports it,
+                        by their com type (requires the binary framing)
+        :type streams: dict
+        :param loop: The event loop to run on, the default event loop if not given
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.reader = None
+        self.writer = None
+        # The task sending the frames of the current connection
+        self.writer_task = None
+        # Set when frames are waiting to be sent by the writer
+        self._outbound_ready = asyncio.Event()
+
+        super().__init__(server_port, server_ip, message_queue, com_type=com_type, framing=framing, cipher=cipher,
+                         key_pool=key_pool, streams=streams)
+
+    def _com_options(self):
+        """
+        :return: The options of this class's constructor, besides the ones of every ClientCom
+        :rtype: dict
+        """
+        return {'loop': self.loop}
+
+    def _start(self):
+        """
+        Starts connecting to the server on the event loop
+        :return: -
+        """
+        self.main_task = asyncio.run_coroutine_threadsafe(self._main_loop_async(), self.loop)
+
+    def _send_frame(self, channel_id, frame):
+        """
+        Queues a frame for the writer of the connection
+        :param channel_id: The stream of the frame
+        :type channel_id: int
+        :param frame: The frame to send
+        :type frame: bytes
+        """
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+
+        # Coroutines of the loop can't wait for the writer which runs on the same loop, and the GUI thread never waits
+        self._enqueue_frame(channel_id, frame, wait=not in_loop and not wx.IsMainThread())
+
+        self.loop.call_soon_threadsafe(self._outbound_ready.set)
+
+    def _deliver(self, channel_id, message):
+        """
+        Puts a received message in the message queue of its stream
+        :param channel_id: The stream the message arrived on
+        :type channel_id: int
+        :param message: The decrypted message
+        :type message: str
+        """
+        self.streams.get(channel_id, self.message_queue).put_nowait(message)
+
+    async def _main_loop_async(self):
+        """
+        Connects to the server, then receives data from it and puts it in a queue
+        :return: -
+        """
+        start_time = time.perf_counter()
+        # Get the RSA key of the key exchange without blocking the loop
+        self.rsa = await self.loop.run_in_executor(None, self.key_pool.get if self.key_pool else RSACipher)
+        self.handshake_times = {'rsa_key': time.perf_counter() - start_time}
+
+        try:
+            step_time = time.perf_counter()
+            self.reader, self.writer = await asyncio.open_connection(self.server_ip, self.server_port)
+            self.handshake_times['connect'] = time.perf_counter() - step_time
+
+            step_time = time.perf_counter()
+            await self._switch_keys_async()  # Switch encryption keys with server
+            self.handshake_times['switch_keys'] = time.perf_counter() - step_time
+
+            # Ask the server for the binary framing if it is preferred
+            if self.preferred_framing == ClientCom.BINARY_FRAMING:
+                step_time = time.perf_counter()
+                await self._negotiate_framing_async()
+                self.handshake_times['framing'] = time.perf_counter() - step_time
+
+            # Ask the server to carry the other channels on this connection
+            if self.streams and self.framing == ClientCom.BINARY_FRAMING:
+                step_time = time.perf_counter()
+                await self._negotiate_multiplexing_async()
+                self.handshake_times['multiplexing'] = time.perf_counter() - step_time
+
+        except Exception:
+            # Check if there is a wx app running
+            if wx.GetApp():
+                # If the server is not responding, send a message to the main frame
+                wx.CallAfter(pub.sendMessage, 'server_connection_lost')
+            self.close()
+            return
+
+        self.handshake_times['total'] = time.perf_counter() - start_time
+
+        reader = self.reader
+        self.running = True
+        self.handshake_done.set()
+        # The writer of the old connection would take the frames of the new one
+        if self.writer_task:
+            self._outbound_ready.set()
+            await self.writer_task
+        self.writer_task = self.loop.create_task(self._writer_loop_async(self.writer))
+
+        # Check if there is a wx app running
+        if wx.GetApp():
+            # Send a message to the main frame that the connection was established
+            wx.CallAfter(pub.sendMessage, 'server_connection_established')
+
+        # Run while the connection is the current connection of the client_com object
+        while self.running and reader is self.reader:
+            try:
+                channel_id, data = await self._receive_frame_async(reader)
+
+            # Invalid size exception, or the connection was closed
+            except (ValueError, EOFError, OSError):
+                if reader is self.reader:
+                    self.running = False
+            else:
+                try:
+                    dec_data = self._decrypt_frame(data, channel_id)
+                except Exception:
+                    pass
+                else:
+                    # Put the received data inside the message queue of its stream
+                    self._deliver(channel_id, dec_data)
+
+        # Wake the writer so it stops with the connection
+        self._outbound_ready.set()
+
+    async def _writer_loop_async(self, writer):
+        """
+        Sends the queued frames to the server, coalescing the frames waiting together into a single write
+        :param writer: The writer of the connection
+        :type writer: asyncio.StreamWriter
+        :return: -
+        """
+        try:
+            while self.running and writer is self.writer:
+                await self._outbound_ready.wait()
+                if writer is not self.writer:
+                    break
+                self._outbound_ready.clear()
+
+                frames = self._take_frames()
+                while frames:
+                    writer.writelines(frames)
+                    await writer.drain()
+                    frames = self._take_frames()
+        except Exception:
+            if self.running and writer is self.writer:
+                wx.CallAfter(pub.sendMessage, 'server_connection_lost')
+                self.close()
+
+    async def _switch_keys_async(self):
+        """
+        Switches encryption keys with the server
+        :return: -
+        """
+        self.server_key = (await self.reader.read(1024)).decode()  # Receive server's public key
+        self.writer.write(self.rsa.get_string_public_key().encode())  # Send client's public key
+        await self.writer.drain()
+        aes_key_enc = await self.reader.readexactly(256)  # Receive encrypted AES key
+        self.aes_key = self.rsa.decrypt(aes_key_enc).decode()  # Decrypt AES key
+
+    async def _negotiate_framing_async(self):
+        """
+        Offers the binary framing to the server, and switches to it if the server accepts.
+        Servers which don't answer in time keep the text framing, and aren't offered it again.
+        :return: -
+        """
+        offer = self._framing_offer()
+        if (self.server_ip, self.server_port, offer) in ClientCom.unanswered_offers:
+            return
+        self.writer.write(ClientCom._text_frame(self.aes_key, offer.encode(), self.SIZE_LENGTH))
+        await self.writer.drain()
+
+        answer = None
+        first = await self._wait_for_answer_async(offer)
+        if first:
+            channel_id, data = await self._receive_frame_async(self.reader, first)
+            answer = self._decrypt_frame(data)
+
+        self._accept_framing(offer, answer)
+
+    async def _wait_for_answer_async(self, offer):
+        """
+        Waits for the first byte of the server's answer to an offer. Only the first byte is waited for with a timeout,
+        the rest of the frame is received as usual so the stream never loses its place in a frame.
+        :param offer: The offer, remembered if the server doesn't answer it
+        :type offer: str
+        :return: The first byte of the answer, empty if the server didn't answer in time
+        :rtype: bytes
+        """
+        try:
+            # A cancelled readexactly consumes nothing
+            return await asyncio.wait_for(self.reader.readexactly(1), ClientCom.FRAMING_TIMEOUT)
+        except asyncio.TimeoutError:
+            ClientCom.unanswered_offers.add((self.server_ip, self.server_port, offer))
+            return b''
+
+    async def _negotiate_multiplexing_async(self):
+        """
+        Offers the server to carry the other channels on this connection.
+        Servers which don't answer in time keep the channels on their own connections, and aren't offered it again.
+        :return: -
+        """
+        if (self.server_ip, self.server_port, ClientCom.MULTIPLEX_OFFER) in ClientCom.unanswered_offers:
+            return
+        self.writer.write(ClientCom._binary_frame(self.aes_key, ClientCom.MULTIPLEX_OFFER.encode(),
+                                                  self.channel_id, self.cipher))
+        await self.writer.drain()
+
+        channel_id, answer = self.channel_id, None
+        first = await self._wait_for_answer_async(ClientCom.MULTIPLEX_OFFER)
+        if first:
+            channel_id, data = await self._receive_frame_async(self.reader, first)
+            answer = self._decrypt_frame(data)
+
+        self._accept_multiplexing(channel_id, answer)
+
+    async def _receive_frame_async(self, reader, first=b''):
+        """
+        Receives a single frame from the server according to the current framing
+        :param reader: The reader of the connection
+        :type reader: asyncio.StreamReader
+        :param first: The first bytes of the frame, if they were already received
+        :type first: bytes
+        :return: The channel id and the encrypted payload of the frame
+        :rtype: tuple
+        """
+        if self.framing == ClientCom.BINARY_FRAMING:
+            header = first + await reader.readexactly(ClientCom.BINARY_HEADER.size - len(first))
+            size, channel_id = ClientCom.BINARY_HEADER.unpack(header)
+        else:
+            # Receive the size of the data and convert it to an int
+            size = int((first + await reader.readexactly(self.SIZE_LENGTH - len(first))).decode())
+            channel_id = self.channel_id
+
+        if size > ClientCom.MAX_FRAME_SIZE:
+            raise ValueError(f'Frame of {size} bytes is too large')
+        # Receive the data
+        return channel_id, await reader.readexactly(size)
+
+    def close(self):
+        """
+        Closes the client communication object
+        :return: -
+        """
+        super().close()
+        self._disconnect()
+        self.loop.call_soon_threadsafe(self._outbound_ready.set)
+
+    def _disconnect(self):
+        """
+        Closes the connection to the server
+        :return: -
+        """
+        if self.writer:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+def _benchmark(iterations=200):
+    """
+    Compares the bytes on the wire and the CPU time per message of the text and binary framings
+    :param iterations: The amount of messages to frame for every size
+    :return: -
+    """
+    aes_key = AESCipher.generate_key()
+    print(f'{"size":>10} {"text bytes":>12} {"binary bytes":>13} {"text us/msg":>12} {"binary us/msg":>14}')
+    for size in (64, 1024, 64 * 1024, 1024 * 1024):
+        data = b'a' * size
+
+        start = time.process_time()
+        for _ in range(iterations):
+            text_frame = ClientCom._text_frame(aes_key, data, 10)
+            AESCipher.decrypt(aes_key, text_frame[10:].decode())
+        text_time = (time.process_time() - start) / iterations
+
+        start = time.process_time()
+        for _ in range(iterations):
+            binary_frame = ClientCom._binary_frame(aes_key, data, 0)
+            AESCipher.decrypt_bytes(aes_key, binary_frame[ClientCom.BINARY_HEADER.size:])
+        binary_time = (time.process_time() - start) / iterations
+
+        print(f'{size:>10} {len(text_frame):>12} {len(binary_frame):>13} '
+              f'{text_time * 1e6:>12.1f} {binary_time * 1e6:>14.1f}')
+
+
+if __name__ == '__main__':
+    _benchmark()
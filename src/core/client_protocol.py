@@ -1,3 +1,46 @@
+class Message:
+    """
+    A message deconstructed from the server, every opcode has a subclass with a slot for each of its parameters.
+    The parameters are read like the items of a dict, parameters the server didn't send are missing.
+    """
+    __slots__ = ()
+    # The name of the operation and the names of its parameters, set by every subclass
+    opname = None
+    params = ()
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+    def get(self, name, default=None):
+        """
+        Returns the value of a parameter
+        :param name: The name of the parameter
+        :param default: The value returned if the server didn't send the parameter
+        :return: The value of the parameter
+        """
+        return getattr(self, name, default)
+
+    def to_dict(self):
+        """
+        Returns the message as a dict, like it's read by the GUI and stored
+        :return: A dict with every parameter name as the key, and it's value as the value
+        """
+        ret = {'opname': self.opname}
+        for name in self.params:
+            if hasattr(self, name):
+                ret[name] = getattr(self, name)
+        return ret
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()})'
+
+
 class Protocol:
     """
     A class for creating and deconstructing messages (client side) according to the protocol
@@ -7,93 +50,139 @@ class Protocol:
     FIELD_SEPARATOR = '@'
     # A chat for separating items in a list of items in a field
     LIST_SEPARATOR = '#'
-
-    # Opcodes to construct messages (client -> server)
-    general_opcodes = {
-        'register': 1,
-        'sign_in': 2,
-        'add_friend': 3,
-        'create_group': 4,
-        'start_voice': 5,
-        'start_video': 6,
-        'change_username': 7,
-        'change_status': 8,
-        'change_password': 9,
-        'get_chat_history': 10,
-        'request_file': 11,
-        'remove_friend': 12,
-        'join_voice': 13,
-        'join_video': 14,
-        'add_group_member': 15,
-        'request_group_members': 16,
-        'request_user_picture': 17,
-        'request_user_status': 18,
-        'request_chats': 19,
-        'accept_friend': 20,
-        'request_friend_list': 21,
-        'logout': 22,
-        'request_keys': 23,
-        'request_user_picture_check': 24,
+    FIELD_SEPARATOR_BYTES = FIELD_SEPARATOR.encode()
+    LIST_SEPARATOR_BYTES = LIST_SEPARATOR.encode()
+    # The decoder of the bulk fields, which are kept as they were received
+    BODY = object()
+
+    # The messages of every channel (client -> server): the opcode and the parameters of every message,
+    # where a parameter with a width is zero padded.
+    # The opcodes tables, the builders and the decoders are all generated from this table and the next one.
+    c_messages = {
+        'general': {
+            'register': (1, ('username', 'password')),
+            'sign_in': (2, ('username', 'password')),
+            'add_friend': (3, ('username',)),
+            'create_group': (4, ('group_name',)),
+            'start_voice': (5, ('chat_id', 'cipher')),
+            'start_video': (6, ('chat_id', 'cipher')),
+            'change_username': (7, ('new_username',)),
+            'change_status': (8, ('new_status',)),
+            'change_password': (9, ('old_password', 'new_password')),
+            'get_chat_history': (10, ('chat_id', 'before_id', 'limit', 'after_id')),
+            'request_file': (11, ('file_hash',)),
+            'remove_friend': (12, ('username',)),
+            'join_voice': (13, ('chat_id', 'cipher')),
+            'join_video': (14, ('chat_id', 'cipher')),
+            'add_group_member': (15, ('chat_id', 'username', 'group_key')),
+            'request_group_members': (16, ('chat_id',)),
+            'request_user_picture': (17, ('username',)),
+            'request_user_status': (18, ('username',)),
+            'request_chats': (19, ()),
+            'accept_friend': (20, ('friend_username', 'is_accepted')),
+            'request_friend_list': (21, ()),
+            'logout': (22, ()),
+            'request_keys': (23, ()),
+            'request_user_picture_check': (24, ('username', 'pfp_hash')),
+            'request_bootstrap': (25, ('usernames', 'pfp_hashes')),
+        },
+        'chat': {
+            'text_message': (1, (('chat_id', 3), 'sender', 'message')),
+            'file_description': (2, (('chat_id', 3), 'sender', 'file_name', 'file_size', 'file_hash'))
+        },
+        'files': {
+            'file_in_chat': (1, ('chat_id', 'file_name', 'file_contents')),
+            'profile_pic_change': (2, ('image_contents',)),
+            'file_upload_start': (3, ('chat_id', 'file_name', 'file_size')),
+            'file_upload_chunk': (4, ('chat_id', 'chunk')),
+            'file_upload_end': (5, ('chat_id', 'file_hash'))
+        }
     }
-    chat_opcodes = {
-        'text_message': 1,
-        'file_description': 2
+    # The amount of digits of the opcodes of every channel
+    c_opcodes_widths = {'general': 2, 'chat': 1, 'files': 1}
+
+    # The messages of every channel (server -> client): the name and the parameters of every opcode
+    s_messages = {
+        'general': {
+            1: ('approve_reject', ('is_approved', 'function_opcode')),
+            2: ('friend_request', ('sender_username', 'is_silent')),
+            3: ('added_to_group', ('group_name', 'chat_id', 'group_key')),
+            4: ('voice_call_started', ('chat_id',)),
+            5: ('video_call_started', ('chat_id',)),
+            6: ('voice_call_info', ('chat_id', 'ips', 'usernames', 'ciphers')),
+            7: ('video_call_info', ('chat_id', 'ips', 'usernames', 'ciphers')),
+            8: ('voice_user_joined', ('chat_id', 'user_ip', 'username', 'cipher')),
+            9: ('video_user_joined', ('chat_id', 'user_ip', 'username', 'cipher')),
+            10: ('chats_list', ('chats_names', 'chats_ids')),
+            11: ('group_members', ('chat_id', 'usernames')),
+            12: ('user_status', ('username', 'status')),
+            13: ('friend_added', ('friend_username', 'friends_key', 'chat_id')),
+            14: ('friend_list', ()),
+            15: ('keys', ('chat_ids', 'keys')),
+            16: ('bootstrap', ('messages',))
+        },
+        'chat': {
+            1: ('text_message', ('chat_id', 'sender', 'message', 'message_id')),
+            2: ('file_description', ('chat_id', 'sender', 'file_name', 'file_size', 'file_hash', 'message_id')),
+            3: ('chat_history', ('messages', 'chat_id', 'oldest_id', 'has_more'))
+        },
+        'files': {
+            1: ('file_in_chat', ('chat_id', 'file_name', 'file_contents')),
+            2: ('user_profile_picture', ('pfp_username', 'image_contents')),
+            3: ('file_download_start', ('file_hash', 'file_size')),
+            4: ('file_download_chunk', ('file_hash', 'chunk')),
+            5: ('file_download_end', ('file_hash',))
+        }
     }
-    files_opcodes = {
-        'file_in_chat': 1,
-        'profile_pic_change': 2
+
+    # The types of the parameters by their name, where a list holds the type of its items (str if not listed)
+    params_types = {
+        'is_approved': int,
+        'function_opcode': int,
+        'is_silent': int,
+        'is_accepted': int,
+        'chat_id': int,
+        'ips': [str],
+        'usernames': [str],
+        'ciphers': [str],
+        'pfp_hashes': [str],
+        'chats_names': [str],
+        'chats_ids': [int],
+        'file_size': int,
+        'message_id': int,
+        'messages': [str],
+        'before_id': int,
+        'after_id': int,
+        'limit': int,
+        'oldest_id': int,
+        'has_more': int,
+        'chat_ids': [int],
+        'keys': [str],
     }
 
+    # The bulk parameters (always the last field, base64 so they never hold a separator), handed through as they are
+    # without scanning them for separators, and kept as a view of the message when decoding bytes
+    body_params = ('file_contents', 'image_contents', 'chunk')
+
+    # Opcodes to construct messages (client -> server)
+    general_opcodes = {name: opcode for name, (opcode, _) in c_messages['general'].items()}
+    chat_opcodes = {name: opcode for name, (opcode, _) in c_messages['chat'].items()}
+    files_opcodes = {name: opcode for name, (opcode, _) in c_messages['files'].items()}
+
     # Opcodes to read messages (server -> client)
-    s_general_opcodes = {
-        1: 'approve_reject',
-        2: 'friend_request',
-        3: 'added_to_group',
-        4: 'voice_call_started',
-        5: 'video_call_started',
-        6: 'voice_call_info',
-        7: 'video_call_info',
-        8: 'voice_user_joined',
-        9: 'video_user_joined',
-        10: 'chats_list',
-        11: 'group_members',
-        12: 'user_status',
-        13: 'friend_added',
-        14: 'friend_list',
-        15: 'keys'
-    }
-    s_chat_opcodes = {
-        1: 'text_message',
-        2: 'file_description',
-        3: 'chat_history'
-    }
-    s_files_opcodes = {
-        1: 'file_in_chat',
-        2: 'user_profile_picture'
-    }
+    s_general_opcodes = {opcode: name for opcode, (name, _) in s_messages['general'].items()}
+    s_chat_opcodes = {opcode: name for opcode, (name, _) in s_messages['chat'].items()}
+    s_files_opcodes = {opcode: name for opcode, (name, _) in s_messages['files'].items()}
 
     # Parameters of every message from the server (server -> client)
-    s_opcodes_params = {
-        'approve_reject': ('is_approved', 'function_opcode'),
-        'friend_request': ('sender_username', 'is_silent'),
-        'added_to_group': ('group_name', 'chat_id', 'group_key'),
-        'voice_call_started': ('chat_id',),
-        'video_call_started': ('chat_id',),
-        'voice_call_info': ('chat_id', 'ips', 'usernames'),
-        'video_call_info': ('chat_id', 'ips', 'usernames'),
-        'voice_user_joined': ('chat_id', 'user_ip', 'username'),
-        'video_user_joined': ('chat_id', 'user_ip', 'username'),
-        'chats_list': ('chats_names', 'chats_ids'),
-        'group_members': ('chat_id', 'usernames'),
-        'user_status': ('username', 'status'),
-        'friend_added': ('friend_username', 'friends_key', 'chat_id',),
-        'text_message': ('chat_id', 'sender', 'message'),
-        'file_description': ('chat_id', 'sender', 'file_name', 'file_size', 'file_hash'),
-        'file_in_chat': ('chat_id', 'file_name', 'file_contents'),
-        'user_profile_picture': ('pfp_username', 'image_contents'),
-        'chat_history': ('messages', 'chat_id'),
-        'keys': ('chat_ids', 'keys')
-    }
+    s_opcodes_params = {name: params for channel in s_messages.values() for name, params in channel.values()}
+
+    # The encoders of every message (client -> server) by its name, compiled by compile_encoders
+    encoders = {}
+    # The decoders of every opcode of every channel, compiled by compile_decoders
+    decoders = {}
+    # The decoders of the messages of the client, to check the encoders
+    c_decoders = {}
 
     @staticmethod
     def register(username, password):
@@ -103,11 +192,7 @@ class Protocol:
         :param password: the password of the user
         :return: the message after protocol
         """
-        # Get the opcode of register
-        opcode = Protocol.general_opcodes['register']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{username}{Protocol.FIELD_SEPARATOR}{password}"
-        return msg
+        return Protocol.encode('register', username, password)
 
     @staticmethod
     def sign_in(username, password):
@@ -117,13 +202,7 @@ class Protocol:
         :param password: the password of the user
         :return: the message after protocol
         """
-
-        # Get the opcode of sign_in
-        opcode = Protocol.general_opcodes['sign_in']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{username}{Protocol.FIELD_SEPARATOR}{password}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('sign_in', username, password)
 
     @staticmethod
     def add_friend(username):
@@ -132,13 +211,7 @@ class Protocol:
         :param username: the username of the user
         :return: the message after protocol
         """
-
-        # Get the opcode of add_friend
-        opcode = Protocol.general_opcodes['add_friend']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{username}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('add_friend', username)
 
     @staticmethod
     def accept_friend_request(friend_username, is_accepted: bool):
@@ -148,14 +221,7 @@ class Protocol:
         :param is_accepted: True if the friend request is accepted, False otherwise
         :return: the message after protocol
         """
-
-        # Get the opcode of accept friend
-        opcode = Protocol.general_opcodes['accept_friend']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{friend_username}" \
-              f"{Protocol.FIELD_SEPARATOR}{int(is_accepted)}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('accept_friend', friend_username, is_accepted)
 
     @staticmethod
     def create_group(group_name):
@@ -164,43 +230,27 @@ class Protocol:
         :param group_name: the name of the group
         :return: the message after protocol
         """
-
-        # Get the opcode of create_group
-        opcode = Protocol.general_opcodes['create_group']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{group_name}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('create_group', group_name)
 
     @staticmethod
-    def start_voice(group_id):
+    def start_voice(group_id, cipher):
         """
         A static method for creating a start voice message
         :param group_id: the id of the group
+        :param cipher: the name of the cipher the client advertises for the call
         :return: the message after protocol
         """
-
-        # Get the opcode of start_voice
-        opcode = Protocol.general_opcodes['start_voice']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{group_id}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('start_voice', group_id, cipher)
 
     @staticmethod
-    def start_video(group_id):
+    def start_video(group_id, cipher):
         """
         A static method for creating a start video message
         :param group_id: the id of the group
+        :param cipher: the name of the cipher the client advertises for the call
         :return: the message after protocol
         """
-
-        # Get the opcode of start_video
-        opcode = Protocol.general_opcodes['start_video']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{group_id}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('start_video', group_id, cipher)
 
     @staticmethod
     def change_username(new_username):
@@ -209,13 +259,7 @@ class Protocol:
         :param new_username: the new username of the user
         :return: the message after protocol
         """
-
-        # Get the opcode of change_username
-        opcode = Protocol.general_opcodes['change_username']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{new_username}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('change_username', new_username)
 
     @staticmethod
     def change_pfp(picture):
@@ -224,13 +268,7 @@ class Protocol:
         :param picture: the new picture of the user
         :return: the message after protocol
         """
-
-        # Get the opcode of change_pfp
-        kind = Protocol.files_opcodes['profile_pic_change']
-        # Construct the message
-        msg = f"{kind}{Protocol.FIELD_SEPARATOR}{picture}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('profile_pic_change', picture)
 
     @staticmethod
     def change_status(new_status):
@@ -239,13 +277,7 @@ class Protocol:
         :param new_status: the new status of the user
         :return: the message after protocol
         """
-
-        # Get the opcode of change_status
-        opcode = Protocol.general_opcodes['change_status']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{new_status}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('change_status', new_status)
 
     @staticmethod
     def change_password(old_password, new_password):
@@ -255,28 +287,23 @@ class Protocol:
         :param new_password: the new password of the user
         :return: the message after protocol
         """
-
-        # Get the opcode of change_password
-        opcode = Protocol.general_opcodes['change_password']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{old_password}{Protocol.FIELD_SEPARATOR}{new_password}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('change_password', old_password, new_password)
 
     @staticmethod
-    def get_chat_history(chat_id):
+    def get_chat_history(chat_id, before_id=None, limit=None, after_id=None):
         """
         A static method for creating a get chat history message
         :param chat_id: the id of the chat
+        :param before_id: the id of the oldest message already loaded, the page ends right before it
+                          (the latest page if not given)
+        :param limit: the maximum amount of messages in the page (the whole history if not given)
+        :param after_id: the id of the newest message already stored, only the messages after it are sent
         :return: the message after protocol
         """
-
-        # Get the opcode of get_chat_history
-        opcode = Protocol.general_opcodes['get_chat_history']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{chat_id}"
-        # Return the message after protocol
-        return msg
+        # Every trailing parameter which wasn't given is left out
+        if limit is None and after_id is None:
+            return Protocol.encode('get_chat_history', chat_id)
+        return Protocol.encode('get_chat_history', chat_id, before_id or 0, limit or 0, after_id)
 
     @staticmethod
     def request_file(file_hash):
@@ -285,13 +312,7 @@ class Protocol:
         :param file_hash: the hash of the file
         :return: the message after protocol
         """
-
-        # Get the opcode of request_file
-        opcode = Protocol.general_opcodes['request_file']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{file_hash}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('request_file', file_hash)
 
     @staticmethod
     def remove_friend(username):
@@ -300,43 +321,27 @@ class Protocol:
         :param username: the username of the friend
         :return: the message after protocol
         """
-
-        # Get the opcode of remove_friend
-        opcode = Protocol.general_opcodes['remove_friend']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{username}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('remove_friend', username)
 
     @staticmethod
-    def join_voice(chat_id):
+    def join_voice(chat_id, cipher):
         """
         A static method for creating a join voice message
         :param chat_id: the id of the chat
+        :param cipher: the name of the cipher the client advertises for the call
         :return: the message after protocol
         """
-
-        # Get the opcode of join_voice
-        opcode = Protocol.general_opcodes['join_voice']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{chat_id}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('join_voice', chat_id, cipher)
 
     @staticmethod
-    def join_video(chat_id):
+    def join_video(chat_id, cipher):
         """
         A static method for creating a join video message
         :param chat_id: the id of the chat
+        :param cipher: the name of the cipher the client advertises for the call
         :return: the message after protocol
         """
-
-        # Get the opcode of join_video
-        opcode = Protocol.general_opcodes['join_video']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{chat_id}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('join_video', chat_id, cipher)
 
     @staticmethod
     def add_member_to_group(chat_id, username, group_key):
@@ -347,13 +352,7 @@ class Protocol:
         :param group_key: the key of the group
         :return: the message after protocol
         """
-
-        # Get the opcode of add_member_to_group
-        opcode = Protocol.general_opcodes['add_group_member']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{chat_id}{Protocol.FIELD_SEPARATOR}{username}{Protocol.FIELD_SEPARATOR}{group_key}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('add_group_member', chat_id, username, group_key)
 
     @staticmethod
     def request_group_members(chat_id):
@@ -362,13 +361,7 @@ class Protocol:
         :param chat_id: the id of the chat
         :return: the message after protocol
         """
-
-        # Get the opcode of request_group_members
-        opcode = Protocol.general_opcodes['request_group_members']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{chat_id}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('request_group_members', chat_id)
 
     @staticmethod
     def request_user_pfp(username):
@@ -377,13 +370,7 @@ class Protocol:
         :param username: the username of the user
         :return: the message after protocol
         """
-
-        # Get the opcode of request_user_pfp
-        opcode = Protocol.general_opcodes['request_user_picture']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{username}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('request_user_picture', username)
 
     @staticmethod
     def request_user_pfp_check(username, pfp_hash):
@@ -396,12 +383,7 @@ class Protocol:
         :return: The message after protocol
         :rtype: str
         """
-        # Get the opcode of request_user_pfp
-        opcode = Protocol.general_opcodes['request_user_picture_check']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{username}{Protocol.FIELD_SEPARATOR}{pfp_hash}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('request_user_picture_check', username, pfp_hash)
 
     @staticmethod
     def request_user_status(username):
@@ -410,13 +392,7 @@ class Protocol:
         :param username: the username of the user
         :return: the message after protocol
         """
-
-        # Get the opcode of request_user_status
-        opcode = Protocol.general_opcodes['request_user_status']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{username}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('request_user_status', username)
 
     @staticmethod
     def request_chats():
@@ -424,13 +400,21 @@ class Protocol:
         A static method for creating a request chats message
         :return: the message after protocol
         """
+        return Protocol.encode('request_chats')
 
-        # Get the opcode of request_chats
-        opcode = Protocol.general_opcodes['request_chats']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}"
-        # Return the message after protocol
-        return msg
+    @staticmethod
+    def request_bootstrap(usernames, pfp_hashes):
+        """
+        A static method for creating a request bootstrap message, which asks for the whole initial state at once:
+        the chats list, then a bootstrap message with the members and statuses of the chats, the latest history page
+        of every chat and the pictures which changed
+        :param usernames: the usernames of the pictures saved locally
+        :type usernames: list
+        :param pfp_hashes: the hashes of the pictures saved locally, in the order of the usernames
+        :type pfp_hashes: list
+        :return: the message after protocol
+        """
+        return Protocol.encode('request_bootstrap', usernames, pfp_hashes)
 
     @staticmethod
     def send_message(sender_username, chat_id, message):
@@ -441,13 +425,7 @@ class Protocol:
         :param message: the message
         :return: the message after protocol
         """
-
-        # Get the opcode of send_message
-        kind = Protocol.chat_opcodes['text_message']
-        # Construct the message
-        msg = f"{kind}{Protocol.FIELD_SEPARATOR}{str(chat_id).zfill(3)}{Protocol.FIELD_SEPARATOR}{sender_username}{Protocol.FIELD_SEPARATOR}{message}"
-        # Return the message after protocol
-        return msg
+        return Protocol.encode('text_message', chat_id, sender_username, message)
 
     @staticmethod
     def send_file(chat_id, file_name, file):
@@ -458,15 +436,39 @@ class Protocol:
         :param file: the file
         :return: the message after protocol
         """
+        return Protocol.encode('file_in_chat', chat_id, file_name, file)
+
+    @staticmethod
+    def file_upload_start(chat_id, file_name, file_size):
+        """
+        A static method for creating a file upload start message (followed by file upload chunks)
+        :param chat_id: the id of the chat
+        :param file_name: the name of the file
+        :param file_size: the size of the file in bytes
+        :return: the message after protocol
+        """
+        return Protocol.encode('file_upload_start', chat_id, file_name, file_size)
+
+    @staticmethod
+    def file_upload_chunk(chat_id, chunk):
+        """
+        A static method for creating a file upload chunk message
+        :param chat_id: the id of the chat
+        :param chunk: the encrypted chunk of the file (base64)
+        :return: the message after protocol
+        """
+        return Protocol.encode('file_upload_chunk', chat_id, chunk)
+
+    @staticmethod
+    def file_upload_end(chat_id, file_hash):
+        """
+        A static method for creating a file upload end message
+        :param chat_id: the id of the chat
+        :param file_hash: the hash of the encrypted chunks of the file
+        :return: the message after protocol
+        """
+        return Protocol.encode('file_upload_end', chat_id, file_hash)
 
-        # Get the opcode of send_file
-        kind = Protocol.files_opcodes['file_in_chat']
-        # Construct the message
-        msg = f"{kind}{Protocol.FIELD_SEPARATOR}{chat_id}" \
-            f"{Protocol.FIELD_SEPARATOR}{file_name}{Protocol.FIELD_SEPARATOR}{file}"
-        # Return the message after protocol
-        return msg
-    
     @staticmethod
     def file_description(sender_username, chat_id, filename, file_size, file_hash):
         """
@@ -478,10 +480,7 @@ class Protocol:
         :param file_hash: The hash of the file
         :return: The message after protocol
         """
-        
-        kind = Protocol.chat_opcodes['file_description']
-        msg = f"{kind}{Protocol.FIELD_SEPARATOR}{str(chat_id).zfill(3)}{Protocol.FIELD_SEPARATOR}{sender_username}{Protocol.FIELD_SEPARATOR}{filename}{Protocol.FIELD_SEPARATOR}{file_size}{Protocol.FIELD_SEPARATOR}{file_hash}"
-        return msg
+        return Protocol.encode('file_description', chat_id, sender_username, filename, file_size, file_hash)
 
     @staticmethod
     def request_keys():
@@ -489,82 +488,302 @@ class Protocol:
         A static method for creating a request keys message
         :return: the message after protocol
         """
+        return Protocol.encode('request_keys')
 
-        # Get the opcode of request_keys
-        opcode = Protocol.general_opcodes['request_keys']
-        # Construct the message
-        msg = f"{str(opcode).zfill(2)}"
-        # Return the message after protocol
-        return msg
+    @staticmethod
+    def compile_encoders():
+        """
+        Compiles the encoder of every message of the client from the table of the messages and the parameters' types:
+        the zero padded opcode as bytes, the prefix of the fields, and a function converting every field to bytes.
+        The fields aren't escaped, so the encoders raise a ValueError for a value holding a separator
+        :return: -
+        """
+        separators = (Protocol.FIELD_SEPARATOR, Protocol.LIST_SEPARATOR)
+        separators_bytes = (Protocol.FIELD_SEPARATOR_BYTES, Protocol.LIST_SEPARATOR_BYTES)
+
+        def separator_error(param_name):
+            return ValueError(f"{param_name.replace('_', ' ').capitalize()} can't contain "
+                              f"'{Protocol.FIELD_SEPARATOR}' or '{Protocol.LIST_SEPARATOR}'")
+
+        def str_encoder(param_name):
+            def encode_field(value):
+                if type(value) != bytes:
+                    value = str(value).encode()
+                if separators_bytes[0] in value or separators_bytes[1] in value:
+                    raise separator_error(param_name)
+                return value
+            return encode_field
+
+        def int_encoder(width):
+            return lambda value: str(int(value)).zfill(width).encode()
+
+        def list_encoder(param_name):
+            def encode_field(value):
+                items = [str(item) for item in value]
+                if any(separators[0] in item or separators[1] in item for item in items):
+                    raise separator_error(param_name)
+                return Protocol.LIST_SEPARATOR.join(items).encode()
+            return encode_field
+
+        def body_encoder(value):
+            if type(value) == str:
+                return value.encode()
+            return value
+
+        for channel, messages in Protocol.c_messages.items():
+            opcode_width = Protocol.c_opcodes_widths[channel]
+            for name, (opcode, params) in messages.items():
+                fields_encoders = []
+                for param in params:
+                    param_name, width = param if type(param) == tuple else (param, 0)
+                    param_type = Protocol.params_types.get(param_name, str)
+                    if param_name in Protocol.body_params:
+                        fields_encoders.append(body_encoder)
+                    elif type(param_type) == list:
+                        fields_encoders.append(list_encoder(param_name))
+                    elif param_type == int:
+                        fields_encoders.append(int_encoder(width))
+                    else:
+                        fields_encoders.append(str_encoder(param_name))
+
+                # The opcode of the message, and the prefix of its fields (the opcode and the separator of the first field)
+                prefix = str(opcode).zfill(opcode_width).encode()
+                Protocol.encoders[name] = (prefix, prefix + Protocol.FIELD_SEPARATOR_BYTES, tuple(fields_encoders))
 
     @staticmethod
-    def unprotocol_msg(type: str, raw_message):
+    def encode(name: str, *values):
+        """
+        Constructs a message of the client with the client-server's protocol
+        :param name: The name of the message
+        :param values: The value of every parameter of the message, trailing None values are left out
+        :return: The message after protocol
+        :rtype: bytes
+        """
+        opcode, prefix, fields_encoders = Protocol.encoders[name]
+        if None in values:
+            count = len(values)
+            while count and values[count - 1] is None:
+                count -= 1
+            values = values[:count]
+            # Only trailing parameters can be left out, the fields after a missing one would shift
+            if None in values:
+                raise ValueError(f'Missing parameter {values.index(None)} of {name}')
+        if not values:
+            return opcode
+        return prefix + Protocol.FIELD_SEPARATOR_BYTES.join([encode_field(value) for encode_field, value
+                                                              in zip(fields_encoders, values)])
+
+    @staticmethod
+    def compile_decoders():
+        """
+        Compiles the decoder of every opcode from the tables of the messages and the parameters' types:
+        a record class with a slot for every parameter, and a function converting every field
+        :return: -
+        """
+        def int_decoder(value):
+            # An empty field is a parameter which wasn't given
+            return int(value) if value else None
+
+        def list_decoder(item_type):
+            if item_type == int:
+                return lambda value: [int(v) for v in value.split(Protocol.LIST_SEPARATOR) if v] if value else []
+            return lambda value: value.split(Protocol.LIST_SEPARATOR) if value else []
+
+        def compile_decoder(opcode_name, params):
+            params_names = tuple(param[0] if type(param) == tuple else param for param in params)
+            record_class = type(''.join(word.capitalize() for word in opcode_name.split('_')), (Message,),
+                                {'__slots__': params_names, 'opname': opcode_name, 'params': params_names})
+
+            fields_decoders = []
+            for param_name in params_names:
+                param_type = Protocol.params_types.get(param_name, str)
+                if param_name in Protocol.body_params:
+                    fields_decoders.append(Protocol.BODY)
+                elif type(param_type) == list:
+                    fields_decoders.append(list_decoder(param_type[0]))
+                else:
+                    fields_decoders.append({str: str, int: int_decoder}.get(param_type, param_type))
+
+            return record_class, tuple(zip(params_names, fields_decoders))
+
+        for channel, messages in Protocol.s_messages.items():
+            Protocol.decoders[channel] = {opcode: compile_decoder(opcode_name, params)
+                                          for opcode, (opcode_name, params) in messages.items()}
+        for channel, messages in Protocol.c_messages.items():
+            Protocol.c_decoders[channel] = {opcode: compile_decoder(name, params)
+                                            for name, (opcode, params) in messages.items()}
+
+    @staticmethod
+    def unprotocol_msg(type: str, raw_message, decoders=None):
         """
         Deconstructs a message received from the server with the client-server's protocol
-        :param type: The type of the message (general, chat, file)
+        :param type: The type of the message (general, chat, files)
         :param raw_message: The message
-        :return: A dict with every parameter name as the key, and it's value as the value
+        :param decoders: The decoders of the messages (the decoders of the server's messages if not given)
+        :return: A record with every parameter of the message, read like a dict
+        :rtype: Message
         """
         # Split the message into it's fields with the field separator
         values = raw_message.split(Protocol.FIELD_SEPARATOR)
 
-        # Get the opcode of the message
-        opcode = int(values[0])
-        values = values[1:]
-
-        # The returned dict
-        ret = {}
-
-        params_names = []
-
-        # If the message was received in the general messages channel
-        if type == 'general':
-            # The first value in the dict is the opcode's name (opname)
-            opcode_name = Protocol.s_general_opcodes[opcode]
-            ret['opname'] = opcode_name
-            # Get the parameters names of the message
-            params_names = Protocol.s_opcodes_params[Protocol.s_general_opcodes[opcode]]
-
-        # If the message was received in the chat messages channel
-        elif type == 'chat':
-            # The first value in the dict is the opcode's name (opname)
-            opcode_name = Protocol.s_chat_opcodes[opcode]
-            ret['opname'] = opcode_name
-            # Get the parameters names of the message
-            params_names = Protocol.s_opcodes_params[Protocol.s_chat_opcodes[opcode]]
-
-        # If the message was received in the files messages channel
-        elif type == 'files':
-            # The first value in the dict is the opcode's name (opname)
-            opcode_name = Protocol.s_files_opcodes[opcode]
-            ret['opname'] = opcode_name
-            # Get the parameters names of the message
-            params_names = Protocol.s_opcodes_params[Protocol.s_files_opcodes[opcode]]
-
-        # Assign a value for each parameter in a dict
-        for i in range(len(values)):
-            value = values[i]
-            param_name = params_names[i]
-
-            # If the value is a list
-            if len(value.split(Protocol.LIST_SEPARATOR)) > 1:
-                # Check if the list is of integers
-                if value.split(Protocol.LIST_SEPARATOR)[0].isnumeric():
-                    ret[param_name] = [int(v) for v in value.split(Protocol.LIST_SEPARATOR)]
-                else:
-                    ret[param_name] = value.split(Protocol.LIST_SEPARATOR)
+        # Get the decoder of the message by it's opcode
+        record_class, fields = (decoders or Protocol.decoders)[type][int(values[0])]
+        record = record_class()
+
+        # Assign every field the server sent, converted to the type of it's parameter
+        for (param_name, decode), value in zip(fields, values[1:]):
+            setattr(record, param_name, value if decode is Protocol.BODY else decode(value))
+        return record
 
-            # If the value isn't a list
+    @staticmethod
+    def unprotocol_bytes(type: str, data, decoders=None):
+        """
+        Deconstructs a message received from the server as bytes (the files channel).
+        Only the header fields are scanned and decoded, the body is a view of the data, so it's neither copied nor
+        scanned for separators.
+        :param type: The type of the message (general, chat, files)
+        :param data: The message
+        :type data: bytes
+        :param decoders: The decoders of the messages (the decoders of the server's messages if not given)
+        :return: A record with every parameter of the message, read like a dict
+        :rtype: Message
+        """
+        end = data.find(Protocol.FIELD_SEPARATOR_BYTES)
+        record_class, fields = (decoders or Protocol.decoders)[type][int(data[:end] if end != -1 else data)]
+        record = record_class()
+
+        for param_name, decode in fields:
+            # No more fields
+            if end == -1:
+                break
+            start = end + 1
+
+            if decode is Protocol.BODY:
+                # The body spans the rest of the message
+                setattr(record, param_name, memoryview(data)[start:])
+                break
+
+            end = data.find(Protocol.FIELD_SEPARATOR_BYTES, start)
+            value = (data[start:end] if end != -1 else data[start:]).decode()
+            setattr(record, param_name, decode(value))
+        return record
+
+
+Protocol.compile_encoders()
+Protocol.compile_decoders()
+
+
+def _untyped_unprotocol_msg(type: str, raw_message):
+    """
+    The former decoder, guessing the types of the fields, kept as the baseline of the benchmark
+    :param type: The type of the message (general, chat, files)
+    :param raw_message: The message
+    :return: A dict with every parameter name as the key, and it's value as the value
+    """
+    values = raw_message.split(Protocol.FIELD_SEPARATOR)
+    opcode = int(values[0])
+    values = values[1:]
+    opcodes = {'general': Protocol.s_general_opcodes, 'chat': Protocol.s_chat_opcodes,
+               'files': Protocol.s_files_opcodes}[type]
+    ret = {'opname': opcodes[opcode]}
+    params_names = Protocol.s_opcodes_params[opcodes[opcode]]
+
+    for i in range(len(values)):
+        value = values[i]
+        param_name = params_names[i]
+        if len(value.split(Protocol.LIST_SEPARATOR)) > 1:
+            if value.split(Protocol.LIST_SEPARATOR)[0].isnumeric():
+                ret[param_name] = [int(v) for v in value.split(Protocol.LIST_SEPARATOR)]
             else:
-                # Check if the value is an integer
-                if value.isnumeric():
-                    ret[param_name] = int(value)
-                else:
-                    ret[param_name] = value
-        return ret
+                ret[param_name] = value.split(Protocol.LIST_SEPARATOR)
+        else:
+            if value.isnumeric():
+                ret[param_name] = int(value)
+            else:
+                ret[param_name] = value
+    return ret
+
+
+def _recorded_corpus():
+    """
+    Builds a corpus like the messages received when logging in with 100 chats and downloading a file
+    :return: A list of (type, message) pairs
+    """
+    import base64
+    import os
+
+    corpus = [('general', '01@2@1'),
+              ('general', '10@' + '#'.join(f'chat{i}' for i in range(100)) + '@' + '#'.join(map(str, range(100)))),
+              ('general', '15@' + '#'.join(map(str, range(100))) + '@' +
+               '#'.join(base64.b64encode(os.urandom(32)).decode() for _ in range(100)))]
+    for chat_id in range(100):
+        corpus.append(('general', f'11@{chat_id}@alice#bob#carol'))
+        corpus.append(('general', f'12@user{chat_id}@Online'))
+        page = '#'.join(base64.b64encode(f'1@{chat_id:03}@alice@{base64.b64encode(os.urandom(48)).decode()}@{i}'
+                                         .encode()).decode() for i in range(50))
+        corpus.append(('chat', f'03@{page}@{chat_id}@1@1'))
+    for i in range(200):
+        corpus.append(('chat', f'1@{i % 100:03}@bob@{base64.b64encode(os.urandom(64)).decode()}@{1000 + i}'))
+    for i in range(20):
+        corpus.append(('files', f'4@{"a" * 64}@{base64.b64encode(os.urandom(48 * 1024)).decode()}'))
+    return corpus
+
+
+def _benchmark(corpus_path=None, repeat=20):
+    """
+    Measures the time to decode a corpus of messages with the untyped decoder and the compiled decoders
+    :param corpus_path: A file with a recorded message per line, as its type and the message separated by a tab
+                        (a corpus like a login is built if not given)
+    :param repeat: The amount of times the corpus is decoded
+    :return: -
+    """
+    import time
+
+    if corpus_path:
+        with open(corpus_path) as corpus_file:
+            corpus = [tuple(line.rstrip('\n').split('\t', 1)) for line in corpus_file if line.strip()]
+    else:
+        corpus = _recorded_corpus()
+
+    for name, decode in (('untyped', _untyped_unprotocol_msg), ('compiled', Protocol.unprotocol_msg)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for type, raw_message in corpus:
+                decode(type, raw_message)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {len(corpus) * repeat / elapsed:.0f} messages/s ({elapsed / repeat * 1000:.2f}ms per corpus)')
+
+
+def _benchmark_encoders(repeat=100000):
+    """
+    Measures the time to construct messages by hand (like the builders did, as a str encoded when sent)
+    and with the compiled encoders (which take the base64 chunks as bytes)
+    :param repeat: The amount of times every message is constructed
+    :return: -
+    """
+    import time
+
+    chunk = b'A' * (64 * 1024)
+    by_hand = (lambda: f"{str(Protocol.general_opcodes['sign_in']).zfill(2)}{Protocol.FIELD_SEPARATOR}doron"
+                       f"{Protocol.FIELD_SEPARATOR}12323k".encode(),
+               lambda: f"{Protocol.chat_opcodes['text_message']}{Protocol.FIELD_SEPARATOR}{str(7).zfill(3)}"
+                       f"{Protocol.FIELD_SEPARATOR}doron{Protocol.FIELD_SEPARATOR}c2VjcmV0IG1lc3NhZ2U=".encode(),
+               lambda: f"{Protocol.files_opcodes['file_upload_chunk']}{Protocol.FIELD_SEPARATOR}7"
+                       f"{Protocol.FIELD_SEPARATOR}{chunk.decode()}".encode())
+    compiled = (lambda: Protocol.sign_in('doron', '12323k'),
+                lambda: Protocol.send_message('doron', 7, 'c2VjcmV0IG1lc3NhZ2U='),
+                lambda: Protocol.file_upload_chunk(7, chunk))
+
+    for (name, builders) in (('by hand', by_hand), ('compiled', compiled)):
+        for message_name, build in zip(('sign_in', 'text_message', 'file_upload_chunk'), builders):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                build()
+            elapsed = time.perf_counter() - start
+            print(f'{name} {message_name}: {elapsed / repeat * 10 ** 6:.2f}us per message')
 
 
 if __name__ == '__main__':
-    message = Protocol.register('doron', '12323k')
-    print(message)
+    _benchmark_encoders()
+    _benchmark()
 
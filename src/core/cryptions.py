@@ -1,7 +1,12 @@
 import base64
+import concurrent.futures
 import hashlib
+import threading
+import time
+from collections import OrderedDict
 from Cryptodome.PublicKey import RSA
 from Cryptodome.Cipher import PKCS1_v1_5, AES
+from Cryptodome.Util.strxor import strxor
 import os
 
 
@@ -11,11 +16,16 @@ class RSACipher:
     """
     KEY_SIZE = 1024*2
 
-    def __init__(self):
+    def __init__(self, key=None):
         """
         Creates an ASYM object for encryption and decryption
+        :param key: A pre-generated key (an RsaKey or its DER/PEM export), a new key is generated if not given
         """
-        self.RSA_key = RSA.generate(RSACipher.KEY_SIZE)
+        if key is None:
+            key = RSA.generate(RSACipher.KEY_SIZE)
+        elif type(key) == bytes:
+            key = RSA.import_key(key)
+        self.RSA_key = key
         self.RSA_cipher = PKCS1_v1_5.new(self.RSA_key)
 
     @staticmethod
@@ -58,12 +68,79 @@ class RSACipher:
         return RSA.import_key(key)
 
 
+def _generate_rsa_key():
+    """
+    Generates a new RSA key (runs in the key pool's worker processes)
+    :return: The DER export of the key
+    :rtype: bytes
+    """
+    return RSA.generate(RSACipher.KEY_SIZE).export_key('DER')
+
+
+class RSAKeyPool:
+    """
+    A pool of RSA keys which are generated in worker processes ahead of demand,
+    so connecting and reconnecting don't block on the key generation
+    """
+
+    def __init__(self, size=3, reuse=False):
+        """
+        Creates a new key pool and starts generating its keys
+        :param size: The amount of keys to keep generated ahead
+        :param reuse: Whether to hand out one key pair for the whole session instead of a fresh one every time
+        """
+        self.size = size
+        self.reuse = reuse
+        self._session_cipher = None
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(size, os.cpu_count() or 1)))
+        # The keys being generated, in the order they were requested
+        self._pending = [self._executor.submit(_generate_rsa_key) for _ in range(1 if reuse else size)]
+
+    def get(self) -> RSACipher:
+        """
+        Returns an RSACipher with a pre-generated key, waiting only if no key is ready yet
+        :return: The RSA cipher
+        """
+        with self._lock:
+            if self.reuse:
+                # Every caller shares the single key pair of the session
+                if self._session_cipher is None:
+                    self._session_cipher = RSACipher(self._pending[0].result())
+                return self._session_cipher
+
+            # Take the oldest key and request a new one in its place
+            future = self._pending.pop(0)
+            self._pending.append(self._executor.submit(_generate_rsa_key))
+
+        return RSACipher(future.result())
+
+    def shutdown(self):
+        """
+        Stops the worker processes of the pool
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
 class AESCipher:
     """
     A class for encrypting and decrypting using AES
     """
     BLOCK_SIZE = 16
 
+    @staticmethod
+    def key_bytes(key):
+        """
+        Returns the bytes of the given key, keys which are already encoded are returned as is.
+        :param key: the key
+        :type key: str or bytes
+        :return: the bytes of the key
+        :rtype: bytes
+        """
+        if type(key) == bytes:
+            return key
+        return key.encode("UTF-8")
+
     @staticmethod
     def pad(byte_array):
         """
@@ -93,7 +170,7 @@ class AESCipher:
         """
         Encrypts the given message using the specified key and returns the encrypted message in base64-encoded form.
         :param key: the encryption key to use
-        :type key: str
+        :type key: str or bytes
         :param message: the message to encrypt
         :type message: str
         :return: the base64-encoded encrypted message
@@ -106,7 +183,7 @@ class AESCipher:
         # generate a random iv and prepend that to the encrypted result.
         # The recipient then needs to unpack the iv and use it.
         iv = os.urandom(AES.block_size)
-        cipher = AES.new(key.encode("UTF-8"), AES.MODE_CBC, iv)
+        cipher = AES.new(AESCipher.key_bytes(key), AES.MODE_CBC, iv)
         encrypted = cipher.encrypt(padded)
         # Note we PREPEND the unencrypted iv to the encrypted message
         return base64.b64encode(iv + encrypted).decode("UTF-8")
@@ -116,7 +193,7 @@ class AESCipher:
         """
         Encrypts the given file contents using the specified key and returns the encrypted contents in base64-encoded form.
         :param key: the encryption key to use
-        :type key: str
+        :type key: str or bytes
         :param contents: the contents of the file to encrypt
         :type contents: bytes
         :return: the base64-encoded encrypted file contents
@@ -127,7 +204,7 @@ class AESCipher:
         # generate a random iv and prepend that to the encrypted result.
         # The recipient then needs to unpack the iv and use it.
         iv = os.urandom(AES.block_size)
-        cipher = AES.new(key.encode("UTF-8"), AES.MODE_CBC, iv)
+        cipher = AES.new(AESCipher.key_bytes(key), AES.MODE_CBC, iv)
         encrypted = cipher.encrypt(padded)
         # Note we PREPEND the unencrypted iv to the encrypted message
         return iv + encrypted
@@ -138,7 +215,7 @@ class AESCipher:
         Decrypts a given message using the provided key.
 
         :param key: The key used to decrypt the message.
-        :type key: str
+        :type key: str or bytes
         :param message: The message to be decrypted.
         :type message: str
         :return: The decrypted message.
@@ -154,7 +231,7 @@ class AESCipher:
         messagebytes = byte_array[16:]
 
         # create a new AES cipher with the provided key and iv, in CBC mode
-        cipher = AES.new(key.encode("UTF-8"), AES.MODE_CBC, iv)
+        cipher = AES.new(AESCipher.key_bytes(key), AES.MODE_CBC, iv)
 
         # decrypt the message bytes
         decrypted_padded = cipher.decrypt(messagebytes)
@@ -171,12 +248,14 @@ class AESCipher:
         Decrypts the contents of a file using the provided key.
 
         :param key: The key used to decrypt the file.
-        :type key: str
+        :type key: str or bytes
         :param contents: The contents of the encrypted file.
         :type contents: bytes
         :return: The decrypted contents of the file.
         :rtype: bytes
         """
+        # Slice the contents without copying them
+        contents = memoryview(contents)
 
         # extract the 16-byte initialization vector from the byte array
         iv = contents[0:16]
@@ -185,7 +264,7 @@ class AESCipher:
         messagebytes = contents[16:]
 
         # create a new AES cipher with the provided key and iv, in CBC mode
-        cipher = AES.new(key.encode("UTF-8"), AES.MODE_CBC, iv)
+        cipher = AES.new(AESCipher.key_bytes(key), AES.MODE_CBC, iv)
 
         # decrypt the message bytes
         decrypted_padded = cipher.decrypt(messagebytes)
@@ -204,3 +283,317 @@ class AESCipher:
         """
         return hashlib.sha256(os.urandom(32)).hexdigest()[:32]
 
+
+class AEADCipher:
+    """
+    A class for authenticated encryption and decryption using AES-GCM.
+    Has the same bytes interface as AESCipher so it can replace it for the calls and the binary framing.
+    """
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+
+    @staticmethod
+    def encrypt_bytes(key, contents: bytes, associated_data: bytes = None):
+        """
+        Encrypts and authenticates the given contents using the specified key.
+        :param key: the encryption key to use
+        :type key: str or bytes
+        :param contents: the contents to encrypt
+        :type contents: bytes
+        :param associated_data: data which is authenticated but not encrypted
+        :type associated_data: bytes
+        :return: the nonce, the encrypted contents and the authentication tag
+        :rtype: bytes
+        """
+        nonce = os.urandom(AEADCipher.NONCE_SIZE)
+        cipher = AES.new(AESCipher.key_bytes(key), AES.MODE_GCM, nonce=nonce, mac_len=AEADCipher.TAG_SIZE)
+        if associated_data:
+            cipher.update(associated_data)
+        encrypted, tag = cipher.encrypt_and_digest(contents)
+        # Note we PREPEND the nonce and APPEND the tag to the encrypted contents
+        return nonce + encrypted + tag
+
+    @staticmethod
+    def decrypt_bytes(key, contents: bytes, associated_data: bytes = None):
+        """
+        Decrypts the given contents using the specified key, and verifies their authentication tag.
+        Raises a ValueError if the contents were tampered with.
+        :param key: the key used to encrypt the contents
+        :type key: str or bytes
+        :param contents: the nonce, the encrypted contents and the authentication tag
+        :type contents: bytes
+        :param associated_data: the data which was authenticated with the contents
+        :type associated_data: bytes
+        :return: the decrypted contents
+        :rtype: bytes
+        """
+        # Slice the contents without copying them
+        contents = memoryview(contents)
+        nonce = contents[:AEADCipher.NONCE_SIZE]
+        encrypted = contents[AEADCipher.NONCE_SIZE:-AEADCipher.TAG_SIZE]
+        tag = contents[-AEADCipher.TAG_SIZE:]
+
+        cipher = AES.new(AESCipher.key_bytes(key), AES.MODE_GCM, nonce=nonce, mac_len=AEADCipher.TAG_SIZE)
+        if associated_data:
+            cipher.update(associated_data)
+        return cipher.decrypt_and_verify(encrypted, tag)
+
+    @staticmethod
+    def encrypt(key, message):
+        """
+        Encrypts the given message and returns it in base64-encoded form.
+        :param key: the encryption key to use
+        :type key: str or bytes
+        :param message: the message to encrypt
+        :type message: str
+        :return: the base64-encoded encrypted message
+        :rtype: str
+        """
+        return base64.b64encode(AEADCipher.encrypt_bytes(key, message.encode("UTF-8"))).decode("UTF-8")
+
+    @staticmethod
+    def decrypt(key, message):
+        """
+        Decrypts a base64-encoded message and verifies it.
+        :param key: the key used to encrypt the message
+        :type key: str or bytes
+        :param message: the base64-encoded encrypted message
+        :type message: str
+        :return: the decrypted message
+        :rtype: str
+        """
+        return AEADCipher.decrypt_bytes(key, base64.b64decode(message)).decode("UTF-8")
+
+    @staticmethod
+    def new_encryptor(key):
+        """
+        Creates an incremental encryptor, for contents which are encrypted in chunks.
+        Call encrypt(chunk) for every chunk and digest() at the end to get the authentication tag.
+        :param key: the encryption key to use
+        :type key: str or bytes
+        :return: the nonce and the encryptor
+        :rtype: tuple(bytes, object)
+        """
+        nonce = os.urandom(AEADCipher.NONCE_SIZE)
+        return nonce, AES.new(AESCipher.key_bytes(key), AES.MODE_GCM, nonce=nonce, mac_len=AEADCipher.TAG_SIZE)
+
+    @staticmethod
+    def new_decryptor(key, nonce: bytes):
+        """
+        Creates an incremental decryptor, for contents which are decrypted in chunks.
+        Call decrypt(chunk) for every chunk and verify(tag) at the end, which raises a ValueError if the
+        contents were tampered with.
+        :param key: the key used to encrypt the contents
+        :type key: str or bytes
+        :param nonce: the nonce of the encryptor
+        :type nonce: bytes
+        :return: the decryptor
+        :rtype: object
+        """
+        return AES.new(AESCipher.key_bytes(key), AES.MODE_GCM, nonce=nonce, mac_len=AEADCipher.TAG_SIZE)
+
+
+# The ciphers which can be used for the calls and the binary framing
+CIPHERS = {
+    'cbc': AESCipher,
+    'gcm': AEADCipher
+}
+
+
+def negotiate_cipher(ciphers):
+    """
+    Chooses the cipher of a call, GCM only if every member of the call advertised it and CBC otherwise
+    :param ciphers: The names of the ciphers the members of the call advertised, None for members which didn't
+    advertise one (older clients and servers)
+    :type ciphers: list
+    :return: The cipher
+    :rtype: type
+    """
+    if ciphers and all(cipher == 'gcm' for cipher in ciphers):
+        return AEADCipher
+    return AESCipher
+
+
+class CipherContext:
+    """
+    A cipher bound to a single key, for the hot paths (call packets, chat messages) which encrypt and decrypt
+    many times with the same key. The contexts are cached per key and cipher.
+    A CBC context keeps the expanded AES key schedule in an ECB cipher object, and decrypts with it: CBC decryption
+    is P[i] = D(C[i]) ^ C[i - 1], so every block is decrypted at once and xored with the ciphertext shifted by a
+    block, instead of creating a new CBC cipher (and expanding the key again) for every packet.
+    CBC encryption chains the blocks, and GCM binds its state to the nonce, so they still create a cipher per packet.
+    """
+    # The most recently used contexts, where the key is a tuple of the key's bytes and the cipher
+    _contexts = OrderedDict()
+    _contexts_lock = threading.Lock()
+    # The most amount of cached contexts, the least recently used contexts are dropped
+    MAX_CONTEXTS = 256
+
+    def __init__(self, key, cipher=AESCipher):
+        """
+        Creates a new cipher context
+        :param key: the key of the context
+        :type key: str or bytes
+        :param cipher: the cipher to use (AESCipher or AEADCipher)
+        :type cipher: type
+        """
+        self.key = AESCipher.key_bytes(key)
+        self.cipher = cipher
+        # The expanded key schedule, an ECB cipher object holds no state besides it so it's reused by every packet
+        self._block_cipher = AES.new(self.key, AES.MODE_ECB) if cipher is AESCipher else None
+
+    @staticmethod
+    def get(key, cipher=AESCipher):
+        """
+        Returns the cached context of the given key and cipher, creating it if needed
+        :param key: the key of the context
+        :type key: str or bytes
+        :param cipher: the cipher to use
+        :type cipher: type
+        :return: the context
+        :rtype: CipherContext
+        """
+        cached = (AESCipher.key_bytes(key), cipher)
+        with CipherContext._contexts_lock:
+            context = CipherContext._contexts.get(cached)
+            if context is not None:
+                CipherContext._contexts.move_to_end(cached)
+                return context
+
+        context = CipherContext(key, cipher)
+        with CipherContext._contexts_lock:
+            CipherContext._contexts[cached] = context
+            while len(CipherContext._contexts) > CipherContext.MAX_CONTEXTS:
+                CipherContext._contexts.popitem(last=False)
+        return context
+
+    @staticmethod
+    def evict(key):
+        """
+        Drops the cached contexts of a key which is no longer used (e.g. the key of a call which ended)
+        :param key: the key of the contexts
+        :type key: str or bytes
+        :return: None
+        """
+        key = AESCipher.key_bytes(key)
+        with CipherContext._contexts_lock:
+            for cached in [cached for cached in CipherContext._contexts if cached[0] == key]:
+                del CipherContext._contexts[cached]
+
+    @staticmethod
+    def clear():
+        """
+        Drops all the cached contexts (e.g. on logout)
+        :return: None
+        """
+        with CipherContext._contexts_lock:
+            CipherContext._contexts.clear()
+
+    def encrypt_bytes(self, contents: bytes):
+        """
+        Encrypts the given contents with the key of the context
+        :param contents: the contents to encrypt
+        :type contents: bytes
+        :return: the encrypted contents
+        :rtype: bytes
+        """
+        return self.cipher.encrypt_bytes(self.key, contents)
+
+    def decrypt_bytes(self, contents: bytes):
+        """
+        Decrypts the given contents with the key of the context
+        :param contents: the encrypted contents
+        :type contents: bytes
+        :return: the decrypted contents
+        :rtype: bytes
+        """
+        if self._block_cipher is None:
+            return self.cipher.decrypt_bytes(self.key, contents)
+
+        # Slice the contents without copying them, the iv is the "ciphertext" before the first block
+        contents = memoryview(contents)
+        if len(contents) <= AES.block_size or len(contents) % AES.block_size:
+            raise ValueError('Data must be padded to 16 byte boundary in CBC mode')
+        decrypted_padded = strxor(self._block_cipher.decrypt(contents[AES.block_size:]), contents[:-AES.block_size])
+        return AESCipher.unpad(decrypted_padded)
+
+    def encrypt(self, message):
+        """
+        Encrypts the given message with the key of the context
+        :param message: the message to encrypt
+        :type message: str
+        :return: the base64-encoded encrypted message
+        :rtype: str
+        """
+        return self.cipher.encrypt(self.key, message)
+
+    def decrypt(self, message):
+        """
+        Decrypts the given base64-encoded message with the key of the context
+        :param message: the encrypted message
+        :type message: str
+        :return: the decrypted message
+        :rtype: str
+        """
+        return self.decrypt_bytes(base64.b64decode(message)).decode("UTF-8")
+
+
+def _benchmark(total_size=32 * 1024 * 1024):
+    """
+    Compares the throughput of the CBC and GCM ciphers for audio chunks, video frames and file sized packets
+    :param total_size: The amount of bytes to encrypt and decrypt for every packet size
+    :return: -
+    """
+    key = AESCipher.generate_key()
+    print(f'{"packet":>10} {"cipher":>7} {"encrypt MB/s":>13} {"decrypt MB/s":>13}')
+    for packet_size in (4 * 1024, 64 * 1024, 4 * 1024 * 1024):
+        packet = os.urandom(packet_size)
+        iterations = max(total_size // packet_size, 1)
+        for name, cipher in CIPHERS.items():
+            start = time.perf_counter()
+            for _ in range(iterations):
+                encrypted = cipher.encrypt_bytes(key, packet)
+            encrypt_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                cipher.decrypt_bytes(key, encrypted)
+            decrypt_time = time.perf_counter() - start
+
+            megabytes = iterations * packet_size / (1024 * 1024)
+            print(f'{packet_size:>10} {name:>7} {megabytes / encrypt_time:>13.1f} {megabytes / decrypt_time:>13.1f}')
+
+
+def _benchmark_contexts(duration=1.0):
+    """
+    Compares the packets per second of encrypting and decrypting with a key string on every call
+    and with a cached cipher context, for audio chunks and video frames
+    :param duration: The amount of seconds to run every measurement
+    :return: -
+    """
+    key = AESCipher.generate_key()
+    print(f'{"packet":>10} {"cipher":>7} {"per call pkt/s":>15} {"context pkt/s":>14}')
+    for packet_size in (8 * 1024, 64 * 1024):
+        packet = os.urandom(packet_size)
+        for name, cipher in CIPHERS.items():
+            packets = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                cipher.decrypt_bytes(key, cipher.encrypt_bytes(key, packet))
+                packets += 1
+            per_call_rate = packets / (time.perf_counter() - start)
+
+            packets = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                context = CipherContext.get(key, cipher)
+                context.decrypt_bytes(context.encrypt_bytes(packet))
+                packets += 1
+            context_rate = packets / (time.perf_counter() - start)
+
+            print(f'{packet_size:>10} {name:>7} {per_call_rate:>15.0f} {context_rate:>14.0f}')
+
+
+if __name__ == '__main__':
+    _benchmark()
+    _benchmark_contexts()
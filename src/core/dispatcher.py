@@ -0,0 +1,76 @@
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class OrderedExecutor:
+    """
+    Runs tasks on a pool of worker threads, where the tasks of the same key run one after the other,
+    in the order they were submitted, and the tasks of different keys run in parallel.
+    """
+
+    def __init__(self, max_workers=None):
+        """
+        Creates the pool of workers, the threads are started when tasks are submitted.
+
+        :param max_workers: The maximum amount of worker threads (chosen by the executor if not given).
+        :type max_workers: int
+        """
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='dispatch')
+        self.lock = threading.Lock()
+        # The tasks waiting for the running task of their key, where the key is the key of the tasks
+        self.pending = {}
+
+    def submit(self, key, fn, *args):
+        """
+        Runs a task after the tasks of its key which were already submitted.
+
+        :param key: The key of the task (e.g. the id of its chat).
+        :param fn: The function of the task.
+        :type fn: function
+        :param args: The arguments of the function.
+        :return: None
+        """
+        with self.lock:
+            tasks = self.pending.get(key)
+            # A task of the key is running, its worker runs this task when it's done
+            if tasks is not None:
+                tasks.append((fn, args))
+                return
+            self.pending[key] = deque()
+
+        self.executor.submit(self._run, key, fn, args)
+
+    def _run(self, key, fn, args):
+        """
+        Runs a task and then the tasks of its key which were submitted meanwhile.
+
+        :param key: The key of the tasks.
+        :param fn: The function of the first task.
+        :type fn: function
+        :param args: The arguments of the function.
+        :type args: tuple
+        :return: None
+        """
+        while True:
+            try:
+                fn(*args)
+            except Exception:
+                # A failed task doesn't stop the tasks after it
+                traceback.print_exc()
+
+            with self.lock:
+                tasks = self.pending[key]
+                if not tasks:
+                    del self.pending[key]
+                    return
+                fn, args = tasks.popleft()
+
+    def shutdown(self):
+        """
+        Stops the workers after the submitted tasks.
+
+        :return: None
+        """
+        self.executor.shutdown(wait=False)
@@ -1,8 +1,10 @@
 import hashlib
 import os
+import threading
+from collections import OrderedDict
 
 import rsa
-from src.core.cryptions import AESCipher, RSACipher
+from src.core.cryptions import AESCipher, RSACipher, CipherContext
 
 
 class KeysManager:
@@ -13,28 +15,40 @@ class KeysManager:
     # chats_keys: a dictionary that will store the keys for each chat
     chats_keys = {}
     last_password = None
+    # The messages of chats whose key didn't arrive yet by chat id, handled again once the key is added.
+    # The lock is held while they are handled again (by handlers which take it again), so no newer message of the
+    # chat is handled before them
+    awaiting_key = {}
+    awaiting_key_lock = threading.RLock()
+
+    # The decrypted text messages by their chat id and message id, so no message is decrypted twice,
+    # the least recently used messages are dropped
+    decrypted_messages = OrderedDict()
+    decrypted_messages_lock = threading.Lock()
+    MAX_DECRYPTED_MESSAGES = 10000
 
     @staticmethod
-    def load_keys(keys: list, chat_ids: list, password: str):
+    def load_keys(keys: list, chat_ids: list, password=None):
         """
         Loads the keys of the chats.
         :param keys: The keys of the chats.
         :type keys: list
         :param chat_ids: The chat_ids of the chats.
         :type chat_ids: list
-        :param password: The password of the user.
+        :param password: The password of the user, kept as it is if not given.
         :type password: str
-        :return: -
+        :return: The ids of the chats which have messages waiting for their keys, see replay_held.
+        :rtype: list
         """
-
-        password = password.ljust(32, '0')
+        held = []
         for i in range(len(keys)):
-            key = keys[i]
-            chat_id = chat_ids[i]
-            KeysManager.chats_keys[chat_id] = key
+            if KeysManager.add_key(chat_ids[i], keys[i]):
+                held.append(chat_ids[i])
 
-        # Sets the last_password attribute to the given password.
-        KeysManager.last_password = password
+        if password is not None:
+            # Sets the last_password attribute to the given password.
+            KeysManager.last_password = password.ljust(32, '0')
+        return held
 
     @staticmethod
     def get_chat_key(chat_id) -> str:
@@ -51,6 +65,47 @@ class KeysManager:
 
         return KeysManager.chats_keys[chat_id]
 
+    @staticmethod
+    def get_chat_context(chat_id) -> CipherContext:
+        """
+        Returns the cached cipher context of a given chat_id's key.
+        :param chat_id: An integer representing the chat_id.
+        :type chat_id: int
+        :return: The cipher context of the chat's key.
+        :rtype: CipherContext
+        """
+        return CipherContext.get(KeysManager.get_chat_key(chat_id))
+
+    @staticmethod
+    def decrypt_message(chat_id: int, message: str, message_id=None) -> str:
+        """
+        Decrypts a text message of a chat, messages with an id are decrypted only once.
+        :param chat_id: The id of the chat the message was sent to.
+        :type chat_id: int
+        :param message: The encrypted message.
+        :type message: str
+        :param message_id: The id of the message, if the server sent it.
+        :type message_id: int
+        :return: The decrypted message.
+        :rtype: str
+        """
+        if message_id is None:
+            return KeysManager.get_chat_context(chat_id).decrypt(message)
+
+        key = (chat_id, message_id)
+        with KeysManager.decrypted_messages_lock:
+            text = KeysManager.decrypted_messages.get(key)
+            if text is not None:
+                KeysManager.decrypted_messages.move_to_end(key)
+                return text
+
+        text = KeysManager.get_chat_context(chat_id).decrypt(message)
+        with KeysManager.decrypted_messages_lock:
+            KeysManager.decrypted_messages[key] = text
+            if len(KeysManager.decrypted_messages) > KeysManager.MAX_DECRYPTED_MESSAGES:
+                KeysManager.decrypted_messages.popitem(last=False)
+        return text
+
     @staticmethod
     def add_key(chat_id: int, key):
         """
@@ -60,9 +115,49 @@ class KeysManager:
         :type chat_id: int
         :param key: the key to add
         :type key: str
+        :return: whether messages of the chat wait for its key, which have to be handled with replay_held
+        :rtype: bool
+        """
+        with KeysManager.awaiting_key_lock:
+            KeysManager.chats_keys[chat_id] = key
+            # The messages stay held (and the newer messages are held after them) until they are handled again
+            return chat_id in KeysManager.awaiting_key
+
+    @staticmethod
+    def hold_until_key(chat_id: int, message) -> bool:
+        """
+        Holds a message of a chat whose key didn't arrive yet (the keys arrive on another channel than the messages),
+        or which has older messages waiting, until the key is added.
+
+        :param chat_id: the id of the chat of the message
+        :type chat_id: int
+        :param message: the message, handled by replay_held once the key is added
+        :return: whether the message was held
+        :rtype: bool
+        """
+        with KeysManager.awaiting_key_lock:
+            if chat_id in KeysManager.chats_keys and chat_id not in KeysManager.awaiting_key:
+                return False
+            KeysManager.awaiting_key.setdefault(chat_id, []).append(message)
+            return True
+
+    @staticmethod
+    def replay_held(chat_id: int, handler):
+        """
+        Handles the messages of a chat which waited for its key, in the order they arrived.
+        The lock is held meanwhile, so a newer message of the chat is either held after them or handled after them.
+
+        :param chat_id: the id of the chat
+        :type chat_id: int
+        :param handler: the function handling every message, called with the message
+        :type handler: function
         :return: None
         """
-        KeysManager.chats_keys[chat_id] = key
+        with KeysManager.awaiting_key_lock:
+            if chat_id not in KeysManager.chats_keys:
+                return
+            for message in KeysManager.awaiting_key.pop(chat_id, []):
+                handler(message)
 
 
 class OldKeysManager:
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import re
 from pathlib import Path
@@ -14,17 +15,19 @@ import socket
 import subprocess
 import ipaddress
 import concurrent.futures
+import traceback
 
 # Add the project folder to PYTHONPATH
 project_dir = str(Path(os.path.abspath(__file__)).parent.parent.parent)
 sys.path.insert(0, project_dir)
 
-from src.core.cryptions import AESCipher
-from src.core.client_com import ClientCom
+from src.core.cryptions import AESCipher, RSAKeyPool
+from src.core.client_com import ClientCom, AsyncClientCom
 from src.core.client_protocol import Protocol
+from src.core.dispatcher import OrderedExecutor
 from src.core.keys_manager import KeysManager
 from src.handlers.file_handler import FileHandler
-from src.gui.main_gui import MainFrame
+from src.handlers.message_store import MessageStore
 import config
 
 
@@ -51,7 +54,8 @@ def handle_added_to_group(message):
     group_name = message['group_name']
     chat_id = message['chat_id']
     group_key = message['group_key']
-    KeysManager.add_key(chat_id, group_key)
+    if KeysManager.add_key(chat_id, group_key):
+        handle_held_messages([chat_id])
     wx.CallAfter(pub.sendMessage, 'added_to_group', group_name=group_name, chat_id=chat_id)
 
 
@@ -78,8 +82,18 @@ def handle_text_message(message):
     """
     sender = message['sender']
     chat_id = message['chat_id']
-    raw_message = message['message']
-    wx.CallAfter(pub.sendMessage, 'text_message', sender=sender, chat_id=chat_id, raw_message=raw_message)
+    # The key of a new chat may still be on its way on the general channel
+    if KeysManager.hold_until_key(chat_id, message):
+        return
+    # Decrypt the message before it gets to the GUI thread
+    try:
+        message = MessageStore.decrypted(message)
+    except Exception:
+        return
+
+    MessageStore.store_new_message(chat_id, message)
+    wx.CallAfter(pub.sendMessage, 'text_message', sender=sender, chat_id=chat_id, message=message['text'],
+                 message_id=message.get('message_id'))
 
 
 def handle_user_pic(message):
@@ -88,6 +102,8 @@ def handle_user_pic(message):
     """
     username = message['pfp_username']
     contents = base64.b64decode(message['image_contents'])
+    # Save the picture off the GUI thread, the GUI only reloads it
+    FileHandler.save_pfp(contents, username)
     wx.CallAfter(pub.sendMessage, 'user_pic', contents=contents, username=username)
 
 
@@ -98,6 +114,8 @@ def handle_friend_added(message):
     friend_username = message['friend_username']
     friends_key = message['friends_key']
     chat_id = message['chat_id']
+    if KeysManager.add_key(chat_id, friends_key):
+        handle_held_messages([chat_id])
     wx.CallAfter(pub.sendMessage, 'friend_added', friend_username=friend_username, friends_key=friends_key,
                  chat_id=chat_id)
 
@@ -107,12 +125,7 @@ def update_chats(message):
     :param message: The message received from the server.
     """
     chats_names = message['chats_names']
-    if type(chats_names) != list:
-        chats_names = [chats_names]
-
     chats_ids = message['chats_ids']
-    if type(chats_ids) != list:
-        chats_ids = [chats_ids]
 
     chats = [(chats_ids[i], chats_names[i]) for i in range(0, len(chats_ids))]
     wx.CallAfter(pub.sendMessage, 'chats_list', chats=chats)
@@ -124,8 +137,6 @@ def update_group_members(message):
     """
     chat_id = message['chat_id']
     usernames = message['usernames']
-    if type(usernames) != list:
-        usernames = [usernames]
     wx.CallAfter(pub.sendMessage, 'group_members', chat_id=chat_id, usernames=usernames)
 
 
@@ -147,47 +158,129 @@ def handle_file_description(message):
     file_size = message['file_size']
     sender = message['sender']
     file_hash = message['file_hash']
+    # The key of a new chat may still be on its way on the general channel
+    if KeysManager.hold_until_key(chat_id, message):
+        return
+    MessageStore.store_new_message(chat_id, MessageStore.decrypted(message))
     wx.CallAfter(pub.sendMessage, 'file_description', chat_id=chat_id, file_name=file_name,
-                 file_size=file_size, sender=sender, file_hash=file_hash)
+                 file_size=file_size, sender=sender, file_hash=file_hash, message_id=message.get('message_id'))
 
 
 def handle_file_in_chat(message):
+    """
+    Handles a whole file sent by servers without streamed downloads
+    :param message: The message received from the server.
+    """
+    chat_id = message['chat_id']
+    file_name = message['file_name']
+    # Find the download registered when the user chose where to save the file, the message carries no hash
+    # so two pending downloads of the same name in the chat can't be told apart
+    downloads = [d for d in list(FileHandler.downloads.values())
+                 if d.chat_id == chat_id and d.file_name == file_name and not d.temp_file]
+    if len(downloads) != 1:
+        return
+    download = downloads[0]
+
+    FileHandler.remove_download(download.file_hash)
+    # Decrypt the file contents using the chat key, without decoding them into a str
+    file_contents_b64 = AESCipher.decrypt_bytes(KeysManager.get_chat_key(chat_id),
+                                                base64.b64decode(message['file_contents']))
+    # B64 decode the contents
+    file_contents = base64.b64decode(file_contents_b64)
+    # Save the file using the FileHandler
+    FileHandler.save_file(file_contents, download.path)
+    wx.CallAfter(pub.sendMessage, 'file_downloaded', file_hash=download.file_hash, path=download.path)
+
+
+def handle_file_download_start(message):
     """
     :param message: The message received from the server.
     """
-    # Show a dialog to select the location to save the file
-    dialog = wx.FileDialog(None, message="Save file", defaultDir="", defaultFile=message['file_name'],
-                           wildcard="All files (*.*)|*.*", style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
-    if dialog.ShowModal() == wx.ID_OK:
-        chat_id = message['chat_id']
-        # Get the path of the selected file
-        file_path = dialog.GetPath()
-        # Decrypt the file contents using the chat key
-        file_contents_b64 = AESCipher.decrypt(KeysManager.get_chat_key(chat_id), message['file_contents'])
-        # B64 decode the contents
-        file_contents = base64.b64decode(file_contents_b64)
-        # Save the file using the FileHandler
-        FileHandler.save_file(file_contents, file_path)
+    file_hash = message['file_hash']
+    download = FileHandler.get_download(file_hash)
+    if download:
+        download.start(message['file_size'])
+        wx.CallAfter(pub.sendMessage, 'file_progress', file_hash=file_hash, bytes_received=0,
+                     file_size=download.file_size)
+
 
-    dialog.Destroy()
+def handle_file_download_chunk(message):
+    """
+    :param message: The message received from the server.
+    """
+    file_hash = message['file_hash']
+    download = FileHandler.get_download(file_hash)
+    if download and download.temp_file:
+        try:
+            # Decrypt the chunk using the chat key and write it straight to the disk
+            enc_chunk = base64.b64decode(message['chunk'])
+            download.write_chunk(KeysManager.get_chat_context(download.chat_id).decrypt_bytes(enc_chunk), enc_chunk)
+        except Exception:
+            # Drop the partial file
+            FileHandler.remove_download(file_hash)
+            download.abort()
+            wx.CallAfter(pub.sendMessage, 'file_download_failed', file_hash=file_hash)
+            return
+
+        wx.CallAfter(pub.sendMessage, 'file_progress', file_hash=file_hash, bytes_received=download.bytes_received,
+                     file_size=download.file_size)
+
+
+def handle_file_download_end(message):
+    """
+    :param message: The message received from the server.
+    """
+    file_hash = message['file_hash']
+    download = FileHandler.remove_download(file_hash)
+    if download and download.temp_file:
+        try:
+            # Move the complete file to its destination, a cut or corrupted file is dropped
+            if not download.verify():
+                raise ValueError('Incomplete download')
+            download.finish()
+        except (ValueError, OSError):
+            download.abort()
+            wx.CallAfter(pub.sendMessage, 'file_download_failed', file_hash=file_hash)
+            return
+        wx.CallAfter(pub.sendMessage, 'file_downloaded', file_hash=file_hash, path=download.path)
 
 
 def handle_chat_history(message):
     """
     :param message: The message received from the server.
     """
-    if type(message['messages']) != list:
-        messages = [message['messages']]
-    else:
-        messages = message['messages']
+    # The key of a new chat may still be on its way on the general channel
+    if KeysManager.hold_until_key(message['chat_id'], message):
+        return
 
     messages_params = []
-    for msg in messages:
+    for msg in message['messages']:
+        # An empty page has no messages
+        if not msg:
+            continue
         msg = base64.b64decode(msg.encode()).decode()
-        msg_params = Protocol.unprotocol_msg('chat', msg)
-        messages_params.append(msg_params)
-    
-    wx.CallAfter(pub.sendMessage, 'chat_history', messages=messages_params, chat_id=message['chat_id'])
+        # Decrypt the messages before they get to the GUI thread
+        try:
+            messages_params.append(MessageStore.decrypted(Protocol.unprotocol_msg('chat', msg)))
+        except Exception:
+            pass
+
+    # The pages are stored by the GUI, which knows whether they join up with the stored messages
+
+    # Servers without pagination send the whole history, without a cursor for an older page
+    wx.CallAfter(pub.sendMessage, 'chat_history', messages=messages_params, chat_id=message['chat_id'],
+                 oldest_id=message.get('oldest_id'), has_more=bool(message.get('has_more', 0)))
+
+
+def handle_bootstrap(message):
+    """
+    Handles the members and statuses of all the chats, sent together after the chats list when logging in
+    :param message: The message received from the server.
+    """
+    for msg in message['messages']:
+        if msg:
+            # Every message is a general message of its own (e.g. group members or a user status)
+            handle_general_message(base64.b64decode(msg.encode()).decode())
 
 
 def handle_voice_info(message):
@@ -197,12 +290,9 @@ def handle_voice_info(message):
     chat_id = message['chat_id']
     ips = message['ips']
     usernames = message['usernames']
-
-    if type(ips) != list:
-        ips = [ips]
-        usernames = [usernames]
-
-    wx.CallAfter(pub.sendMessage, 'voice_info', chat_id=chat_id, ips=ips, usernames=usernames)
+    # The ciphers the call members advertised, missing if the server doesn't relay them
+    ciphers = message.get('ciphers')
+    wx.CallAfter(pub.sendMessage, 'voice_info', chat_id=chat_id, ips=ips, usernames=usernames, ciphers=ciphers)
 
 
 def handle_video_info(message):
@@ -212,12 +302,9 @@ def handle_video_info(message):
     chat_id = message['chat_id']
     ips = message['ips']
     usernames = message['usernames']
-
-    if type(ips) != list:
-        ips = [ips]
-        usernames = [usernames]
-
-    wx.CallAfter(pub.sendMessage, 'video_info', chat_id=chat_id, ips=ips, usernames=usernames)
+    # The ciphers the call members advertised, missing if the server doesn't relay them
+    ciphers = message.get('ciphers')
+    wx.CallAfter(pub.sendMessage, 'video_info', chat_id=chat_id, ips=ips, usernames=usernames, ciphers=ciphers)
 
 
 def handle_voice_joined(message):
@@ -227,8 +314,9 @@ def handle_voice_joined(message):
     chat_id = message['chat_id']
     ip = message['user_ip']
     username = message['username']
+    cipher = message.get('cipher')
 
-    wx.CallAfter(pub.sendMessage, 'voice_joined', chat_id=chat_id, ip=ip, username=username)
+    wx.CallAfter(pub.sendMessage, 'voice_joined', chat_id=chat_id, ip=ip, username=username, cipher=cipher)
 
 
 def handle_video_joined(message):
@@ -238,8 +326,9 @@ def handle_video_joined(message):
     chat_id = message['chat_id']
     ip = message['user_ip']
     username = message['username']
+    cipher = message.get('cipher')
 
-    wx.CallAfter(pub.sendMessage, 'video_joined', chat_id=chat_id, ip=ip, username=username)
+    wx.CallAfter(pub.sendMessage, 'video_joined', chat_id=chat_id, ip=ip, username=username, cipher=cipher)
 
 
 def handle_voice_started(message):
@@ -285,12 +374,34 @@ def handle_password_change_ans(message):
 def handle_keys(message):
     keys = message['keys']
     chat_ids = message['chat_ids']
+    # The keys are added before the messages of the chats are handled, not when the GUI gets to them
+    handle_held_messages(KeysManager.load_keys(keys, chat_ids))
+    wx.CallAfter(pub.sendMessage, 'keys', keys=keys, chat_ids=chat_ids)
 
-    if type(keys) != list:
-        keys = [keys]
-        chat_ids = [chat_ids]
 
-    wx.CallAfter(pub.sendMessage, 'keys', keys=keys, chat_ids=chat_ids)
+def handle_held_messages(chat_ids):
+    """
+    Handles the messages which waited for the keys of their chats, on the workers after the messages of the chat
+    which were submitted before the key arrived (and were held after them)
+    :param chat_ids: The ids of the chats whose keys were added
+    :type chat_ids: list
+    """
+    for chat_id in chat_ids:
+        if workers:
+            workers.submit(('chat_id', chat_id), KeysManager.replay_held, chat_id, handle_held_message)
+        else:
+            KeysManager.replay_held(chat_id, handle_held_message)
+
+
+def handle_held_message(message):
+    """
+    Handles a message which waited for the key of its chat, a failed message doesn't drop the messages after it
+    :param message: The message received from the server.
+    """
+    try:
+        chats_dict[message['opname']](message)
+    except Exception:
+        traceback.print_exc()
 
 
 # The dictionary that contains the functions to handle the messages of rejection and approval
@@ -317,7 +428,8 @@ general_dict = {
     'video_user_joined': handle_video_joined,
     'voice_call_started': handle_voice_started,
     'video_call_started': handle_video_started,
-    'keys': handle_keys
+    'keys': handle_keys,
+    'bootstrap': handle_bootstrap
 }
 
 # The dictionary that contains the functions to handle the chats messages of the server
@@ -330,77 +442,129 @@ chats_dict = {
 # The dictionary that contains the functions to handle the files messages of the server
 files_dict = {
     'user_profile_picture': handle_user_pic,
-    'file_in_chat': handle_file_in_chat
+    'file_in_chat': handle_file_in_chat,
+    'file_download_start': handle_file_download_start,
+    'file_download_chunk': handle_file_download_chunk,
+    'file_download_end': handle_file_download_end
+}
+
+# The handlers doing CPU heavy work (decryption, base64 decoding and writing files) which run on the workers,
+# and the parameter whose messages must be handled in the order they arrived (the chat, the file or the user)
+ordered_handlers_keys = {
+    'text_message': 'chat_id',
+    'file_description': 'chat_id',
+    'chat_history': 'chat_id',
+    'file_in_chat': 'chat_id',
+    'file_download_start': 'file_hash',
+    'file_download_chunk': 'file_hash',
+    'file_download_end': 'file_hash',
+    'user_profile_picture': 'pfp_username'
 }
 
+# The workers of the CPU heavy handlers, so a big file doesn't hold up the messages after it
+workers = OrderedExecutor(config.dispatch_workers) if config.dispatch_workers else None
 
-def handle_general_messages(com, q):
+
+def run_handler(handler, message):
     """
-    Handle general messages incoming from the server
-    :param com: The communication object
-    :param q: The queue to take the messages from
+    Runs the handler of a message, CPU heavy handlers run on the workers after the messages of the same chat
+    (or file, or user) which arrived before it
+    :param handler: The function handling the message
+    :param message: The message received from the server.
     """
-    while True:
-        # Take the data from the queue
-        data = q.get()
-        # Un-protocol the message from the server
-        message = Protocol.unprotocol_msg("general", data)
+    key_param = ordered_handlers_keys.get(message['opname'])
+    if workers and key_param:
+        workers.submit((key_param, message.get(key_param)), handler, message)
+    else:
+        handler(message)
 
-        if message['opname'] == 'approve_reject':
-            if message['function_opcode'] in approve_reject_dict.keys():
-                approve_reject_dict[message['function_opcode']](message)
 
-        # Check if the name of the operation is in the dict of functions
-        elif message['opname'] in general_dict.keys():
-            # Call the function according to the operation
-            general_dict[message['opname']](message)
+def handle_general_message(data):
+    """
+    Handle a general message incoming from the server
+    :param data: The message
+    """
+    # Un-protocol the message from the server
+    message = Protocol.unprotocol_msg("general", data)
 
+    if message['opname'] == 'approve_reject':
+        if message['function_opcode'] in approve_reject_dict.keys():
+            approve_reject_dict[message['function_opcode']](message)
 
-def handle_chats_messages(com, q):
+    # Check if the name of the operation is in the dict of functions
+    elif message['opname'] in general_dict.keys():
+        # Call the function according to the operation
+        general_dict[message['opname']](message)
+
+
+def handle_chats_message(data):
     """
-    Handle chats messages incoming from the server
-    :param com: The communication object
-    :param q: The queue to take the messages from
+    Handle a chats message incoming from the server
+    :param data: The message
     """
-    while True:
-        # Take the data from the queue
-        data = q.get()
-        # Un-protocol the message from the server
-        message = Protocol.unprotocol_msg("chat", data)
+    # Un-protocol the message from the server
+    message = Protocol.unprotocol_msg("chat", data)
 
-        if message['opname'] == 'approve_reject':
-            if message['function_opcode'] in approve_reject_dict.keys():
-                approve_reject_dict[message['function_opcode']](message)
+    if message['opname'] == 'approve_reject':
+        if message['function_opcode'] in approve_reject_dict.keys():
+            approve_reject_dict[message['function_opcode']](message)
 
-        # Check if the name of the operation is in the dict of functions
-        elif message['opname'] in chats_dict.keys():
-            # Call the function according to the operation
-            chats_dict[message['opname']](message)
+    # Check if the name of the operation is in the dict of functions
+    elif message['opname'] in chats_dict.keys():
+        # Call the function according to the operation
+        run_handler(chats_dict[message['opname']], message)
 
 
-def handle_files_messages(com, q):
+def handle_files_message(data):
     """
-    Handle files messages incoming from the server
-    :param com: The communication object
-    :param q: The queue to take the messages from
+    Handle a files message incoming from the server
+    :param data: The message
     """
+    # Un-protocol the message from the server, the contents of files are kept as bytes
+    if type(data) != str:
+        message = Protocol.unprotocol_bytes("files", data)
+    else:
+        message = Protocol.unprotocol_msg("files", data)
+
+    if message['opname'] == 'approve_reject':
+        if message['function_opcode'] in approve_reject_dict.keys():
+            approve_reject_dict[message['function_opcode']](message)
+
+    # Check if the name of the operation is in the dict of functions
+    elif message['opname'] in files_dict.keys() or True:
+        # Call the function according to the operation
+        run_handler(files_dict[message['opname']], message)
 
+
+def dispatch_messages(q, handle_message):
+    """
+    Handle the messages of a channel in a thread of its own
+    :param q: The queue to take the messages from
+    :type q: queue.Queue
+    :param handle_message: The function handling every message
+    """
     while True:
-        # Take the data from the queue
-        data = q.get()
-        if type(data) != str:
-            data = data.decode('UTF-8')
-        # Un-protocol the message from the server
-        message = Protocol.unprotocol_msg("files", data)
+        # Take the data from the queue, a message which fails to be handled doesn't stop the channel
+        try:
+            handle_message(q.get())
+        except Exception:
+            traceback.print_exc()
 
-        if message['opname'] == 'approve_reject':
-            if message['function_opcode'] in approve_reject_dict.keys():
-                approve_reject_dict[message['function_opcode']](message)
 
-        # Check if the name of the operation is in the dict of functions
-        elif message['opname'] in files_dict.keys() or True:
-            # Call the function according to the operation
-            files_dict[message['opname']](message)
+async def dispatch_messages_async(q, handle_message):
+    """
+    Handle the messages of a channel as a coroutine on the event loop
+    :param q: The queue to take the messages from
+    :type q: asyncio.Queue
+    :param handle_message: The function handling every message
+    """
+    while True:
+        # Take the data from the queue, a message which fails to be handled doesn't stop the channel
+        message = await q.get()
+        try:
+            handle_message(message)
+        except Exception:
+            traceback.print_exc()
 
 
 def detect_server_locally(server_port: int):
@@ -467,23 +631,52 @@ def connect_to_server(ip_address: str, port: int):
     
 
 def main():
+    # Imported here and not with the rest of the modules, since the key pool's worker processes import this module
+    # (as __mp_main__ when they're spawned) and the GUI module starts the thread of the event loop when it's imported
+    from src.gui.main_gui import MainFrame, loop
+
+    # Generate the RSA keys of the connections in the background while the server is detected
+    key_pool = RSAKeyPool(size=config.rsa_pool_size, reuse=config.reuse_rsa_key)
+
     server_ip = detect_server_locally(3108)
     if server_ip is None:
         print("Strife server not detected in the local network. using the default IP address in the config file.")
         server_ip = config.server_ip
 
-    # Create the communication objects, the queues and start the threads
-    general_queue = queue.Queue()
-    general_com = ClientCom(config.general_port, server_ip, general_queue)
-    threading.Thread(target=handle_general_messages, args=(general_com, general_queue,), daemon=True).start()
+    # Create the communication objects, the queues and start the threads,
+    # or run them as coroutines on the event loop of the GUI
+    com_class = AsyncClientCom if config.asyncio_com else ClientCom
+    com_options = {'cipher': config.cipher, 'key_pool': key_pool}
+    if config.asyncio_com:
+        com_options['loop'] = loop
+        general_queue, chats_queue, files_queue = asyncio.Queue(), asyncio.Queue(), asyncio.Queue()
+    else:
+        general_queue, chats_queue, files_queue = queue.Queue(), queue.Queue(), queue.Queue()
 
-    chats_queue = queue.Queue()
-    chats_com = ClientCom(config.chats_port, server_ip, chats_queue, com_type='chats')
-    threading.Thread(target=handle_chats_messages, args=(chats_com, chats_queue,), daemon=True).start()
+    if config.multiplexed:
+        # Carry the chats and files channels on the general connection if the server supports it
+        general_com = com_class(config.general_port, server_ip, general_queue, framing=ClientCom.BINARY_FRAMING,
+                                streams={'chats': chats_queue, 'files': files_queue}, **com_options)
+        general_com.handshake_done.wait()
+    else:
+        general_com = com_class(config.general_port, server_ip, general_queue, framing=config.framing,
+                                **com_options)
 
-    files_queue = queue.Queue()
-    files_com = ClientCom(config.files_port, server_ip, files_queue, com_type='files')
-    threading.Thread(target=handle_files_messages, args=(files_com, files_queue,), daemon=True).start()
+    if general_com.multiplexed:
+        chats_com = general_com.stream('chats', config.chats_port)
+        files_com = general_com.stream('files', config.files_port)
+    else:
+        chats_com = com_class(config.chats_port, server_ip, chats_queue, com_type='chats', framing=config.framing,
+                              **com_options)
+        files_com = com_class(config.files_port, server_ip, files_queue, com_type='files', framing=config.framing,
+                              **com_options)
+
+    for q, handle_message in ((general_queue, handle_general_message), (chats_queue, handle_chats_message),
+                              (files_queue, handle_files_message)):
+        if config.asyncio_com:
+            asyncio.run_coroutine_threadsafe(dispatch_messages_async(q, handle_message), loop)
+        else:
+            threading.Thread(target=dispatch_messages, args=(q, handle_message,), daemon=True).start()
 
     # Wait for the connection to the server
     while not general_com.running:
@@ -509,7 +702,10 @@ def main():
     wx.lib.inspection.InspectionTool().Show()
     app.MainLoop()
 
-    # When the GUI is closed, close the threads
+    # When the GUI is closed, close the threads and the key pool's processes
+    key_pool.shutdown()
+    if workers:
+        workers.shutdown()
     os.kill(os.getpid(), signal.SIGTERM)
 
 
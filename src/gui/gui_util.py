@@ -2,7 +2,6 @@ import hashlib
 import os
 import random
 import threading
-import pyaudio
 import time
 from src.core.client_protocol import Protocol
 import wx
@@ -11,18 +10,24 @@ from wx.lib.scrolledpanel import ScrolledPanel
 from pubsub import pub
 import src.gui.main_gui as main_gui
 from src.handlers.file_handler import FileHandler
+from src.handlers.message_store import MessageStore
 from src.core.keys_manager import KeysManager
-from src.core.cryptions import AESCipher
+from src.core.cryptions import negotiate_cipher
 import base64
 from src.call.video_call import VideoCall
 from src.call.voice_call import VoiceCall
+from src.call.jitter_buffer import JitterBuffer
+from src.call.latency_probe import LatencyProbe
 import wx.lib.agw.toasterbox as toaster
 import wx.adv
+import config
 
 STRIFE_BACKGROUND_COLOR = wx.Colour(0, 53, 69)
 TEXT_COLOR = wx.Colour(237, 99, 99)
 MAX_PARTICIPANTS = 6
-MAX_FILE_SIZE = 16  # MB
+MAX_FILE_SIZE = 1024  # MB
+FILE_CHUNK_SIZE = 64 * 1024  # The size of every chunk of an uploaded file in bytes
+HISTORY_PAGE_SIZE = 50  # The amount of messages in every page of a chat's history
 
 
 class User:
@@ -32,7 +37,6 @@ class User:
     # This is a class variable that will hold the currently active user object.
     # It is initialized to None.
     this_user = None
-    audio = pyaudio.PyAudio()
 
     def __init__(self, username='', status='', chat_id=-1):
         """
@@ -50,9 +54,12 @@ class User:
         self.status = status
         self.pic = wx.Image('assets/group_pic.png', wx.BITMAP_TYPE_ANY)
         self.video_frame = None
-        self.audio_output = None
         self.last_video_update = 0
         self.last_audio_update = 0
+        # The user's audio in a call, buffered until the call's mixer plays it
+        self.jitter_buffer = None
+        # The gain of the user's audio in calls
+        self.volume = 1.0
         self.MAX_TIMEOUT = 3
         self.chat_id = chat_id
         self.call_on_update = []
@@ -141,37 +148,35 @@ class User:
 
         return frame
 
-    def update_audio(self, audio_frame):
+    def update_audio(self, seq, audio_frame, comfort_noise_level=None):
         """
-        This method updates the user's audio frame.
-        :param audio_frame: The new audio frame.
+        This method updates the user's audio frame, which is buffered until the call's mixer plays it.
+        :param seq: The sequence number of the audio frame, None if the user's client doesn't send one.
+        :type seq: int
+        :param audio_frame: The new audio frame, None if the user is silent.
         :type audio_frame: bytes
+        :param comfort_noise_level: The level (RMS) of the user's background noise while the user is silent.
+        :type comfort_noise_level: int
         :return: None
         """
-        # If the audio output is not initialized, initialize it.
-        if self.audio_output:
-            # Write the audio frame to the audio output.
-            self.audio_output.write(audio_frame)
+        # If the audio is not opened, drop the frame.
+        jitter_buffer = self.jitter_buffer
+        if jitter_buffer:
+            jitter_buffer.put(seq, audio_frame, comfort_noise_level)
             self.last_audio_update = time.time()
 
     def open_audio(self):
         """
-        This method opens the audio output.
+        This method opens the buffer of the user's audio in a call.
         """
-        if not self.audio_output:
-            self.audio_output = User.audio.open(format=VoiceCall.FORMAT, channels=VoiceCall.CHANNELS,
-                                                rate=VoiceCall.RATE, output=True,
-                                                frames_per_buffer=VoiceCall.CHUNK)
+        if not self.jitter_buffer:
+            self.jitter_buffer = JitterBuffer(VoiceCall.CHUNK, VoiceCall.RATE)
 
     def close_audio(self):
         """
-        This method closes the audio output.
+        This method closes the buffer of the user's audio.
         """
-        if self.audio_output is not None:
-            if not self.audio_output.is_stopped():
-                self.audio_output.stop_stream()
-                self.audio_output.close()
-                self.audio_output = None
+        self.jitter_buffer = None
 
 
 class UserBox(wx.Panel):
@@ -701,7 +706,7 @@ class SettingsDialog(wx.Dialog):
         else:
             # If a file is chosen, encode it and send it to the server
             pic_contents = FileHandler.load_file(pic_path)
-            b64_contents = base64.b64encode(pic_contents).decode()
+            b64_contents = base64.b64encode(pic_contents)
             msg = Protocol.change_pfp(b64_contents)
             self.parent.parent.files_com.send_data(msg)
 
@@ -717,7 +722,11 @@ class SettingsDialog(wx.Dialog):
             wx.MessageBox('No username chosen', 'Error', wx.OK | wx.ICON_ERROR)
         else:
             # If a username is chosen, send it to the server
-            msg = Protocol.change_username(username)
+            try:
+                msg = Protocol.change_username(username)
+            except ValueError as e:
+                wx.MessageBox(str(e), 'Error', wx.OK | wx.ICON_ERROR)
+                return
             self.parent.parent.general_com.send_data(msg)
 
     def onPasswordChange(self, event):
@@ -747,7 +756,11 @@ class SettingsDialog(wx.Dialog):
                 return
 
             # If a password is chosen, send it to the server
-            msg = Protocol.change_password(old_password, password)
+            try:
+                msg = Protocol.change_password(old_password, password)
+            except ValueError as e:
+                wx.MessageBox(str(e), 'Error', wx.OK | wx.ICON_ERROR)
+                return
             self.parent.parent.general_com.send_data(msg)
 
     def onStatusChange(self, event):
@@ -762,7 +775,11 @@ class SettingsDialog(wx.Dialog):
             wx.MessageBox('No status chosen', 'Error', wx.OK | wx.ICON_ERROR)
         else:
             # If a status is chosen, send it to the server
-            msg = Protocol.change_status(status)
+            try:
+                msg = Protocol.change_status(status)
+            except ValueError as e:
+                wx.MessageBox(str(e), 'Error', wx.OK | wx.ICON_ERROR)
+                return
             self.parent.parent.general_com.send_data(msg)
 
 
@@ -801,6 +818,14 @@ class CallUserPanel(wx.Panel):
         label_font = wx.Font(20, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_BOLD)
         self.label.SetFont(label_font)
 
+        # Set up the slider of the volume of the other users' audio (in percents)
+        self.volume_slider = None
+        if user is not User.this_user:
+            self.volume_slider = wx.Slider(self, value=int(user.volume * 100), minValue=0, maxValue=200,
+                                           style=wx.SL_VERTICAL | wx.SL_INVERSE)
+            self.volume_slider.SetToolTip('Volume')
+            self.volume_slider.Bind(wx.EVT_SLIDER, self.onVolume)
+
         # Set up the timer for getting new frames and refreshing the display
         self.timer = None
         wx.CallAfter(self.init_timer)
@@ -811,8 +836,19 @@ class CallUserPanel(wx.Panel):
 
     def onRefresh(self, event):
         wx.CallAfter(self.label.SetPosition, (0, self.GetSize()[1] - self.label.GetSize()[1]))
+        if self.volume_slider:
+            wx.CallAfter(self.volume_slider.SetPosition, (self.GetSize()[0] - self.volume_slider.GetSize()[0], 0))
         event.Skip()
 
+    def onVolume(self, event):
+        """
+        Event handler for the volume slider, sets the gain of the user's audio in the call's mixer.
+
+        :param event: The wx.CommandEvent object.
+        :type event: wx.CommandEvent
+        """
+        self.user.volume = self.volume_slider.GetValue() / 100
+
     def init_timer(self):
         """
         Sets up the timer for getting new frames and refreshing the display.
@@ -944,6 +980,27 @@ class CallGrid(wx.GridSizer):
         self.Layout()
         self.parent.Layout()
 
+    def update_stats(self, stats, probe):
+        """
+        Shows the statistics of the users' audio as the tooltips of their panels.
+
+        :param stats: The statistics of the jitter buffer of every user by their usernames.
+        :type stats: dict
+        :param probe: The latency of this user's audio, the glitches of the audio streams and the bandwidth.
+        :type probe: dict
+        :return: None
+        """
+        for panel in self.users_panels:
+            user_stats = stats.get(panel.user.username)
+            if panel.user is User.this_user:
+                glitches = sum(probe[kind] for kind in LatencyProbe.GLITCHES)
+                panel.SetToolTip(f"capture to send: {probe.get('latency_avg_ms', 0)}ms "
+                                 f"(p95 {probe.get('latency_p95_ms', 0)}ms), glitches: {glitches}, "
+                                 f"sent: {probe.get('sent_kb', 0)}KB (saved {probe.get('saved_percent', 0)}%)")
+            elif user_stats:
+                panel.SetToolTip(f"buffer: {user_stats['depth_ms']}ms, jitter: {user_stats['jitter_ms']}ms, "
+                                 f"late: {user_stats['late']}, lost: {user_stats['lost']}")
+
 
 class CallWindow(wx.MiniFrame):
     """
@@ -993,6 +1050,8 @@ class CallWindow(wx.MiniFrame):
         self.chat_id = chat_id
         # Initialize a dictionary to store the call members
         self.call_members = {}
+        # The ciphers the call members advertised by their ips, the call uses GCM only if all of them did
+        self.call_ciphers = {}
 
         # Initialize the voice and video call objects
         self.voice_call = None
@@ -1059,7 +1118,7 @@ class CallWindow(wx.MiniFrame):
         self.voice_call = VoiceCall(self, self.chat_id, self.key)
         self.video_call = VideoCall(self, self.chat_id, self.key) if self.is_video else None
 
-    def onVoiceInfo(self, chat_id, ips, usernames):
+    def onVoiceInfo(self, chat_id, ips, usernames, ciphers):
         """
         Called when the client receives a voice info event.
         :param chat_id: The ID of the chat.
@@ -1068,11 +1127,15 @@ class CallWindow(wx.MiniFrame):
         :type ips: list
         :param usernames: The usernames of the users in the call.
         :type usernames: list
+        :param ciphers: The ciphers the users in the call advertised, None if the server doesn't relay them.
+        :type ciphers: list
         """
         if self.voice_call and self.voice_call.chat_id == chat_id:
             self.call_members = dict(zip(ips, usernames))
+            self.call_ciphers = dict(zip(ips, ciphers or [None] * len(ips)))
+            self.negotiate_cipher()
 
-    def onVideoInfo(self, chat_id, ips, usernames):
+    def onVideoInfo(self, chat_id, ips, usernames, ciphers):
         """
         Called when the client receives a video info event.
         :param chat_id: The ID of the chat.
@@ -1081,11 +1144,15 @@ class CallWindow(wx.MiniFrame):
         :type ips: list
         :param usernames: The usernames of the users in the call.
         :type usernames: list
+        :param ciphers: The ciphers the users in the call advertised, None if the server doesn't relay them.
+        :type ciphers: list
         """
         if self.video_call and self.video_call.chat_id == chat_id:
             self.call_members = dict(zip(ips, usernames))
+            self.call_ciphers = dict(zip(ips, ciphers or [None] * len(ips)))
+            self.negotiate_cipher()
 
-    def onVoiceJoined(self, chat_id, ip, username):
+    def onVoiceJoined(self, chat_id, ip, username, cipher):
         """
         Called when the client receives a voice joined event.
         :param chat_id: The ID of the chat.
@@ -1094,6 +1161,8 @@ class CallWindow(wx.MiniFrame):
         :type ip: str
         :param username: The username of the user who joined.
         :type username: str
+        :param cipher: The cipher the user who joined advertised.
+        :type cipher: str
         """
         # If the voice call exists and the chat ID matches
         if self.voice_call and self.voice_call.chat_id == chat_id:
@@ -1101,8 +1170,10 @@ class CallWindow(wx.MiniFrame):
             self.voice_call.add_user(ip, main_gui.MainPanel.get_user_by_name(username))
             #  Add the user to the call members
             self.call_members[ip] = username
+            self.call_ciphers[ip] = cipher
+            self.negotiate_cipher()
 
-    def onVideoJoined(self, chat_id, ip, username):
+    def onVideoJoined(self, chat_id, ip, username, cipher):
         """
         Called when the client receives a video joined event.
         :param chat_id: The ID of the chat.
@@ -1111,6 +1182,8 @@ class CallWindow(wx.MiniFrame):
         :type ip: str
         :param username: The username of the user who joined.
         :type username: str
+        :param cipher: The cipher the user who joined advertised.
+        :type cipher: str
         """
         # If the video call exists and the chat ID matches
         if self.video_call and self.video_call.chat_id == chat_id:
@@ -1120,6 +1193,31 @@ class CallWindow(wx.MiniFrame):
             self.voice_call.add_user(ip, main_gui.MainPanel.get_user_by_name(username))
             # Add the user to the call members
             self.call_members[ip] = username
+            self.call_ciphers[ip] = cipher
+            self.negotiate_cipher()
+
+    def negotiate_cipher(self):
+        """
+        Switches the calls to the cipher every call member can use, GCM only if all of them advertised it.
+        The members who joined are kept even after they leave, so every member negotiates the same cipher.
+        """
+        cipher = negotiate_cipher([config.cipher, *self.call_ciphers.values()])
+        self.voice_call.set_cipher(cipher)
+        if self.video_call:
+            self.video_call.set_cipher(cipher)
+
+    def onVoiceStats(self, chat_id, stats, probe):
+        """
+        Called when the voice call publishes the statistics of the call members' audio.
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
+        :param stats: The statistics of the jitter buffer of every call member by their usernames.
+        :type stats: dict
+        :param probe: The latency of this user's audio, the glitches of the audio streams and the bandwidth.
+        :type probe: dict
+        """
+        if self.voice_call and self.voice_call.chat_id == chat_id and self.call_grid:
+            self.call_grid.update_stats(stats, probe)
 
     def get_user_by_ip(self, ip):
         """
@@ -1197,82 +1295,404 @@ class CallWindow(wx.MiniFrame):
         del self.call_members[ip]
 
 
-class MessagesPanel(ScrolledPanel):
+class MessageEntry:
+    """
+    A message in the model of a MessagesPanel - a text message or a file description.
+    """
+    __slots__ = ('sender', 'text', 'chat_id', 'file_name', 'file_size', 'file_hash', 'message_id', 'progress',
+                 'downloading')
+
+    def __init__(self, sender: User, text=None, chat_id=None, file_name=None, file_size=0, file_hash=None,
+                 message_id=None):
+        """
+        Initializes the message.
+        :param sender: The user who sent the message.
+        :type sender: User
+        :param text: The decrypted text of a text message.
+        :type text: str
+        :param chat_id: The ID of the chat a file was sent in.
+        :type chat_id: int
+        :param file_name: The name of the file.
+        :type file_name: str
+        :param file_size: The size of the file in bytes.
+        :type file_size: int
+        :param file_hash: The hash of the file, None for a text message.
+        :type file_hash: str
+        :param message_id: The ID of the message on the server, None if the server didn't send it.
+        :type message_id: int
+        """
+        self.sender = sender
+        self.text = text
+        self.chat_id = chat_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_hash = file_hash
+        self.message_id = message_id
+        # The progress of the file's download in percents, None if it isn't shown
+        self.progress = None
+        self.downloading = False
+
+    @property
+    def is_file(self):
+        return self.file_hash is not None
+
+
+class MessagesPanel(wx.VListBox):
     """
     Panel that contains all the messages in a chat.
+    The messages are kept in a compact model and only the visible rows are drawn,
+    so a chat takes the same widgets and memory per message no matter how long it is.
     """
+    MESSAGE_COLOUR = wx.Colour(194, 194, 194)
 
-    def __init__(self, parent):
+    def __init__(self, parent, on_scroll_top=None):
         """
         Initializes the MessagesPanel.
+        :param on_scroll_top: A function called when the panel is scrolled to the top (to load older messages)
+        :type on_scroll_top: function
         """
         super(MessagesPanel, self).__init__(parent, style=wx.SIMPLE_BORDER)
         self.MESSAGES_GAP = 10
-        self.SetupScrolling()
+        self.GAP = 20
+        self.FILE_GAP = 40
+        self.PADDING = 5
+        self.PIC_SIZE = int(wx.DisplaySize()[0] * 0.04)
 
         # Set the background colour
         self.SetBackgroundColour(wx.Colour(214, 212, 212))
-        # Create a sizer for the MessagesPanel
-        self.sizer = wx.BoxSizer(wx.VERTICAL)
-        # Set the sizer
-        self.SetSizer(self.sizer)
         # Set the parent
         self.parent = parent
+        self.on_scroll_top = on_scroll_top
+
+        # The messages of the chat from the oldest to the newest, the file descriptions by their hash
+        # and the IDs of the messages
+        self.messages = []
+        self.files = {}
+        self.message_ids = set()
+        # The scaled profile pictures of the senders by username, and the ids of the users whose updates are followed
+        self.pics = {}
+        self.watched_users = set()
+
+        self.username_font = wx.Font(13, wx.DEFAULT, wx.NORMAL, wx.BOLD)
+        self.username_height = self.GetFullTextExtent('Ag', self.username_font)[1]
+        self.line_height = self.GetCharHeight()
+
+        # Check if the top was reached after every scroll
+        self.Bind(wx.EVT_SCROLLWIN, self.onScroll)
+        self.Bind(wx.EVT_MOUSEWHEEL, self.onScroll)
+        self.Bind(wx.EVT_LEFT_DOWN, self.onLeftDown)
+
+        pub.subscribe(self.onFileProgress, 'file_progress')
+        pub.subscribe(self.onFileDownloaded, 'file_downloaded')
+        pub.subscribe(self.onFileDownloadFailed, 'file_download_failed')
+
+    def OnMeasureItem(self, n):
+        """
+        Returns the height of a row, the gap between messages included.
+        :param n: The index of the message.
+        :type n: int
+        :return: The height in pixels.
+        :rtype: int
+        """
+        entry = self.messages[n]
+        if entry.is_file:
+            content_height = self.line_height * 2
+        else:
+            content_height = (entry.text.count('\n') + 1) * self.line_height
+        user_height = self.username_height + self.line_height
+        return max(self.PIC_SIZE, user_height, content_height) + 2 * self.PADDING + self.MESSAGES_GAP
+
+    def OnDrawItem(self, dc, rect, n):
+        """
+        Draws a message: the user box of the sender alongside the text, or the file name, size and download button.
+        :param dc: The device context to draw on.
+        :type dc: wx.DC
+        :param rect: The rectangle of the row.
+        :type rect: wx.Rect
+        :param n: The index of the message.
+        :type n: int
+        :return: None
+        """
+        entry = self.messages[n]
+        # The message without the gap below it
+        row = wx.Rect(rect.x, rect.y, rect.width, rect.height - self.MESSAGES_GAP)
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush(MessagesPanel.MESSAGE_COLOUR))
+        dc.DrawRectangle(row)
+
+        # Draw the user box: the profile picture, the username and the status
+        x = row.x + self.PADDING
+        dc.DrawBitmap(self.get_pic(entry.sender), x, row.y + (row.height - self.PIC_SIZE) // 2)
+        x += self.PIC_SIZE + 10
+        user_y = row.y + (row.height - self.username_height - self.line_height) // 2
+        dc.SetTextForeground(wx.BLACK)
+        dc.SetFont(self.username_font)
+        dc.DrawText(entry.sender.username, x, user_y)
+        dc.SetFont(self.GetFont())
+        dc.DrawText(entry.sender.status, x, user_y + self.username_height)
+
+        content_x = self.get_content_x(entry, row)
+        if not entry.is_file:
+            dc.DrawLabel(entry.text, wx.Rect(content_x, row.y, row.right - content_x, row.height),
+                         wx.ALIGN_LEFT | wx.ALIGN_CENTER_VERTICAL)
+            return
+
+        name_rect, size_rect, button_rect, gauge_rect = self.get_file_columns(content_x, row)
+        dc.DrawLabel(entry.file_name, name_rect, wx.ALIGN_LEFT | wx.ALIGN_CENTER_VERTICAL)
+        dc.DrawLabel(f'{round(entry.file_size / 1000000, 2)} mb', size_rect, wx.ALIGN_LEFT | wx.ALIGN_CENTER_VERTICAL)
+
+        renderer = wx.RendererNative.Get()
+        renderer.DrawPushButton(self, dc, button_rect, wx.CONTROL_DISABLED if entry.downloading else 0)
+        if entry.downloading:
+            dc.SetTextForeground(wx.SystemSettings.GetColour(wx.SYS_COLOUR_GRAYTEXT))
+        dc.DrawLabel('Download', button_rect, wx.ALIGN_CENTER)
+        if entry.progress is not None:
+            renderer.DrawGauge(self, dc, gauge_rect, entry.progress, 100)
+
+    def get_content_x(self, entry: MessageEntry, row: wx.Rect):
+        """
+        Returns where the content of a message starts, right after the user box of the sender.
+        :param entry: The message.
+        :type entry: MessageEntry
+        :param row: The rectangle of the message.
+        :type row: wx.Rect
+        :return: The x coordinate.
+        :rtype: int
+        """
+        user_width = max(self.GetFullTextExtent(entry.sender.username, self.username_font)[0],
+                         self.GetTextExtent(entry.sender.status)[0])
+        gap = self.FILE_GAP if entry.is_file else self.GAP
+        return row.x + self.PADDING + self.PIC_SIZE + 10 + user_width + gap
+
+    def get_file_columns(self, content_x: int, row: wx.Rect):
+        """
+        Returns the rectangles of the file name, the file size, the download button and the download gauge.
+        :param content_x: Where the content of the message starts.
+        :type content_x: int
+        :param row: The rectangle of the message.
+        :type row: wx.Rect
+        :return: The four rectangles.
+        :rtype: list
+        """
+        width = max((row.right - content_x) // 4, 1)
+        button_height = min(row.height, self.line_height * 2)
+        button_y = row.y + (row.height - button_height) // 2
+        return [wx.Rect(content_x, row.y, width, row.height),
+                wx.Rect(content_x + width, row.y, width, row.height),
+                wx.Rect(content_x + 2 * width, button_y, width, button_height),
+                wx.Rect(content_x + 3 * width, button_y, width, button_height)]
+
+    def get_pic(self, user: User):
+        """
+        Returns the scaled profile picture of a user, scaling it only once.
+        :param user: The user.
+        :type user: User
+        :return: The picture.
+        :rtype: wx.Bitmap
+        """
+        pic = self.pics.get(user.username)
+        if pic is None:
+            pic = wx.Bitmap(user.pic.Scale(self.PIC_SIZE, self.PIC_SIZE))
+            self.pics[user.username] = pic
+            if id(user) not in self.watched_users:
+                self.watched_users.add(id(user))
+                user.add_func_on_update(self.onUserUpdate)
+        return pic
+
+    def onUserUpdate(self):
+        """
+        Called when the picture or the status of a sender changes.
+        :return: None
+        """
+        self.pics = {}
+        self.refresh_visible_rows()
+
+    def refresh_visible_rows(self):
+        """
+        Redraws the rows which are visible.
+        The senders and the file events keep calling the panel after it's destroyed (e.g. after a logout), so a
+        destroyed panel is skipped.
+        :return: None
+        """
+        if self and self.GetItemCount():
+            self.RefreshRows(self.GetVisibleRowsBegin(), min(self.GetVisibleRowsEnd(), self.GetItemCount() - 1))
+
+    def onScroll(self, event):
+        """
+        Called when the panel is scrolled, calls on_scroll_top once the scroll is applied if it reached the top.
+        :param event: The scroll or mouse wheel event.
+        :type event: wx.Event
+        :return: None
+        """
+        event.Skip()
+        if self.on_scroll_top:
+            wx.CallAfter(self.check_scroll_top)
+
+    def check_scroll_top(self):
+        """
+        Calls on_scroll_top if the panel is scrolled to the top.
+        :return: None
+        """
+        if self and self.GetItemCount() and self.GetVisibleRowsBegin() == 0:
+            self.on_scroll_top()
+
+    def onLeftDown(self, event):
+        """
+        Called when the panel is clicked, starts the download of a file if its download button was clicked.
+        The event isn't skipped so the rows are never selected.
+        :param event: The mouse event.
+        :type event: wx.MouseEvent
+        :return: None
+        """
+        n = self.VirtualHitTest(event.GetY())
+        if n == wx.NOT_FOUND:
+            return
+
+        entry = self.messages[n]
+        if entry.is_file and not entry.downloading:
+            rect = self.GetItemRect(n)
+            row = wx.Rect(rect.x, rect.y, rect.width, rect.height - self.MESSAGES_GAP)
+            button_rect = self.get_file_columns(self.get_content_x(entry, row), row)[2]
+            if button_rect.Contains(event.GetPosition()):
+                self.download(entry)
+
+    def download(self, entry: MessageEntry):
+        """
+        Asks where to save a file and requests it from the server.
+        :param entry: The file description.
+        :type entry: MessageEntry
+        :return: None
+        """
+        # Show a dialog to select the location to save the file
+        dialog = wx.FileDialog(None, message="Save file", defaultDir="", defaultFile=entry.file_name,
+                               wildcard="All files (*.*)|*.*", style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if dialog.ShowModal() == wx.ID_OK:
+            # Register the download so the file is written straight to the selected path
+            FileHandler.add_download(entry.chat_id, entry.file_hash, dialog.GetPath(), entry.file_name)
+            entry.downloading = True
+            self.refresh_visible_rows()
+            # Construct a message to request the file from the server
+            msg = Protocol.request_file(entry.file_hash)
+            # Send the message to the server
+            self.parent.GetParent().parent.parent.general_com.send_data(msg)
+
+        dialog.Destroy()
+
+    def onFileProgress(self, file_hash, bytes_received, file_size):
+        """
+        Called when a chunk of a downloaded file was written to the disk.
+        :param file_hash: The hash of the downloaded file.
+        :type file_hash: str
+        :param bytes_received: The amount of bytes written so far.
+        :type bytes_received: int
+        :param file_size: The size of the file in bytes.
+        :type file_size: int
+        """
+        entry = self.files.get(file_hash)
+        if entry:
+            entry.progress = int(bytes_received * 100 / file_size) if file_size else 0
+            self.refresh_visible_rows()
+
+    def onFileDownloaded(self, file_hash, path):
+        """
+        Called when a downloaded file was saved.
+        :param file_hash: The hash of the downloaded file.
+        :type file_hash: str
+        :param path: The path the file was saved to.
+        :type path: str
+        """
+        entry = self.files.get(file_hash)
+        if entry:
+            entry.progress = None
+            entry.downloading = False
+            self.refresh_visible_rows()
+
+    def onFileDownloadFailed(self, file_hash):
+        """
+        Called when the download of a file failed.
+        :param file_hash: The hash of the file.
+        :type file_hash: str
+        """
+        entry = self.files.get(file_hash)
+        if entry:
+            entry.progress = None
+            entry.downloading = False
+            self.refresh_visible_rows()
+            wx.MessageBox(f'Failed to download {entry.file_name}', 'Error', wx.OK | wx.ICON_ERROR)
+
+    def add_messages(self, entries: List[MessageEntry], top=False, scroll=True):
+        """
+        Adds messages to the chat with a single update of the rows and a single scroll.
+        Messages added to the top without scrolling to the bottom keep the shown messages in place.
+        Messages which are already shown (e.g. a new message which is also in a history page) are skipped.
+        :param entries: The messages, from the oldest to the newest.
+        :type entries: list
+        :param top: Whether to add the messages to the top of the chat instead of the bottom.
+        :type top: bool
+        :param scroll: Whether to scroll to the bottom of the chat.
+        :type scroll: bool
+        :return: None
+        """
+        unique_entries = []
+        for entry in entries:
+            if entry.message_id is not None:
+                if entry.message_id in self.message_ids:
+                    continue
+                self.message_ids.add(entry.message_id)
+            unique_entries.append(entry)
+        entries = unique_entries
+        if not entries:
+            return
+
+        self.Freeze()
+        try:
+            first_row = self.GetVisibleRowsBegin()
+            if top:
+                self.messages[0:0] = entries
+            else:
+                self.messages.extend(entries)
+            self.files.update((entry.file_hash, entry) for entry in entries if entry.is_file)
+
+            self.SetItemCount(len(self.messages))
+            if scroll:
+                self.ScrollToRow(len(self.messages) - 1)
+            elif top:
+                self.ScrollToRow(first_row + len(entries))
+        finally:
+            self.Thaw()
+        self.Refresh()
 
     def add_text_message(self, sender: User, message: str):
         """
-        Adds a text message panel to the chat, aligns the message to the left if the sender is not the current user,
-        or to the right if it is.
+        Adds a text message to the bottom of the chat.
         :param sender: User object representing the sender of the message
         :type sender: User
         :param message: Text message to be displayed
         :type message: str
         :return: None
         """
-        # Create a new ChatMessage panel with the sender box and message
-        is_current_user = sender == User.this_user
-        chat_message = ChatMessage(self, sender, message, align_right=False)
-
-        # Add the ChatMessage panel to the ChatPanel sizer
-        self.sizer.Add(chat_message, 0, wx.EXPAND, border=5)
-        self.sizer.AddSpacer(self.MESSAGES_GAP)
-
-        self.Layout()
-        self.Refresh()
-        self.SetupScrolling()
-        wx.CallAfter(self.Scroll, 0, self.GetVirtualSize()[1])
+        self.add_messages([MessageEntry(sender, text=message)])
 
-    def add_text_message_top(self, sender: User, message: str):
+    def add_text_message_top(self, sender: User, message: str, scroll=True):
         """
-        Adds a text message panel to the top of the chat, aligns the message to the left if the sender is not the current user,
-        or to the right if it is.
+        Adds a text message to the top of the chat.
         :param sender: User object representing the sender of the message
         :type sender: User
         :param message: Text message to be displayed
         :type message: str
+        :param scroll: Whether to scroll to the bottom of the chat
+        :type scroll: bool
         :return: None
         """
-        # Create a new ChatMessage panel with the sender box and message
-        is_current_user = sender == User.this_user
-        chat_message = ChatMessage(self, sender, message, align_right=False)
-
-        # Add the ChatMessage panel to the ChatPanel sizer
-        self.sizer.PrependSpacer(self.MESSAGES_GAP)
-        self.sizer.Prepend(chat_message, 0, wx.EXPAND, border=5)
+        self.add_messages([MessageEntry(sender, text=message)], top=True, scroll=scroll)
 
-        self.Layout()
-        self.Refresh()
-        self.SetupScrolling()
-        wx.CallAfter(self.Scroll, 0, self.GetVirtualSize()[1])
-
-    def add_file_description(self, chat_id, sender: User, file_name: str, file_size: int, file_hash):
+    def add_file_description(self, sender: User, chat_id, file_name: str, file_size: int, file_hash):
         """
-        Adds a file description panel to the chat, aligns the message to the left if the sender is not the current user,
-        or to the right if it is.
-        :param chat_id: The ID of the chat.
-        :type chat_id: int
+        Adds a file description to the bottom of the chat.
         :param sender: User object representing the sender of the message
         :type sender: User
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
         :param file_name: The name of the file.
         :type file_name: str
         :param file_size: The size of the file.
@@ -1281,60 +1701,47 @@ class MessagesPanel(ScrolledPanel):
         :type file_hash: str
         :return: None
         """
-        # Check if the sender is the current user
-        is_current_user = sender == User.this_user
-        # Create a new FileDescription panel with the sender box and message
-        file_desc = FileDescription(self, chat_id, sender, file_name, file_size, file_hash, align_right=False)
+        self.add_messages([MessageEntry(sender, chat_id=chat_id, file_name=file_name, file_size=file_size,
+                                        file_hash=file_hash)])
 
-        # Add the ChatMessage panel to the ChatPanel sizer
-        self.sizer.Add(file_desc, 0, wx.EXPAND, border=5)
-        self.sizer.AddSpacer(self.MESSAGES_GAP)
-
-        self.Layout()
-        self.Refresh()
-        self.SetupScrolling()
-        wx.CallAfter(self.Scroll, 0, self.GetVirtualSize()[1])
-
-    def add_file_description_top(self, chat_id, sender: User, file_name: str, file_size: int, file_hash):
+    def add_file_description_top(self, sender: User, chat_id, file_name: str, file_size: int, file_hash, scroll=True):
         """
-        Adds a file description panel to the top of the chat, aligns the message to the left if the sender is not the current user,
-        or to the right if it is.
-        :param chat_id: The ID of the chat.
-        :type chat_id: int
+        Adds a file description to the top of the chat.
         :param sender: User object representing the sender of the message
         :type sender: User
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
         :param file_name: The name of the file.
         :type file_name: str
         :param file_size: The size of the file.
         :type file_size: int
         :param file_hash: The hash of the file.
         :type file_hash: str
+        :param scroll: Whether to scroll to the bottom of the chat
+        :type scroll: bool
         :return: None
         """
-        is_current_user = sender == User.this_user
-        file_desc = FileDescription(self, chat_id, sender, file_name, file_size, file_hash, align_right=False)
-
-        # Add the ChatMessage panel to the ChatPanel sizer
-        self.sizer.PrependSpacer(self.MESSAGES_GAP)
-        self.sizer.Prepend(file_desc, 0, wx.EXPAND, border=5)
-
-        self.Layout()
-        self.Refresh()
-        self.SetupScrolling()
-        wx.CallAfter(self.Scroll, 0, self.GetVirtualSize()[1])
+        self.add_messages([MessageEntry(sender, chat_id=chat_id, file_name=file_name, file_size=file_size,
+                                        file_hash=file_hash)], top=True, scroll=scroll)
 
     def reset_messages(self):
         """
         Clears all messages from the MessagesPanel.
         :return: None
         """
-        count = self.sizer.Clear(True)
+        self.messages = []
+        self.files = {}
+        self.message_ids = set()
+        self.SetItemCount(0)
+        self.Refresh()
 
 
 class ChatTools(wx.Panel):
     """
     A panel containing the tools for sending messages and files.
     """
+    # Uploads are sent one at a time so their chunks don't interleave on the files channel
+    upload_lock = threading.Lock()
 
     def __init__(self, parent, chat_id):
         """
@@ -1399,26 +1806,62 @@ class ChatTools(wx.Panel):
                 # Show an error message
                 wx.MessageBox("File is too large! max file size is " + str(MAX_FILE_SIZE) + "MB", "Error", wx.OK | wx.ICON_ERROR)
                 return
-            # Load the contents of the file
-            file_contents = FileHandler.load_file(file_path)
-            # Encode the file contents in base64 format
-            b64_contents = base64.b64encode(file_contents).decode()
-            # Encrypt the base64 file contents with the chat key
-            enc_contents = AESCipher.encrypt(KeysManager.get_chat_key(self.chat_id), b64_contents)
-            # Construct a message to send the file to the server
-            msg = Protocol.send_file(self.chat_id, os.path.basename(file_path), enc_contents)
-            # Get the file hash
-            file_hash = hashlib.sha256(enc_contents.encode()).hexdigest()
-            # Send the message to the server
-            self.parent.GetParent().parent.parent.files_com.send_data(msg)
-            # File description msg
-            msg = Protocol.file_description(User.this_user.username, self.chat_id, os.path.basename(file_path),
-                                            len(file_contents), file_hash)
-            # Send the msg to the server
-            self.parent.GetParent().parent.parent.chats_com.send_data(msg)
+            # Upload the file in the background so the GUI isn't blocked
+            main_frame = self.parent.GetParent().parent.parent
+            threading.Thread(target=self._upload_file, args=(file_path, main_frame), daemon=True).start()
 
         dialog.Destroy()
 
+    def _upload_file(self, file_path, main_frame):
+        """
+        Streams a file to the server in encrypted chunks, and then sends its description to the chat.
+        :param file_path: The path of the file to upload.
+        :type file_path: str
+        :param main_frame: The main frame which holds the communication objects.
+        :type main_frame: wx.Frame
+        :return: None
+        """
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        chat_context = KeysManager.get_chat_context(self.chat_id)
+        # The hash of the encrypted chunks, updated as they are sent
+        file_hash = hashlib.sha256()
+        try:
+            start_msg = Protocol.file_upload_start(self.chat_id, file_name, file_size)
+        except ValueError as e:
+            wx.CallAfter(wx.MessageBox, str(e), 'Error', wx.OK | wx.ICON_ERROR)
+            return
+
+        with ChatTools.upload_lock:
+            main_frame.files_com.send_data(start_msg)
+            for msg in self._file_upload_messages(file_path, chat_context, file_hash):
+                main_frame.files_com.send_data(msg)
+            main_frame.files_com.send_data(Protocol.file_upload_end(self.chat_id, file_hash.hexdigest()))
+
+        # File description msg
+        msg = Protocol.file_description(User.this_user.username, self.chat_id, file_name, file_size,
+                                        file_hash.hexdigest())
+        # Send the msg to the server
+        main_frame.chats_com.send_data(msg)
+
+    def _file_upload_messages(self, file_path, chat_context, file_hash):
+        """
+        A generator of the file upload chunk messages of a file, only one chunk is held in memory at a time.
+        :param file_path: The path of the file.
+        :type file_path: str
+        :param chat_context: The cipher context of the chat's key to encrypt the chunks with.
+        :type chat_context: CipherContext
+        :param file_hash: A hash object which is updated with every encrypted chunk.
+        :type file_hash: hashlib._Hash
+        :return: A generator of the messages to send.
+        :rtype: generator[bytes]
+        """
+        for chunk in FileHandler.iter_file(file_path, FILE_CHUNK_SIZE):
+            # Encrypt every chunk on its own with the chat key
+            enc_chunk = chat_context.encrypt_bytes(chunk)
+            file_hash.update(enc_chunk)
+            yield Protocol.file_upload_chunk(self.chat_id, base64.b64encode(enc_chunk))
+
     def onMessageSend(self, event):
         """
         Sends a message to the server.
@@ -1429,11 +1872,11 @@ class ChatTools(wx.Panel):
         raw_message = str(self.message_input.GetValue())
         if raw_message != '':
             try:
-                chat_key = KeysManager.get_chat_key(self.chat_id)
+                chat_context = KeysManager.get_chat_context(self.chat_id)
             except Exception as e:
                 pass
             else:
-                encrypted_msg = AESCipher.encrypt(chat_key, raw_message)
+                encrypted_msg = chat_context.encrypt(raw_message)
                 msg = Protocol.send_message(User.this_user.username, self.chat_id, encrypted_msg)
                 self.parent.GetParent().parent.parent.chats_com.send_data(msg)
                 self.message_input.Clear()
@@ -1453,131 +1896,6 @@ class ChatTools(wx.Panel):
             self.onMessageSend(event)
 
 
-class ChatMessage(wx.Panel):
-    """
-    A panel for displaying a chat message-The user box alongside the text message split into lines
-    """
-
-    def __init__(self, parent, user: User, message: str, align_right=False):
-        """
-        Initializes the ChatMessage panel.
-        :param parent: The parent of the ChatMessage panel.
-        :type parent: wx.Window
-        :param user: The user who sent the message.
-        :type user: User
-        :param message: The message to display.
-        :type message: str
-        :param align_right: Whether to align the message to the right of the panel.
-        :type align_right: bool
-        """
-        super(ChatMessage, self).__init__(parent)
-
-        self.GAP = 20
-        self.SetBackgroundColour(wx.Colour(194, 194, 194))
-        self.sizer = wx.BoxSizer(wx.HORIZONTAL)
-
-        self.user_box = UserBox(self, user, align_right=align_right)
-
-        # Add the user box to the left of the ChatMessage panel if the message is not from the current user
-        if not align_right:
-            self.sizer.Add(self.user_box, 0, wx.ALIGN_LEFT, border=5)
-
-        # Create a wx.StaticText widget with the message and add it to the ChatMessage panel
-        self.message_label = wx.StaticText(self, label=message)
-
-        if align_right:
-            # Add the message sizer to the ChatMessage panel
-            self.sizer.Add(self.message_label, 0, wx.ALIGN_RIGHT)
-        else:
-            self.sizer.AddSpacer(self.GAP)
-            # Add the message sizer to the ChatMessage panel
-            self.sizer.Add(self.message_label, 0, wx.ALIGN_LEFT | wx.ALIGN_CENTER)
-
-        # Add the user box to the right of the ChatMessage panel if the message is from the current user
-        if align_right:
-            self.sizer.AddSpacer(self.GAP)
-            self.sizer.Add(self.user_box, 0, wx.ALIGN_RIGHT, border=5)
-
-        self.SetSizer(self.sizer)
-        self.Layout()
-
-    def __str__(self):
-        return f"Chat message object"
-
-
-class FileDescription(wx.Panel):
-    """
-        A panel for displaying a file description- The user box alongside the file name and size
-        """
-
-    def __init__(self, parent, user: User, chat_id: int, file_name: str, file_size: int, file_hash: str,
-                 align_right=False):
-        """
-            Initializes the FileDescription panel.
-            :param parent: The parent of the FileDescription panel.
-            :type parent: wx.Window
-            :param user: The user who sent the file.
-            :type user: User
-            :param chat_id: The ID of the chat the file was sent in.
-            :type chat_id: int
-            :param file_name: The name of the file.
-            :type file_name: str
-            :param file_size: The size of the file in bytes.
-            :type file_size: int
-            :param file_hash: The hash of the file.
-            :type file_hash: str
-            :param align_right: Whether to align the file description to the right of the panel.
-            :type align_right: bool
-            """
-        super(FileDescription, self).__init__(parent)
-        self.file_name = file_name
-        self.file_size = file_size
-        self.sender = user
-        self.file_hash = file_hash
-        self.chat_id = chat_id
-        self.parent = parent
-        self.GAP = 40
-        self.SetBackgroundColour(wx.Colour(194, 194, 194))
-
-        self.sizer = wx.BoxSizer(wx.HORIZONTAL)
-
-        self.user_box = UserBox(self, user, align_right=align_right)
-
-        if not align_right:
-            self.sizer.Add(self.user_box, 0, wx.ALIGN_LEFT, border=5)
-            self.sizer.AddSpacer(self.GAP)
-
-        # Add a label with the file name
-        self.file_name_label = wx.StaticText(self, label=file_name)
-        self.sizer.Add(self.file_name_label, 1, wx.ALIGN_LEFT | wx.ALIGN_CENTER)
-
-        # Add a label with the file size
-        self.file_size_label = wx.StaticText(self, label=f'{round(file_size / 1000000, 2)} mb')
-        self.sizer.Add(self.file_size_label, 1, wx.ALIGN_LEFT | wx.ALIGN_CENTER)
-
-        # Add a button to download the file
-        self.download_button = wx.Button(self, label='Download')
-        self.download_button.Bind(wx.EVT_BUTTON, self.onDownload)
-        self.sizer.Add(self.download_button, 1, wx.ALIGN_LEFT | wx.ALIGN_CENTER)
-
-        if align_right:
-            self.sizer.AddSpacer(self.GAP)
-            self.sizer.Add(self.user_box, 0, wx.ALIGN_RIGHT, border=5)
-
-        self.SetSizer(self.sizer)
-
-    def onDownload(self, event):
-        """
-            Called when the user clicks the download button.
-            :param event: The event that triggered the function call.
-            :type event: wx.Event
-            """
-        # Construct a message to request the file from the server
-        msg = Protocol.request_file(self.file_hash)
-        # Send the message to the server
-        self.parent.parent.GetParent().parent.parent.general_com.send_data(msg)
-
-
 class GroupsSwitcher(wx.BoxSizer):
     """
     A box sizer for switching between groups
@@ -1602,63 +1920,248 @@ class GroupsSwitcher(wx.BoxSizer):
         self.add_member_dialog = SelectFriendDialog(self.parent,
                                                     [friend.username for friend in main_gui.MainPanel.my_friends])
         self.current_group_id = -1
+        # The state of every chat's paginated history where the key is the chat id, see new_history
+        self.histories = {}
+        # The history pages received for chats which weren't shown yet, built when the chat is shown
+        self.pending_histories = {}
 
         pub.subscribe(self.onTextMessage, 'text_message')
         pub.subscribe(self.onFileDescription, 'file_description')
         pub.subscribe(self.onGroupMembers, 'group_members')
         pub.subscribe(self.onChatHistory, 'chat_history')
 
-    def onChatHistory(self, messages, chat_id):
+    def request_history(self, chat_id):
         """
-        Called when the client receives a chat history from the server.
+        Shows the next older page of a chat's history, the latest page if none was loaded yet.
+        Pages are read from the local message store when it has them, and requested from the server otherwise.
         :param chat_id: The ID of the chat.
         :type chat_id: int
-        :param messages: The messages in the chat history.
+        :return: None
+        """
+        history = self.histories.setdefault(chat_id, self.new_history())
+        if history['loading'] or not history['has_more']:
+            return
+
+        history['loading'] = True
+        # The stored messages are read and decrypted off the GUI thread
+        threading.Thread(target=self.load_stored_history, args=(chat_id, history), daemon=True).start()
+
+    @staticmethod
+    def new_history():
+        """
+        Creates the state of a chat's paginated history
+        :return: The cursor of the next older page, whether there are older pages, whether a page is being loaded,
+        whether the page being loaded is the delta since the newest stored message, the ID of that message,
+        the pages of the delta received so far, whether the latest page was requested because nothing of the chat
+        is stored, whether the latest messages are shown and the new messages received before they were shown
+        :rtype: dict
+        """
+        return {'oldest_id': None, 'has_more': True, 'loading': False, 'delta': False, 'newest_stored_id': None,
+                'delta_pages': [], 'requested_latest': False, 'synced': False, 'held': []}
+
+    def load_stored_history(self, chat_id, history):
+        """
+        Reads the next older page of a chat's history from the message store, runs on a thread of its own.
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
+        :param history: The state of the chat's history when the page was requested.
+        :type history: dict
+        :return: None
+        """
+        stored = MessageStore.load_messages(chat_id, history['oldest_id'], HISTORY_PAGE_SIZE)
+        wx.CallAfter(self.onStoredHistory, chat_id, history, stored)
+
+    def onStoredHistory(self, chat_id, history, stored):
+        """
+        Called with a page of a chat's history read from the message store,
+        the page is requested from the server if it isn't stored.
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
+        :param history: The state of the chat's history when the page was requested.
+        :type history: dict
+        :param stored: The stored messages in the page, from the newest to the oldest.
+        :type stored: list
+        :return: None
+        """
+        # The chats were reset while the page was read
+        if self.histories.get(chat_id) is not history:
+            return
+
+        if stored:
+            history['loading'] = False
+            is_latest_page = history['oldest_id'] is None
+            history['oldest_id'] = stored[-1]['message_id']
+            self.show_history_page(chat_id, stored, is_latest_page)
+            if is_latest_page:
+                # Only the messages sent after the newest stored message are requested from the server
+                history['loading'] = True
+                history['delta'] = True
+                history['newest_stored_id'] = stored[0]['message_id']
+                msg = Protocol.get_chat_history(chat_id, after_id=history['newest_stored_id'])
+                self.parent.parent.parent.general_com.send_data(msg)
+            return
+
+        # Nothing of the chat is stored, so the latest page starts the stored messages
+        history['requested_latest'] = history['oldest_id'] is None
+        msg = Protocol.get_chat_history(chat_id, history['oldest_id'], HISTORY_PAGE_SIZE)
+        self.parent.parent.parent.general_com.send_data(msg)
+
+    def onChatHistory(self, messages, chat_id, oldest_id=None, has_more=False):
+        """
+        Called when the client receives a page of a chat history from the server.
+        The messages are shown only once the chat is shown.
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
+        :param messages: The messages in the page, from the newest to the oldest.
+        :type messages: list
+        :param oldest_id: The ID of the oldest message in the page, the cursor of the next older page.
+        :type oldest_id: int
+        :param has_more: Whether there are older messages.
+        :type has_more: bool
+        """
+        if chat_id not in self.groups:
+            return
+
+        # A latest page this client didn't request (e.g. the bootstrap's) may not join up with the stored messages,
+        # so it's dropped and the chat's history is read from the store (and the delta requested) when it's shown
+        history = self.histories.get(chat_id)
+        requested = history is not None and (history['delta'] or history['requested_latest']
+                                             or history['oldest_id'] is not None)
+        if not requested and MessageStore.connection:
+            return
+        history = self.histories.setdefault(chat_id, self.new_history())
+
+        # The messages sent since the newest stored message, paged from the newest message down to it
+        if history['delta']:
+            history['delta_pages'].append(messages)
+            if messages and has_more and oldest_id is not None:
+                msg = Protocol.get_chat_history(chat_id, oldest_id, after_id=history['newest_stored_id'])
+                self.parent.parent.parent.general_com.send_data(msg)
+                return
+
+            history['loading'] = False
+            history['delta'] = False
+            delta = [message for page in history['delta_pages'] for message in page]
+            history['delta_pages'] = []
+            # The whole delta joins up with the stored messages, so the new messages can be stored from now on
+            threading.Thread(target=MessageStore.synced, args=(chat_id, delta), daemon=True).start()
+            # Added below the stored messages already shown
+            entries = self.history_entries(delta)
+            entries.reverse()
+            self.groups[chat_id][0].add_messages(entries)
+            self.show_held_messages(chat_id)
+            return
+
+        history['loading'] = False
+        # The latest page replaces the messages shown, older pages are added above them
+        is_latest_page = history['oldest_id'] is None
+        history['oldest_id'] = oldest_id
+        # Without a cursor there is no way to ask for older messages
+        history['has_more'] = has_more and oldest_id is not None
+        if is_latest_page and history['requested_latest']:
+            # The latest page was requested because nothing of the chat is stored, so it starts the stored messages
+            history['requested_latest'] = False
+            threading.Thread(target=MessageStore.synced, args=(chat_id, messages), daemon=True).start()
+        elif not is_latest_page and chat_id in MessageStore.synced_chats:
+            # The page is right before the oldest message shown, which is stored once the chat was synced
+            threading.Thread(target=MessageStore.store_messages, args=(chat_id, messages), daemon=True).start()
+
+        if chat_id != self.current_group_id:
+            pages = self.pending_histories.setdefault(chat_id, [])
+            if is_latest_page:
+                pages.clear()
+            pages.append((messages, is_latest_page))
+            return
+
+        self.show_history_page(chat_id, messages, is_latest_page)
+        self.show_held_messages(chat_id)
+
+    def show_history_page(self, chat_id, messages, is_latest_page):
+        """
+        Adds the messages of a history page to the top of the chat.
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
+        :param messages: The messages in the page, from the newest to the oldest.
         :type messages: list
+        :param is_latest_page: Whether the page replaces the messages shown.
+        :type is_latest_page: bool
+        :return: None
+        """
+        messages_panel = self.groups[chat_id][0]
+        if is_latest_page:
+            messages_panel.reset_messages()
+
+        # Add the page at once, the latest page scrolls to the bottom and older pages keep the shown messages in place
+        entries = self.history_entries(messages)
+        entries.reverse()
+        messages_panel.add_messages(entries, top=True, scroll=is_latest_page)
+
+    def show_held_messages(self, chat_id):
+        """
+        Adds the new messages which were received before the latest messages of a chat were shown,
+        below the latest messages.
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
+        :return: None
         """
-        self.groups[chat_id][0].reset_messages()
+        history = self.histories[chat_id]
+        history['synced'] = True
+        held, history['held'] = history['held'], []
+        self.groups[chat_id][0].add_messages(held)
 
+    def add_new_message(self, chat_id, entry: MessageEntry):
+        """
+        Adds a new message to the bottom of a chat, or holds it while the latest messages of the chat are loading
+        so the history isn't added below it.
+        :param chat_id: The ID of the chat.
+        :type chat_id: int
+        :param entry: The message.
+        :type entry: MessageEntry
+        :return: None
+        """
+        history = self.histories.get(chat_id)
+        if history and not history['synced']:
+            history['held'].append(entry)
+        else:
+            self.groups[chat_id][0].add_messages([entry])
+
+    @staticmethod
+    def history_entries(messages):
+        """
+        Creates the entries of the messages of a history page, which were decrypted by the network side.
+        :param messages: The messages, with the decrypted text of the text messages.
+        :type messages: list
+        :return: The entries of the messages, in the same order.
+        :rtype: list
+        """
+        entries = []
         for msg in messages:
-            sender = msg['sender']
-            chat_id = msg['chat_id']
-            sender_user = main_gui.MainPanel.get_user_by_name(sender)
-            try:
-                chat_key = KeysManager.get_chat_key(chat_id)
-            except KeyError:
-                pass
+            sender_user = main_gui.MainPanel.get_user_by_name(msg['sender'])
+            if msg['opname'] == 'text_message':
+                entries.append(MessageEntry(sender_user, text=msg['text'], message_id=msg.get('message_id')))
             else:
-                if msg['opname'] == 'text_message':
-                    raw_msg = msg['message']
-                    decrypted_message = AESCipher.decrypt(chat_key, raw_msg)
-                    self.groups[chat_id][0].add_text_message_top(sender_user, decrypted_message)
-                else:
-                    # File description
-                    filename = msg['file_name']
-                    file_size = msg['file_size']
-                    file_hash = msg['file_hash']
-                    self.groups[chat_id][0].add_file_description_top(sender_user, chat_id, filename, file_size,
-                                                                     file_hash)
-
-    def onTextMessage(self, sender, chat_id, raw_message):
+                # File description
+                entries.append(MessageEntry(sender_user, chat_id=msg['chat_id'], file_name=msg['file_name'],
+                                            file_size=msg['file_size'], file_hash=msg['file_hash'],
+                                            message_id=msg.get('message_id')))
+        return entries
+
+    def onTextMessage(self, sender, chat_id, message, message_id=None):
         """
         Called when the client receives a text message from the server.
         :param sender: The sender of the message.
         :type sender: str
         :param chat_id: The id of the chat the message was sent to.
         :type chat_id: int
-        :param raw_message: The raw message.
-        :type raw_message: str
+        :param message: The message, decrypted by the network side.
+        :type message: str
+        :param message_id: The id of the message.
+        :type message_id: int
         """
-        try:
-            chat_key = KeysManager.get_chat_key(chat_id)
-        except Exception:
-            pass
-        else:
-            decrypted_message = AESCipher.decrypt(chat_key, raw_message)
-            sender_user = main_gui.MainPanel.get_user_by_name(sender)
-            self.groups[chat_id][0].add_text_message(sender_user, decrypted_message)
+        sender_user = main_gui.MainPanel.get_user_by_name(sender)
+        self.add_new_message(chat_id, MessageEntry(sender_user, text=message, message_id=message_id))
 
-    def onFileDescription(self, chat_id, file_name, file_size, sender, file_hash):
+    def onFileDescription(self, chat_id, file_name, file_size, sender, file_hash, message_id=None):
         """
         Called when the client receives a file description from the server.
         :param chat_id: The id of the chat the file was sent to.
@@ -1671,9 +2174,12 @@ class GroupsSwitcher(wx.BoxSizer):
         :type sender: str
         :param file_hash: The hash of the file.
         :type file_hash: str
+        :param message_id: The id of the message.
+        :type message_id: int
         """
         sender_user = main_gui.MainPanel.get_user_by_name(sender)
-        self.groups[chat_id][0].add_file_description(sender_user, chat_id, file_name, file_size, file_hash)
+        self.add_new_message(chat_id, MessageEntry(sender_user, chat_id=chat_id, file_name=file_name,
+                                                   file_size=file_size, file_hash=file_hash, message_id=message_id))
 
     def onGroupMembers(self, chat_id, usernames):
         """
@@ -1702,7 +2208,7 @@ class GroupsSwitcher(wx.BoxSizer):
 
         # Create the group members panel.
         group_members = UsersScrollPanel(group_panel)
-        group_messages = MessagesPanel(group_panel)
+        group_messages = MessagesPanel(group_panel, on_scroll_top=lambda: self.request_history(group_id))
         chat_tools = ChatTools(group_panel, group_id)
         chat_sizer = wx.BoxSizer(wx.VERTICAL)
         chat_sizer.Add(group_messages, 6, wx.EXPAND)
@@ -1787,6 +2293,8 @@ class GroupsSwitcher(wx.BoxSizer):
             self.Remove(0)
         self.groups_panels = {}
         self.groups = {}
+        self.histories = {}
+        self.pending_histories = {}
 
     def Show(self, chat_id):
         """
@@ -1802,6 +2310,15 @@ class GroupsSwitcher(wx.BoxSizer):
                 group_panel.Show()
                 self.current_group_id = chat_id
                 wx.CallAfter(group_panel.Refresh)
+
+                # Show the history pages received in the background, or fetch the latest page
+                pages = self.pending_histories.pop(chat_id, None)
+                if pages:
+                    for messages, is_latest_page in pages:
+                        self.show_history_page(chat_id, messages, is_latest_page)
+                    self.show_held_messages(chat_id)
+                elif chat_id not in self.histories:
+                    self.request_history(chat_id)
                 # wx.CallAfter(self.groups[id_][0].Scroll, 0, self.groups[id_][0].GetVirtualSize()[1])
             else:
                 # and hide the rest
@@ -2144,3 +2661,39 @@ def resize_image_keep_ratio(image, target_width):
 
     image = image.Scale(new_width, new_height, quality=wx.IMAGE_QUALITY_HIGH)
     return image
+
+
+def _benchmark_history(sizes=(1000, 10000)):
+    """
+    Compares the time it takes to add and paint a chat history one message at a time and in a single batch
+    :param sizes: The amounts of messages in the histories
+    :return: -
+    """
+    app = wx.App()
+    frame = wx.Frame(None, size=(800, 600))
+    panel = MessagesPanel(frame)
+    frame.Show()
+    sender = User(username='benchmark', status='online')
+
+    print(f'{"messages":>10} {"one by one ms":>14} {"batch ms":>10}')
+    for size in sizes:
+        entries = [MessageEntry(sender, text=f'message number {i}') for i in range(size)]
+        times = []
+        for add in (lambda: [panel.add_text_message_top(entry.sender, entry.text, scroll=False) for entry in entries],
+                    lambda: panel.add_messages(entries, top=True, scroll=False)):
+            panel.reset_messages()
+            start = time.perf_counter()
+            add()
+            # Paint the rows
+            panel.Update()
+            times.append(time.perf_counter() - start)
+        print(f'{size:>10} {times[0] * 1000:>14.1f} {times[1] * 1000:>10.1f}')
+
+    frame.Destroy()
+    app.Destroy()
+
+
+if __name__ == '__main__':
+    _benchmark_history()
+    # The event loop thread of main_gui keeps the process alive
+    os._exit(0)
@@ -1,3 +1,4 @@
+import time
 import src.gui.gui_util as gui_util
 from src.core.client_protocol import Protocol
 import wx
@@ -169,7 +170,11 @@ class RegisterPanel(wx.Panel):
 
         # Pass the username and password to the main program...
         if not error_str:
-            msg = Protocol.register(username, password)
+            try:
+                msg = Protocol.register(username, password)
+            except ValueError as e:
+                wx.MessageBox(str(e), 'Error', wx.OK | wx.ICON_ERROR)
+                return
             self.parent.general_com.send_data(msg)
 
     def toLogin(self, event):
@@ -342,8 +347,14 @@ class LoginPanel(wx.Panel):
 
         # Pass the username and password to the main program...
         if not error_str:
+            try:
+                msg = Protocol.sign_in(username, password)
+            except ValueError as e:
+                wx.MessageBox(str(e), 'Error', wx.OK | wx.ICON_ERROR)
+                return
             gui_util.User.this_user = main_gui.MainPanel.get_user_by_name(username=username)
-            msg = Protocol.sign_in(username, password)
+            # Measure the time from the login to the first paint of the main panel
+            self.parent.login_time = time.perf_counter()
             self.parent.general_com.send_data(msg)
 
     def toRegister(self, event):
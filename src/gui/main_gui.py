@@ -1,6 +1,7 @@
 import asyncio
 import os
 import threading
+import time
 import wx
 import wx.adv
 import wx.media
@@ -10,7 +11,10 @@ from src.core.client_protocol import Protocol
 from pubsub import pub
 import wx.lib.mixins.inspection
 from src.handlers.file_handler import FileHandler
+from src.handlers.message_store import MessageStore
 from src.core.keys_manager import KeysManager
+from src.core.cryptions import CipherContext
+import config
 
 # Create a new event loop
 loop = asyncio.new_event_loop()
@@ -19,13 +23,13 @@ loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
 
-# Start the event loop in a separate thread
+# Start the event loop in a separate thread, which doesn't keep the process running by itself
 def start_loop(loop):
     asyncio.set_event_loop(loop)
     loop.run_forever()
 
 
-threading.Thread(target=start_loop, args=(loop,)).start()
+threading.Thread(target=start_loop, args=(loop,), daemon=True).start()
 
 
 class MainPanel(wx.Panel):
@@ -160,6 +164,13 @@ class MainPanel(wx.Panel):
         pub.subscribe(self.onVideoInfo, 'video_info')
         pub.subscribe(self.onVoiceJoined, 'voice_joined')
         pub.subscribe(self.onVideoJoined, 'video_joined')
+        pub.subscribe(self.onVoiceStats, 'voice_stats')
+
+        # Whether the state of the chats is requested at once, so the chats list shouldn't request it per chat
+        self.bootstrapping = False
+        # Open the messages stored in the previous sessions of the user, before any chat is shown
+        if config.store_messages:
+            MessageStore.initialize(f'{FileHandler.base_path}\\{gui_util.User.this_user.username}_messages.db')
         self.load_friends()
 
 
@@ -180,11 +191,10 @@ class MainPanel(wx.Panel):
         :param username: The user's username
         :return: None
         """
+        # The picture was saved by the network side
         if username == gui_util.User.this_user.username:
-            FileHandler.save_pfp(contents, username)
             asyncio.run_coroutine_threadsafe(update_pic_async(gui_util.User.this_user), loop=asyncio.get_event_loop())
         else:
-            FileHandler.save_pfp(contents, username)
             user = MainPanel.get_user_by_name(username)
             asyncio.run_coroutine_threadsafe(update_pic_async(user), loop=asyncio.get_event_loop())
 
@@ -229,11 +239,12 @@ class MainPanel(wx.Panel):
                 self.groups_panel.sizer.add_group(chat_id, [gui_util.User.this_user, user])
                 add_to_friends_panel.append(user)
 
-                self.request_user_pfp(other_username)
-                # Construct a message to request the user's status
-                msg = Protocol.request_user_status(other_username)
-                # Send the message to the server
-                self.parent.general_com.send_data(msg)
+                if not self.bootstrapping:
+                    self.request_user_pfp(other_username)
+                    # Construct a message to request the user's status
+                    msg = Protocol.request_user_status(other_username)
+                    # Send the message to the server
+                    self.parent.general_com.send_data(msg)
             else:
                 # If it's a group chat
                 # Create a user object for the group
@@ -243,55 +254,88 @@ class MainPanel(wx.Panel):
                 # Create a new group in the groups panel and add the current user to it
                 self.groups_panel.sizer.add_group(chat_id, [gui_util.User.this_user])
                 add_to_friends_panel.append(group_user)
-                # Send a message to the server requesting a list of the group's members
-                msg = Protocol.request_group_members(chat_id)
-                self.parent.general_com.send_data(msg)
-
-            # Request every chat's messages history
-            msg = Protocol.get_chat_history(chat_id)
-            self.parent.general_com.send_data(msg)
+                if not self.bootstrapping:
+                    # Send a message to the server requesting a list of the group's members
+                    msg = Protocol.request_group_members(chat_id)
+                    self.parent.general_com.send_data(msg)
 
         # Add the users to the friends panel
         self.friends_panel.add_users(add_to_friends_panel)
+        self.bootstrapping = False
+
+        if self.parent.login_time is not None:
+            self.parent.login_metrics = {'chats': len(chats),
+                                         'chats_list_ms': round((time.perf_counter() - self.parent.login_time) * 1000)}
+            # The idle event comes once the pending events, including the paint events, were handled
+            self.Bind(wx.EVT_IDLE, self.onFirstPaint)
+
+    def onFirstPaint(self, event):
+        """
+        Measures the time from the login to the first paint of the chats
+        :param event: The wx event
+        :type event: wx.IdleEvent
+        :return: None
+        """
+        self.Unbind(wx.EVT_IDLE, handler=self.onFirstPaint)
+        event.Skip()
+        if self.parent.login_time is not None:
+            self.parent.login_metrics['first_paint_ms'] = round((time.perf_counter() - self.parent.login_time) * 1000)
+            self.parent.login_time = None
 
     def load_friends(self):
         """
         Load the user's friends list
         :return: None
         """
+        if config.batched_bootstrap:
+            # Request the chats with their members, statuses, histories and changed pictures at once
+            pfps_hashes = FileHandler.get_pfps_hashes()
+            self.bootstrapping = True
+            msg = Protocol.request_bootstrap(list(pfps_hashes.keys()), list(pfps_hashes.values()))
+            self.parent.general_com.send_data(msg)
+            return
+
         # Request the list of chats
         msg = Protocol.request_chats()
         self.parent.general_com.send_data(msg)
 
         self.request_user_pfp(gui_util.User.this_user.username)
 
-    def onVoiceInfo(self, chat_id, ips, usernames):
+    def onVoiceInfo(self, chat_id, ips, usernames, ciphers):
         """
         Handle the voice call info
         """
         if self.voice_call_window:
-            self.voice_call_window.onVoiceInfo(chat_id, ips, usernames)
+            self.voice_call_window.onVoiceInfo(chat_id, ips, usernames, ciphers)
 
-    def onVideoInfo(self, chat_id, ips, usernames):
+    def onVideoInfo(self, chat_id, ips, usernames, ciphers):
         """
         Handle the video call info
         """
         if self.video_call_window:
-            self.video_call_window.onVideoInfo(chat_id, ips, usernames)
+            self.video_call_window.onVideoInfo(chat_id, ips, usernames, ciphers)
 
-    def onVoiceJoined(self, chat_id, ip, username):
+    def onVoiceJoined(self, chat_id, ip, username, cipher):
         """
         Handle the voice call join
         """
         if self.voice_call_window:
-            self.voice_call_window.onVoiceJoined(chat_id, ip, username)
+            self.voice_call_window.onVoiceJoined(chat_id, ip, username, cipher)
 
-    def onVideoJoined(self, chat_id, ip, username):
+    def onVideoJoined(self, chat_id, ip, username, cipher):
         """
         Handle the video call join
         """
         if self.video_call_window:
-            self.video_call_window.onVideoJoined(chat_id, ip, username)
+            self.video_call_window.onVideoJoined(chat_id, ip, username, cipher)
+
+    def onVoiceStats(self, chat_id, stats, probe):
+        """
+        Handle the statistics of the call members' audio and of this user's audio
+        """
+        for window in (self.voice_call_window, self.video_call_window):
+            if window:
+                window.onVoiceStats(chat_id, stats, probe)
 
     def onAddFriendAnswer(self, is_valid):
         """
@@ -323,7 +367,11 @@ class MainPanel(wx.Panel):
                     f()
                     return
                 # Construct a message to add a new friend
-                msg = Protocol.add_friend(friend_username)
+                try:
+                    msg = Protocol.add_friend(friend_username)
+                except ValueError as e:
+                    wx.MessageBox(str(e), 'Error', wx.OK | wx.ICON_ERROR)
+                    return
                 # Send the message to the server
                 self.parent.general_com.send_data(msg)
 
@@ -436,7 +484,11 @@ class MainPanel(wx.Panel):
                 # Get the chosen group name
                 group_name = self.group_creation_window.group_name
                 # Construct a message to create a new group
-                msg = Protocol.create_group(group_name)
+                try:
+                    msg = Protocol.create_group(group_name)
+                except ValueError as e:
+                    wx.MessageBox(str(e), 'Error', wx.OK | wx.ICON_ERROR)
+                    return
                 # Send the message to the server
                 self.parent.general_com.send_data(msg)
 
@@ -500,10 +552,10 @@ class MainPanel(wx.Panel):
 
         dialog = self.incoming_calls[chat_id]
         if dialog.call_type == 'video':
-            msg = Protocol.join_video(chat_id)
+            msg = Protocol.join_video(chat_id, config.cipher)
             self.onVideo(chat_id)
         else:
-            msg = Protocol.join_voice(chat_id)
+            msg = Protocol.join_voice(chat_id, config.cipher)
             self.onVoice(chat_id)
 
         wx.CallAfter(dialog.Destroy)
@@ -552,7 +604,7 @@ class MainPanel(wx.Panel):
 
         # If the call was started by the current user, send a start voice message to the server
         if type(event) != int:
-            msg = Protocol.start_voice(chat_id)
+            msg = Protocol.start_voice(chat_id, config.cipher)
             self.parent.general_com.send_data(msg)
 
         # Create a sound object
@@ -590,7 +642,7 @@ class MainPanel(wx.Panel):
 
         # If the call was started by the current user, send a start voice message to the server
         if type(event) != int:
-            msg = Protocol.start_video(chat_id)
+            msg = Protocol.start_video(chat_id, config.cipher)
             self.parent.general_com.send_data(msg)
 
         # Create a sound object
@@ -610,6 +662,9 @@ class MainPanel(wx.Panel):
 
         # Clear the current user
         gui_util.User.this_user = None
+        MessageStore.close()
+        KeysManager.decrypted_messages.clear()
+        CipherContext.clear()
 
         # Close all sub-windows
         if self.voice_call_window:
@@ -631,9 +686,15 @@ class MainPanel(wx.Panel):
         self.friends_panel.reset_friends()
         self.groups_panel.sizer.reset_groups()
         self.groups_panel.sizer.current_group_id = None
-        threading.Thread(target=lambda: self.parent.general_com.reconnect()).start()
-        threading.Thread(target=lambda: self.parent.chats_com.reconnect()).start()
-        threading.Thread(target=lambda: self.parent.files_com.reconnect()).start()
+
+        def reconnect():
+            # The channels carried on the general connection reconnect after it started reconnecting, since they
+            # move to connections of their own if the server doesn't multiplex the new connection
+            self.parent.general_com.reconnect()
+            threading.Thread(target=lambda: self.parent.chats_com.reconnect()).start()
+            threading.Thread(target=lambda: self.parent.files_com.reconnect()).start()
+
+        threading.Thread(target=reconnect).start()
         # Move back to the login panel
         self.parent.logout()
 
@@ -705,6 +766,10 @@ class MainFrame(wx.Frame):
         self.login_panel = login_gui.LoginPanel(self)
         self.register_panel = login_gui.RegisterPanel(self)
         self.main_panel = None
+        # The time the user logged in at, until the main panel is first painted
+        self.login_time = None
+        # The amount of chats of the last login and the milliseconds from it to the chats list and to its first paint
+        self.login_metrics = {}
 
         self.panel_switcher = gui_util.PanelsSwitcher(self, [self.login_panel, self.register_panel])
 
@@ -805,6 +870,7 @@ class MainFrame(wx.Frame):
         # Delete the keys
         KeysManager.last_password = None
         KeysManager.chats_keys = {}
+        KeysManager.awaiting_key = {}
         wx.GetApp().ExitMainLoop()
 
 
@@ -1,11 +1,101 @@
 import datetime
 import hashlib
 import os
+import tempfile
+
+
+class FileDownload:
+    """
+    A file being downloaded straight to disk. The chunks are written to a temporary file next to the
+    destination, which replaces the destination only when the download is complete.
+    """
+
+    def __init__(self, chat_id: int, file_hash: str, path: str, file_name: str = None):
+        """
+        Creates a new download.
+
+        :param chat_id: The id of the chat the file was sent in.
+        :type chat_id: int
+        :param file_hash: The hash of the file.
+        :type file_hash: str
+        :param path: The path to save the file to.
+        :type path: str
+        :param file_name: The name the file was sent with.
+        :type file_name: str
+        """
+        self.chat_id = chat_id
+        self.file_hash = file_hash
+        self.path = path
+        self.file_name = file_name
+        self.file_size = 0
+        self.bytes_received = 0
+        self.temp_file = None
+        # The hash of the encrypted chunks as they arrive, which is the hash the uploader sent
+        self.hash = hashlib.sha256()
+
+    def start(self, file_size: int):
+        """
+        Opens the temporary file of the download.
+
+        :param file_size: The size of the file in bytes.
+        :type file_size: int
+        :return: None
+        """
+        self.file_size = file_size
+        self.bytes_received = 0
+        self.hash = hashlib.sha256()
+        self.temp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)),
+                                                     prefix='.strife_', suffix='.part', delete=False)
+
+    def write_chunk(self, chunk: bytes, enc_chunk: bytes):
+        """
+        Writes a decrypted chunk of the file to the temporary file.
+
+        :param chunk: The chunk to write.
+        :type chunk: bytes
+        :param enc_chunk: The chunk as it was received, before decrypting it.
+        :type enc_chunk: bytes
+        :return: None
+        """
+        self.temp_file.write(chunk)
+        self.bytes_received += len(chunk)
+        self.hash.update(enc_chunk)
+
+    def verify(self):
+        """
+        Checks whether the whole file was received: its size and the hash of its encrypted chunks.
+
+        :return: Whether the file is complete.
+        :rtype: bool
+        """
+        return self.bytes_received == self.file_size and self.hash.hexdigest() == self.file_hash
+
+    def finish(self):
+        """
+        Closes the temporary file and atomically moves it to the destination path.
+
+        :return: None
+        """
+        self.temp_file.close()
+        os.replace(self.temp_file.name, self.path)
+
+    def abort(self):
+        """
+        Closes and removes the temporary file.
+
+        :return: None
+        """
+        if self.temp_file:
+            self.temp_file.close()
+            if os.path.exists(self.temp_file.name):
+                os.remove(self.temp_file.name)
 
 
 class FileHandler:
     PFPS_PATH = '\\profiles'
     base_path = ''
+    # The files being downloaded, where the key is the hash of the file
+    downloads = {}
 
     @staticmethod
     def initialize(base_path):
@@ -118,6 +208,68 @@ class FileHandler:
             data = f.read()
         return data
 
+    @staticmethod
+    def iter_file(path, chunk_size):
+        """
+        A static method to read a file from a given path in chunks of a fixed size.
+
+        :param path: The path of the file to read.
+        :type path: str
+        :param chunk_size: The size of every chunk in bytes.
+        :type chunk_size: int
+        :return: A generator of the chunks of the file.
+        :rtype: generator[bytes]
+        """
+        with open(path, 'rb') as f:
+            chunk = f.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = f.read(chunk_size)
+
+    @staticmethod
+    def add_download(chat_id: int, file_hash: str, path: str, file_name: str = None):
+        """
+        A static method to register a file that should be downloaded to the given path.
+
+        :param chat_id: The id of the chat the file was sent in.
+        :type chat_id: int
+        :param file_hash: The hash of the file.
+        :type file_hash: str
+        :param path: The path to save the file to.
+        :type path: str
+        :param file_name: The name the file was sent with.
+        :type file_name: str
+        :return: The download object.
+        :rtype: FileDownload
+        """
+        download = FileDownload(chat_id, file_hash, path, file_name)
+        FileHandler.downloads[file_hash] = download
+        return download
+
+    @staticmethod
+    def get_download(file_hash: str):
+        """
+        A static method to get a registered download.
+
+        :param file_hash: The hash of the file.
+        :type file_hash: str
+        :return: The download object, or None if the file isn't being downloaded.
+        :rtype: FileDownload or None
+        """
+        return FileHandler.downloads.get(file_hash)
+
+    @staticmethod
+    def remove_download(file_hash: str):
+        """
+        A static method to remove a registered download.
+
+        :param file_hash: The hash of the file.
+        :type file_hash: str
+        :return: The removed download object, or None if the file wasn't being downloaded.
+        :rtype: FileDownload or None
+        """
+        return FileHandler.downloads.pop(file_hash, None)
+
     @staticmethod
     def get_pfps_info():
         """
@@ -145,4 +297,12 @@ class FileHandler:
 
         return infos
 
+    @staticmethod
+    def get_pfps_hashes():
+        """
+        A static method to get the hashes of all profile pictures stored in the 'profiles' directory.
 
+        :return: A dict of the hash of every picture by its username.
+        :rtype: dict
+        """
+        return {username: FileHandler.get_pfp_hash(username) for username, _ in FileHandler.get_pfps_info()}
@@ -0,0 +1,167 @@
+import json
+import sqlite3
+import threading
+from src.core.keys_manager import KeysManager
+
+
+class MessageStore:
+    """
+    A local cache of the chats' messages keyed by chat id and message id.
+    Every message is encrypted at rest with the key of its chat, which the server sends only after logging in.
+    """
+    connection = None
+    # The connection is shared by the threads handling the server's messages and the GUI thread
+    lock = threading.Lock()
+    # The chats whose stored messages were brought up to date with the server in this session,
+    # only their new messages can be stored without leaving a gap
+    synced_chats = set()
+    # The new messages of the chats which weren't synced yet by chat id, stored once the chat is synced
+    unsynced_messages = {}
+    sync_lock = threading.Lock()
+
+    @staticmethod
+    def initialize(path: str):
+        """
+        Opens the store, creating it if needed.
+
+        :param path: The path of the database file.
+        :type path: str
+        :return: None
+        """
+        MessageStore.close()
+        with MessageStore.lock:
+            MessageStore.connection = sqlite3.connect(path, check_same_thread=False)
+            MessageStore.connection.execute('CREATE TABLE IF NOT EXISTS messages (chat_id INTEGER, message_id INTEGER, '
+                                            'record TEXT, PRIMARY KEY (chat_id, message_id))')
+            MessageStore.connection.commit()
+
+    @staticmethod
+    def close():
+        """
+        Closes the store.
+
+        :return: None
+        """
+        with MessageStore.lock:
+            if MessageStore.connection:
+                MessageStore.connection.close()
+            MessageStore.connection = None
+        with MessageStore.sync_lock:
+            MessageStore.synced_chats = set()
+            MessageStore.unsynced_messages = {}
+
+    @staticmethod
+    def store_messages(chat_id: int, messages: list):
+        """
+        Stores messages of a chat, messages without an id are skipped.
+
+        :param chat_id: The id of the chat.
+        :type chat_id: int
+        :param messages: The messages, as returned by decrypted.
+        :type messages: list[dict]
+        :return: None
+        """
+        if not MessageStore.connection:
+            return
+        try:
+            chat_context = KeysManager.get_chat_context(chat_id)
+        except Exception:
+            return
+
+        rows = [(chat_id, message['message_id'], chat_context.encrypt(json.dumps(message)))
+                for message in messages if type(message.get('message_id')) == int]
+
+        with MessageStore.lock:
+            if MessageStore.connection and rows:
+                MessageStore.connection.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?)', rows)
+                MessageStore.connection.commit()
+
+    @staticmethod
+    def store_new_message(chat_id: int, message: dict):
+        """
+        Stores a new message of a chat, or keeps it until the chat is synced so it doesn't hide the gap before it.
+
+        :param chat_id: The id of the chat.
+        :type chat_id: int
+        :param message: The message, as returned by decrypted.
+        :type message: dict
+        :return: None
+        """
+        if not MessageStore.connection:
+            return
+        with MessageStore.sync_lock:
+            if chat_id not in MessageStore.synced_chats:
+                MessageStore.unsynced_messages.setdefault(chat_id, []).append(message)
+                return
+        MessageStore.store_messages(chat_id, [message])
+
+    @staticmethod
+    def synced(chat_id: int, messages: list):
+        """
+        Stores the messages which bring a chat's stored messages up to date with the server (the latest page, or every
+        message after the newest stored one) and the new messages received meanwhile.
+
+        :param chat_id: The id of the chat.
+        :type chat_id: int
+        :param messages: The messages, as returned by decrypted.
+        :type messages: list[dict]
+        :return: None
+        """
+        with MessageStore.sync_lock:
+            MessageStore.synced_chats.add(chat_id)
+            messages = messages + MessageStore.unsynced_messages.pop(chat_id, [])
+        MessageStore.store_messages(chat_id, messages)
+
+    @staticmethod
+    def decrypted(message):
+        """
+        Returns a message of a chat as it's shown and stored, a dict where text messages hold their decrypted text
+        instead of the encrypted message.
+
+        :param message: The message, as deconstructed by the protocol.
+        :type message: Message or dict
+        :return: The message with its decrypted text.
+        :rtype: dict
+        """
+        if type(message) != dict:
+            message = message.to_dict()
+        if message['opname'] == 'text_message' and 'text' not in message:
+            message['text'] = KeysManager.decrypt_message(message['chat_id'], message.pop('message'),
+                                                          message.get('message_id'))
+        return message
+
+    @staticmethod
+    def load_messages(chat_id: int, before_id=None, limit=50):
+        """
+        Loads a page of the stored messages of a chat.
+
+        :param chat_id: The id of the chat.
+        :type chat_id: int
+        :param before_id: The page ends right before the message with this id (the latest page if not given).
+        :type before_id: int
+        :param limit: The maximum amount of messages in the page.
+        :type limit: int
+        :return: The messages from the newest to the oldest, as returned by decrypted.
+        :rtype: list
+        """
+        with MessageStore.lock:
+            if not MessageStore.connection:
+                return []
+            rows = MessageStore.connection.execute(
+                'SELECT record FROM messages WHERE chat_id = ? AND message_id < ? ORDER BY message_id DESC LIMIT ?',
+                (chat_id, before_id if before_id is not None else 2 ** 63 - 1, limit)).fetchall()
+
+        try:
+            chat_context = KeysManager.get_chat_context(chat_id)
+        except Exception:
+            return []
+
+        messages = []
+        for record, in rows:
+            try:
+                # Messages stored before their text was stored decrypted are decrypted once here
+                messages.append(MessageStore.decrypted(json.loads(chat_context.decrypt(record))))
+            except Exception:
+                # A message stored with an old key of the chat
+                pass
+        return messages
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from src.call.audio_codecs import ADPCMCodec, CODECS, PCMCodec, ULawCodec, codecs_mask, negotiate_codec
+
+RATE = 44100
+CHUNK = 4096
+
+
+def voice_chunks(count=8, seed=0):
+    """
+    Chunks of a voice-like signal: a few harmonics with a syllable envelope, and some noise
+    """
+    t = np.arange(CHUNK * count) / RATE
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)
+    signal = envelope * sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate((180, 360, 720, 1440)))
+    signal = signal * 6000 + np.random.default_rng(seed).normal(0, 200, signal.size)
+    return [signal[i * CHUNK:(i + 1) * CHUNK].astype(np.int16).tobytes() for i in range(count)]
+
+
+def snr(original, decoded):
+    original = np.frombuffer(original, dtype=np.int16).astype(np.float64)
+    error = original - np.frombuffer(decoded, dtype=np.int16)
+    return 10 * np.log10(np.sum(original ** 2) / max(np.sum(error ** 2), 1))
+
+
+@pytest.mark.parametrize('codec_class', CODECS.values(), ids=CODECS.keys())
+def test_round_trip_keeps_the_chunk_size(codec_class):
+    codec = codec_class()
+    for pcm in voice_chunks():
+        assert len(codec_class.decode(codec.encode(pcm))) == len(pcm)
+
+
+def test_pcm_round_trip_is_exact():
+    codec = PCMCodec()
+    for pcm in voice_chunks():
+        assert PCMCodec.decode(codec.encode(pcm)) == pcm
+
+
+def test_ulaw_round_trip():
+    codec = ULawCodec()
+    for pcm in voice_chunks():
+        encoded = codec.encode(pcm)
+        assert len(encoded) == len(pcm) // 2
+        assert snr(pcm, ULawCodec.decode(encoded)) > 30
+
+
+def test_ulaw_keeps_silence_and_full_scale():
+    codec = ULawCodec()
+    silence = bytes(CHUNK * 2)
+    assert ULawCodec.decode(codec.encode(silence)) == silence
+
+    extremes = np.array([-32768, 32767] * (CHUNK // 2), dtype=np.int16)
+    decoded = np.frombuffer(ULawCodec.decode(codec.encode(extremes.tobytes())), dtype=np.int16)
+    assert np.all(np.abs(decoded.astype(np.int32) - extremes) <= 1)
+
+
+@pytest.mark.skipif('adpcm' not in CODECS, reason='audioop is not available')
+def test_adpcm_round_trip():
+    codec = ADPCMCodec()
+    for pcm in voice_chunks():
+        encoded = codec.encode(pcm)
+        assert len(encoded) == ADPCMCodec.STATE.size + len(pcm) // 4
+        assert snr(pcm, ADPCMCodec.decode(encoded)) > 15
+
+
+@pytest.mark.skipif('adpcm' not in CODECS, reason='audioop is not available')
+def test_adpcm_chunks_decode_on_their_own():
+    # Every chunk carries the state of the encoder, so a lost chunk doesn't change how the next one decodes
+    codec = ADPCMCodec()
+    chunks = voice_chunks(4)
+    encoded = [codec.encode(pcm) for pcm in chunks]
+    in_order = [ADPCMCodec.decode(data) for data in encoded]
+    assert ADPCMCodec.decode(encoded[3]) == in_order[3]
+    assert snr(chunks[3], ADPCMCodec.decode(encoded[3])) > 15
+
+
+def test_codecs_mask():
+    assert codecs_mask([PCMCodec]) == 1 << PCMCodec.ID
+    assert codecs_mask([PCMCodec, ULawCodec]) == (1 << PCMCodec.ID) | (1 << ULawCodec.ID)
+
+
+def test_negotiate_prefers_the_configured_codec():
+    mask = codecs_mask()
+    assert negotiate_codec([mask, mask], 'ulaw') is ULawCodec
+    assert negotiate_codec([mask, mask], 'pcm') is PCMCodec
+
+
+def test_negotiate_picks_a_codec_every_member_decodes():
+    only_pcm = codecs_mask([PCMCodec])
+    assert negotiate_codec([codecs_mask(), only_pcm], 'ulaw') is PCMCodec
+    assert negotiate_codec([codecs_mask([PCMCodec, ULawCodec])], 'adpcm') is ULawCodec
+    # Without a preference the most compressed common codec is chosen
+    assert negotiate_codec([codecs_mask()]) is next(iter(CODECS.values()))
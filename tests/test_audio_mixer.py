@@ -0,0 +1,54 @@
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyaudio')
+
+from src.call.audio_mixer import AudioMixer  # noqa: E402
+
+CHUNK = 256
+
+
+def member(samples, volume=1):
+    pcm = np.asarray(samples, dtype=np.int16).tobytes()
+    return types.SimpleNamespace(jitter_buffer=types.SimpleNamespace(get=lambda: pcm), volume=volume)
+
+
+def mix(*members):
+    # The mixing alone, without opening an output stream
+    mixer = AudioMixer.__new__(AudioMixer)
+    mixer.chunk = CHUNK
+    mixer.users = {str(i): user for i, user in enumerate(members)}
+    return np.frombuffer(mixer.mix(), dtype=np.int16)
+
+
+def test_no_members_is_silence():
+    assert not np.any(mix())
+
+
+def test_members_are_summed():
+    mixed = mix(member(np.full(CHUNK, 1000)), member(np.full(CHUNK, -300)))
+    assert np.all(mixed == 700)
+
+
+def test_loud_members_are_clipped_instead_of_wrapping_around():
+    loud = np.full(CHUNK, 30000)
+    assert np.all(mix(member(loud), member(loud)) == 32767)
+    assert np.all(mix(member(-loud), member(-loud), member(-loud)) == -32768)
+
+
+def test_high_volume_is_clipped():
+    samples = np.tile([20000, -20000, 100, -100], CHUNK // 4)
+    mixed = mix(member(samples, volume=2))
+    assert list(mixed[:4]) == [32767, -32768, 200, -200]
+
+
+def test_volume_and_muted_members():
+    mixed = mix(member(np.full(CHUNK, 1000), volume=0.5), member(np.full(CHUNK, 5000), volume=0))
+    assert np.all(mixed == 500)
+
+
+def test_members_without_an_open_buffer_are_skipped():
+    closed = types.SimpleNamespace(jitter_buffer=None, volume=1)
+    assert np.all(mix(closed, member(np.full(CHUNK, 42))) == 42)
@@ -0,0 +1,152 @@
+import base64
+import random
+
+import pytest
+
+from src.core.client_protocol import Protocol
+
+
+def params_names(params):
+    return [param[0] if type(param) == tuple else param for param in params]
+
+
+def client_messages():
+    return [(channel, name, params_names(params))
+            for channel, messages in Protocol.c_messages.items() for name, (_, params) in messages.items()]
+
+
+def decode_client_message(channel, message):
+    """
+    Decodes a message of the client with the decoders of the client's messages, as a str and (for the files channel)
+    as bytes like the bulk messages are received
+    """
+    records = [Protocol.unprotocol_msg(channel, message.decode(), Protocol.c_decoders)]
+    if channel == 'files':
+        records.append(Protocol.unprotocol_bytes(channel, message, Protocol.c_decoders))
+    return records
+
+
+def decoded_value(record, param_name):
+    value = record[param_name]
+    if type(value) == memoryview:
+        return value.tobytes().decode()
+    return value
+
+
+@pytest.mark.parametrize('channel, name, params', client_messages())
+def test_fuzz_round_trip(channel, name, params):
+    # The alphabet holds the separators, the values holding one have to be rejected instead of corrupting the message
+    rand = random.Random(name)
+    alphabet = 'ab12%\\ שלום@#'
+
+    def random_str(min_length=0):
+        return ''.join(rand.choice(alphabet) for _ in range(rand.randint(min_length, 12)))
+
+    def random_value(param_name):
+        param_type = Protocol.params_types.get(param_name, str)
+        if param_name in Protocol.body_params:
+            return base64.b64encode(rand.randbytes(rand.randint(0, 64))).decode()
+        if type(param_type) == list:
+            # An empty item can't be told apart from an empty list
+            return [rand.randint(0, 10 ** 6) if param_type[0] == int else random_str(1)
+                    for _ in range(rand.randint(0, 5))]
+        if param_type == int:
+            return rand.randint(0, 10 ** 6)
+        return random_str()
+
+    for _ in range(200):
+        values = [random_value(param_name) for param_name in params]
+        if any(separator in str(value) for value in values for separator in '@#'):
+            with pytest.raises(ValueError):
+                Protocol.encode(name, *values)
+            continue
+
+        message = Protocol.encode(name, *values)
+        for record in decode_client_message(channel, message):
+            assert record.opname == name
+            for param_name, value in zip(params, values):
+                assert decoded_value(record, param_name) == value, (name, param_name, message)
+
+
+@pytest.mark.parametrize('value', ['a@b', 'a#b', '@', '#', 'שלום@#'])
+def test_separators_are_rejected(value):
+    with pytest.raises(ValueError, match="can't contain"):
+        Protocol.sign_in(value, 'password')
+    with pytest.raises(ValueError, match="can't contain"):
+        Protocol.sign_in('username', value)
+    with pytest.raises(ValueError, match="can't contain"):
+        Protocol.create_group(value)
+    with pytest.raises(ValueError, match="can't contain"):
+        Protocol.change_status(value)
+    with pytest.raises(ValueError, match="can't contain"):
+        Protocol.file_description('sender', 1, value, 10, 'hash')
+    with pytest.raises(ValueError, match="can't contain"):
+        Protocol.request_bootstrap(['alice', value], ['hash1', 'hash2'])
+
+
+def test_separator_error_names_the_field():
+    with pytest.raises(ValueError, match="^Group name can't contain '@' or '#'$"):
+        Protocol.create_group('a#b')
+
+
+def test_fields_round_trip_with_punctuation():
+    message = Protocol.sign_in('דורון %\\!', 'p a$s&w=rd')
+    assert message == '02@דורון %\\!@p a$s&w=rd'.encode()
+    record, = decode_client_message('general', message)
+    assert record['username'] == 'דורון %\\!'
+    assert record['password'] == 'p a$s&w=rd'
+
+
+def test_zero_padded_fields():
+    assert Protocol.encode('text_message', 7, 'alice', 'aGk=') == b'1@007@alice@aGk='
+
+
+def test_trailing_none_values_are_left_out():
+    assert Protocol.encode('get_chat_history', 5, None, None, None) == b'10@5'
+    assert Protocol.encode('request_chats') == b'19'
+
+
+def test_missing_middle_parameter_is_rejected():
+    with pytest.raises(ValueError, match='Missing parameter'):
+        Protocol.encode('get_chat_history', 5, None, 50, 3)
+
+
+def test_body_fields_are_not_scanned():
+    chunk = base64.b64encode(bytes(range(256)))
+    message = Protocol.file_upload_chunk(3, chunk)
+    for record in decode_client_message('files', message):
+        assert decoded_value(record, 'chunk') == chunk.decode()
+
+
+def test_server_message_lists():
+    record = Protocol.unprotocol_msg('general', '06@3@1.2.3.4#5.6.7.8@alice#bob@gcm#cbc')
+    assert record.opname == 'voice_call_info'
+    assert record['chat_id'] == 3
+    assert record['ips'] == ['1.2.3.4', '5.6.7.8']
+    assert record['usernames'] == ['alice', 'bob']
+    assert record['ciphers'] == ['gcm', 'cbc']
+
+
+def test_server_message_missing_parameters():
+    record = Protocol.unprotocol_msg('general', '06@3@1.2.3.4@alice')
+    assert 'ciphers' not in record
+    assert record.get('ciphers') is None
+    with pytest.raises(KeyError):
+        record['ciphers']
+
+
+def test_server_message_empty_int_field():
+    record = Protocol.unprotocol_msg('chat', '3@@4@@0')
+    assert record.opname == 'chat_history'
+    assert record['messages'] == []
+    assert record['chat_id'] == 4
+    assert record['oldest_id'] is None
+    assert record['has_more'] == 0
+
+
+def test_server_message_bytes():
+    data = b'4@' + b'f' * 64 + b'@' + base64.b64encode(b'chunk@#')
+    record = Protocol.unprotocol_bytes('files', data)
+    assert record.opname == 'file_download_chunk'
+    assert record['file_hash'] == 'f' * 64
+    assert bytes(record['chunk']) == base64.b64encode(b'chunk@#')
@@ -0,0 +1,95 @@
+import random
+import threading
+import time
+
+import pytest
+
+from src.core.dispatcher import OrderedExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = OrderedExecutor(4)
+    yield executor
+    executor.executor.shutdown(wait=True)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def test_tasks_of_a_key_run_in_order(executor):
+    rand = random.Random(0)
+    done = {key: [] for key in range(8)}
+    expected = {key: [] for key in range(8)}
+
+    def task(key, index):
+        # Random durations, so a later task would overtake an earlier one if they ran in parallel
+        time.sleep(rand.random() / 2000)
+        done[key].append(index)
+
+    for index in range(400):
+        key = rand.randrange(8)
+        expected[key].append(index)
+        executor.submit(key, task, key, index)
+
+    wait_for(lambda: sum(map(len, done.values())) == 400)
+    assert done == expected
+
+
+def test_tasks_of_a_key_never_overlap(executor):
+    running = set()
+    overlaps = []
+    counter = [0]
+
+    def task(key):
+        if key in running:
+            overlaps.append(key)
+        running.add(key)
+        time.sleep(0.001)
+        running.discard(key)
+        counter[0] += 1
+
+    for index in range(60):
+        executor.submit(index % 3, task, index % 3)
+
+    wait_for(lambda: counter[0] == 60)
+    assert not overlaps
+
+
+def test_keys_run_in_parallel(executor):
+    # The first key blocks until the second key's task ran, which deadlocks if the keys share a worker
+    second_ran = threading.Event()
+    results = []
+
+    executor.submit('first', lambda: results.append(second_ran.wait(5)))
+    executor.submit('second', second_ran.set)
+
+    wait_for(lambda: results)
+    assert results == [True]
+
+
+def test_failed_task_doesnt_stop_the_next_tasks(executor, capsys):
+    done = []
+
+    def fail():
+        raise RuntimeError('task failed')
+
+    executor.submit('key', done.append, 1)
+    executor.submit('key', fail)
+    executor.submit('key', done.append, 2)
+
+    wait_for(lambda: len(done) == 2)
+    assert done == [1, 2]
+    assert 'task failed' in capsys.readouterr().err
+
+
+def test_key_is_released_when_its_tasks_are_done(executor):
+    done = threading.Event()
+    executor.submit('key', done.set)
+    assert done.wait(5)
+
+    wait_for(lambda: not executor.pending)
@@ -0,0 +1,137 @@
+import types
+
+import numpy as np
+import pytest
+
+import src.call.jitter_buffer as jitter_buffer
+from src.call.jitter_buffer import JitterBuffer
+
+CHUNK = 64
+RATE = 6400
+CHUNK_TIME = CHUNK / RATE
+
+
+def chunk(value):
+    return np.full(CHUNK, value, dtype=np.int16).tobytes()
+
+
+def value(pcm):
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    assert samples.size == CHUNK
+    assert np.all(samples == samples[0])
+    return int(samples[0])
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jitter_buffer, 'time', types.SimpleNamespace(time=clock.time))
+    return clock
+
+
+@pytest.fixture
+def buffer(clock):
+    return JitterBuffer(CHUNK, RATE)
+
+
+def put_on_time(buffer, clock, seq, pcm=None, comfort_noise_level=None):
+    # Every packet arrives exactly when its chunk was sent, so there's no jitter
+    clock.now = 1000.0 + seq * CHUNK_TIME
+    buffer.put(seq % 0x10000, pcm, comfort_noise_level)
+
+
+def test_reordered_packets_play_in_order(buffer, clock):
+    for seq in (0, 2, 1, 3):
+        put_on_time(buffer, clock, seq, chunk(seq + 1))
+    assert [value(buffer.get()) for _ in range(4)] == [1, 2, 3, 4]
+    assert buffer.stats()['lost'] == 0
+
+
+def test_waits_for_the_target_depth(buffer, clock):
+    assert buffer.get() == bytes(CHUNK * 2)
+    put_on_time(buffer, clock, 0, chunk(7))
+    assert value(buffer.get()) == 7
+
+
+def test_lost_packet_is_concealed_with_the_last_chunk_fading(buffer, clock):
+    for seq in (0, 1, 3):
+        put_on_time(buffer, clock, seq, chunk(1000 * (seq + 1)))
+    played = [value(buffer.get()) for _ in range(4)]
+    assert played == [1000, 2000, int(2000 * JitterBuffer.CONCEALMENT_FADE), 4000]
+    assert buffer.stats()['lost'] == 1
+
+
+def test_concealment_turns_to_silence(buffer, clock):
+    last = JitterBuffer.MAX_CONCEALED + 2
+    put_on_time(buffer, clock, 0, chunk(8000))
+    put_on_time(buffer, clock, last, chunk(5))
+    played = [value(buffer.get()) for _ in range(last + 1)]
+    fades = [int(8000 * JitterBuffer.CONCEALMENT_FADE ** i) for i in range(1, JitterBuffer.MAX_CONCEALED + 1)]
+    assert played == [8000] + fades + [0, 5]
+    assert buffer.stats()['lost'] == JitterBuffer.MAX_CONCEALED + 1
+
+
+def test_late_and_duplicate_packets_are_dropped(buffer, clock):
+    put_on_time(buffer, clock, 0, chunk(1))
+    put_on_time(buffer, clock, 1, chunk(2))
+    put_on_time(buffer, clock, 1, chunk(99))
+    assert value(buffer.get()) == 1
+    put_on_time(buffer, clock, 0, chunk(99))
+    assert value(buffer.get()) == 2
+    stats = buffer.stats()
+    assert stats['late'] == 2
+    assert stats['received'] == 4
+
+
+def test_sequence_numbers_wrap_around(buffer, clock):
+    for seq in (0xFFFE, 0x10000, 0xFFFF, 0x10001):
+        put_on_time(buffer, clock, seq, chunk(seq - 0xFFFD))
+    assert [value(buffer.get()) for _ in range(4)] == [1, 2, 3, 4]
+    assert buffer.stats()['lost'] == 0
+
+
+def test_packets_without_sequence_numbers_play_in_arrival_order(buffer):
+    for i in range(3):
+        buffer.put(None, chunk(i + 1))
+    assert [value(buffer.get()) for _ in range(3)] == [1, 2, 3]
+
+
+def test_burst_drops_the_oldest_chunks(buffer, clock):
+    count = JitterBuffer.MAX_DEPTH + 2
+    for seq in range(count):
+        put_on_time(buffer, clock, seq, chunk(seq))
+    assert buffer.stats()['dropped'] == 2
+    assert [value(buffer.get()) for _ in range(JitterBuffer.MAX_DEPTH)] == list(range(2, count))
+
+
+def test_comfort_noise_marker(buffer, clock):
+    put_on_time(buffer, clock, 0, chunk(10))
+    put_on_time(buffer, clock, 1, comfort_noise_level=300)
+    assert value(buffer.get()) == 10
+    noise = np.frombuffer(buffer.get(), dtype=np.int16)
+    assert noise.size == CHUNK and np.any(noise)
+    # Silent until the next talkspurt, which starts again from its first chunk
+    assert np.any(np.frombuffer(buffer.get(), dtype=np.int16))
+    put_on_time(buffer, clock, 9, chunk(20))
+    assert value(buffer.get()) == 20
+    assert buffer.stats()['lost'] == 0
+
+
+def test_depth_follows_the_jitter(buffer, clock):
+    for seq in range(40):
+        # Every other packet is late by two chunks
+        clock.now = 1000.0 + seq * CHUNK_TIME + (2 * CHUNK_TIME if seq % 2 else 0)
+        buffer.put(seq, chunk(seq))
+        buffer.get()
+    stats = buffer.stats()
+    assert stats['target_depth'] > JitterBuffer.MIN_DEPTH
+    assert stats['target_depth'] <= JitterBuffer.MAX_DEPTH
+    assert stats['jitter_ms'] > 0
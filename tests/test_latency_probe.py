@@ -0,0 +1,24 @@
+from src.call.latency_probe import LatencyProbe
+
+
+def test_stats():
+    probe = LatencyProbe()
+    assert probe.stats() == dict.fromkeys(LatencyProbe.GLITCHES, 0)
+
+    for ms in range(1, 101):
+        probe.record_latency(ms / 1000)
+    probe.glitch('output_underflow')
+    stats = probe.stats()
+    assert stats['latency_avg_ms'] == 50.5
+    assert stats['latency_max_ms'] == 100
+    assert 94 <= stats['latency_p95_ms'] <= 96
+    assert stats['output_underflow'] == 1
+
+
+def test_keeps_the_latest_samples():
+    probe = LatencyProbe()
+    for _ in range(LatencyProbe.SAMPLES):
+        probe.record_latency(1)
+    for _ in range(LatencyProbe.SAMPLES):
+        probe.record_latency(0.002)
+    assert probe.stats()['latency_max_ms'] == 2
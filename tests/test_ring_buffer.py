@@ -0,0 +1,87 @@
+import threading
+
+import numpy as np
+
+from src.call.ring_buffer import RingBuffer
+
+
+def pcm(start, count):
+    return np.arange(start, start + count, dtype=np.int16).tobytes()
+
+
+def test_empty_buffer():
+    buffer = RingBuffer(8)
+    assert buffer.available() == 0
+    assert buffer.free() == 8
+    assert buffer.read(1) is None
+
+
+def test_write_and_read():
+    buffer = RingBuffer(8)
+    assert buffer.write(pcm(0, 5)) == 5
+    assert buffer.available() == 5
+    assert buffer.free() == 3
+    assert buffer.read(3) == pcm(0, 3)
+    assert buffer.read(3) is None
+    assert buffer.read(2) == pcm(3, 2)
+
+
+def test_wraparound():
+    buffer = RingBuffer(8)
+    buffer.write(pcm(0, 6))
+    buffer.read(6)
+    # The write and the read both cross the end of the buffer
+    assert buffer.write(pcm(6, 7)) == 7
+    assert buffer.read(7) == pcm(6, 7)
+    assert buffer.write_pos == buffer.read_pos == 13
+
+
+def test_wraparound_many_times():
+    buffer = RingBuffer(10)
+    written = read = 0
+    for size in [3, 7, 9, 1, 10, 4] * 20:
+        assert buffer.write(pcm(written, size)) == size
+        written += size
+        assert buffer.read(size) == pcm(read, size)
+        read += size
+    assert buffer.available() == 0
+
+
+def test_full_buffer_drops_the_newest_samples():
+    buffer = RingBuffer(8)
+    buffer.write(pcm(0, 6))
+    assert buffer.write(pcm(6, 5)) == 2
+    assert buffer.free() == 0
+    assert buffer.write(pcm(100, 1)) == 0
+    assert buffer.read(8) == pcm(0, 8)
+
+
+def test_skip():
+    buffer = RingBuffer(8)
+    buffer.write(pcm(0, 5))
+    buffer.skip()
+    assert buffer.available() == 0
+    buffer.write(pcm(5, 6))
+    assert buffer.read(6) == pcm(5, 6)
+
+
+def test_one_writer_one_reader():
+    buffer = RingBuffer(64)
+    total = 20000
+    received = []
+
+    def writer():
+        written = 0
+        while written < total:
+            written += buffer.write(pcm(written % 30000, min(17, total - written)))
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    while len(received) * 13 < total - total % 13:
+        data = buffer.read(13)
+        if data is not None:
+            received.append(data)
+    thread.join()
+
+    samples = np.frombuffer(b''.join(received), dtype=np.int16)
+    assert np.array_equal(samples, np.arange(samples.size) % 30000)
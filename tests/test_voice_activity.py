@@ -0,0 +1,68 @@
+import numpy as np
+
+from src.call.voice_activity import VoiceActivityDetector, comfort_noise
+
+CHUNK = 4096
+
+
+def noise(rms, seed=0):
+    return np.clip(np.random.default_rng(seed).normal(0, rms, CHUNK), -32768, 32767).astype(np.int16).tobytes()
+
+
+def tone(amplitude, frequency=440, rate=44100):
+    t = np.arange(CHUNK) / rate
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.int16).tobytes()
+
+
+def test_energy():
+    assert VoiceActivityDetector.energy(bytes(CHUNK * 2)) == 20 * np.log10(1 / 32768)
+    square = np.array([32767, -32767] * (CHUNK // 2), dtype=np.int16).tobytes()
+    assert abs(VoiceActivityDetector.energy(square)) < 0.01
+    assert VoiceActivityDetector.energy(b'') == 20 * np.log10(1 / 32768)
+
+
+def test_background_noise_isnt_speech():
+    vad = VoiceActivityDetector()
+    assert not any(vad.is_speech(noise(100, seed)) for seed in range(20))
+
+
+def test_speech_over_the_noise_with_hangover():
+    vad = VoiceActivityDetector()
+    for seed in range(5):
+        vad.is_speech(noise(100, seed))
+
+    assert vad.is_speech(tone(8000))
+    # The chunks right after the speech are still sent, so the ends of words aren't cut
+    hangover = [vad.is_speech(noise(100, seed)) for seed in range(5, 5 + VoiceActivityDetector.HANGOVER_CHUNKS + 2)]
+    assert hangover == [True] * VoiceActivityDetector.HANGOVER_CHUNKS + [False, False]
+
+
+def test_quiet_room_never_makes_faint_sounds_speech():
+    vad = VoiceActivityDetector()
+    for _ in range(5):
+        vad.is_speech(bytes(CHUNK * 2))
+    # Far louder than the digital silence, but below MIN_SPEECH_DB
+    assert not vad.is_speech(noise(5))
+
+
+def test_noise_estimate_follows_a_louder_room_slowly():
+    vad = VoiceActivityDetector()
+    vad.is_speech(noise(100))
+    quiet_db = vad.noise_db
+    vad.is_speech(noise(3000, seed=1))
+    assert vad.noise_db == quiet_db + VoiceActivityDetector.NOISE_RISE_DB
+
+
+def test_noise_level():
+    vad = VoiceActivityDetector()
+    assert vad.noise_level() == 0
+    vad.is_speech(noise(200))
+    assert 150 < vad.noise_level() < 250
+
+
+def test_comfort_noise():
+    pcm = comfort_noise(300, CHUNK)
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float64)
+    assert samples.size == CHUNK
+    assert 250 < np.sqrt(np.mean(samples ** 2)) < 350
+    assert comfort_noise(0, CHUNK) == bytes(CHUNK * 2)